@@ -1,13 +1,179 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .catalog_io import change_prices
 from .models import *
 
-admin.site.register(Category)
-admin.site.register(CartProduct)
-admin.site.register(Cart)
-admin.site.register(Client)
-admin.site.register(Brand)
-admin.site.register(Shoes)
-admin.site.register(Hoodie)
-admin.site.register(Pants)
-admin.site.register(Order)
+# tables with fewer rows than this are counted exactly
+ESTIMATED_COUNT_THRESHOLD = 10000
+
+
+def get_estimated_count(model, using='default'):
+    """
+    row count of the table from the planner statistics, None if the database has none
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    queries = {
+        'postgresql': 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+        'mysql': 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s',
+        # filled by ANALYZE, the first number of a row is the row count of the table or of one index,
+        # a partial index counts fewer rows, so the largest number is taken
+        'sqlite': 'SELECT MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 WHERE tbl = %s',
+    }
+    if connection.vendor not in queries:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(queries[connection.vendor], [table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if not row or row[0] is None:
+        return None
+    return int(str(row[0]).split()[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    takes the page count of an unfiltered large table from the database statistics instead of COUNT(*)
+    """
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = get_estimated_count(self.object_list.model, self.object_list.db)
+            if estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    change lists of tables that grow with the traffic: no exact counts, no full foreign key dropdowns
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+
+class PriceActionForm(ActionForm):
+    percent = forms.DecimalField(label='Изменение цены, %', required=False, max_digits=5, decimal_places=2)
+
+
+class ClothesAdmin(LargeTableAdmin):
+    list_display = ('title', 'category', 'brand', 'price', 'updated_at')
+    # the change list shows the category and the brand of every product
+    list_select_related = ('category', 'brand')
+    list_filter = ('category',)
+    search_fields = ('title', 'slug')
+    autocomplete_fields = ('category', 'brand')
+    action_form = PriceActionForm
+    actions = ('change_price',)
+
+    @admin.action(description='Изменить цену на указанный процент')
+    def change_price(self, request, queryset):
+        form = self.action_form(request.POST)
+        # the "action" choices are not set on this copy of the form, only "percent" matters here
+        form.is_valid()
+        if form.cleaned_data.get('percent') is None:
+            self.message_user(request, 'Укажите изменение цены в процентах', messages.ERROR)
+            return
+        count = change_prices(queryset, form.cleaned_data['percent'])
+        self.message_user(request, 'Цена изменена у {} товаров'.format(count))
+
+
+class OrderAdmin(LargeTableAdmin):
+    list_display = (
+        'id', 'client', 'first_name', 'last_name', 'phone', 'status', 'buying_type', 'final_price', 'created_at'
+    )
+    list_select_related = ('client__user',)
+    list_filter = ('status', 'buying_type')
+    search_fields = ('=id', 'phone', 'last_name')
+    raw_id_fields = ('client', 'cart')
+    actions = ('mark_in_progress', 'mark_ready', 'mark_completed')
+
+    def set_status(self, request, queryset, status):
+        count = queryset.update(status=status)
+        self.message_user(request, 'Статус "{}" установлен у {} заказов'.format(
+            dict(Order.STATUS_CHOICES)[status], count
+        ))
+
+    @admin.action(description='Перевести в обработку')
+    def mark_in_progress(self, request, queryset):
+        self.set_status(request, queryset, Order.STATUS_IN_PROGRESS)
+
+    @admin.action(description='Отметить готовыми')
+    def mark_ready(self, request, queryset):
+        self.set_status(request, queryset, Order.STATUS_READY)
+
+    @admin.action(description='Отметить выполненными')
+    def mark_completed(self, request, queryset):
+        self.set_status(request, queryset, Order.STATUS_COMPLETED)
+
+
+class CartProductAdmin(LargeTableAdmin):
+    list_display = ('id', 'get_title', 'cart', 'user', 'qty', 'final_price')
+    list_select_related = ('user__user', 'cart')
+    raw_id_fields = ('user', 'cart')
+
+    def get_queryset(self, request):
+        # one query per product model instead of one per row for "content_object"
+        return super().get_queryset(request).prefetch_related('content_object')
+
+    @admin.display(description='Товар')
+    def get_title(self, obj):
+        return obj.content_object.title if obj.content_object else '-'
+
+
+class CartAdmin(LargeTableAdmin):
+    list_display = ('id', 'owner', 'total_products', 'final_price', 'in_order')
+    list_select_related = ('owner__user',)
+    list_filter = ('in_order',)
+    raw_id_fields = ('owner', 'clothes')
+
+
+class ClientAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'phone')
+    list_select_related = ('user',)
+    search_fields = ('user__username', 'phone')
+    raw_id_fields = ('user', 'orders')
+
+
+class QueuedTaskAdmin(LargeTableAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'max_attempts', 'run_at', 'created_at')
+    list_filter = ('status', 'name')
+    readonly_fields = ('attempts', 'started_at', 'created_at', 'last_error')
+    actions = ('retry',)
+
+    @admin.action(description='Повторить')
+    def retry(self, request, queryset):
+        count = queryset.exclude(status=QueuedTask.STATUS_RUNNING).update(
+            status=QueuedTask.STATUS_PENDING, attempts=0, run_at=timezone.now()
+        )
+        self.message_user(request, 'Поставлено в очередь задач: {}'.format(count))
+
+
+class CategoryAdmin(admin.ModelAdmin):
+    search_fields = ('name',)
+
+
+class BrandAdmin(admin.ModelAdmin):
+    search_fields = ('name', 'slug')
+
 
+admin.site.register(Category, CategoryAdmin)
+admin.site.register(CartProduct, CartProductAdmin)
+admin.site.register(Cart, CartAdmin)
+admin.site.register(Client, ClientAdmin)
+admin.site.register(Brand, BrandAdmin)
+admin.site.register(Shoes, ClothesAdmin)
+admin.site.register(Hoodie, ClothesAdmin)
+admin.site.register(Pants, ClothesAdmin)
+admin.site.register(Order, OrderAdmin)
+admin.site.register(QueuedTask, QueuedTaskAdmin)
@@ -0,0 +1,411 @@
+import asyncio
+import http.cookiejar
+import math
+import random
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from decimal import Decimal
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.test import AsyncClient, Client as TestClient
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from . import images
+from .catalog_io import refresh_catalog
+from .models import Brand, Cart, CartProduct, CatalogEntry, Category, Client, Order, OrderLine, User
+
+BENCH_PREFIX = 'bench'
+BENCH_PASSWORD = 'bench'
+PLACEHOLDER_IMAGE = 'bench/placeholder.jpg'
+READ_ONLY_VIEWS = ('base', 'category_detail', 'clothes_detail')
+SERVER_TIMING_QUERIES_RE = re.compile(r'desc="(\d+) queries')
+CATEGORIES = (('Худи', 'hoodies'), ('Брюки', 'pants'), ('Обувь', 'shoes'))
+CATEGORY_BY_MODEL = {'hoodie': 'hoodies', 'pants': 'pants', 'shoes': 'shoes'}
+# small value pools keep the facets realistic, every value is shared by many products
+FIELD_VALUES = {
+    'color': ('черный', 'белый', 'серый', 'синий', 'красный', 'зеленый', 'бежевый'),
+    'pattern': ('однотонный', 'полоска', 'клетка', 'принт', 'камуфляж'),
+    'size': tuple(str(size) for size in range(36, 47)),
+    'claps': ('молния', 'пуговица', 'без застежки'),
+    'outsole_material': ('резина', 'ЭВА', 'полиуретан'),
+    'insole_material': ('текстиль', 'кожа', 'пена'),
+    'inner_material': ('текстиль', 'кожа', 'мех'),
+    'top_material': ('кожа', 'замша', 'текстиль', 'сетка'),
+}
+
+
+def get_placeholder_image(storage=default_storage):
+    """
+    one image shared by all seeded products, product pages expect every product to have an image
+    """
+    if not storage.exists(PLACEHOLDER_IMAGE):
+        buffer = BytesIO()
+        Image.new('RGB', (800, 800), (200, 200, 200)).save(buffer, 'JPEG')
+        storage.save(PLACEHOLDER_IMAGE, ContentFile(buffer.getvalue()))
+        images.generate_derivatives(PLACEHOLDER_IMAGE, storage)
+    return PLACEHOLDER_IMAGE
+
+
+def get_bench_username(number):
+    return '{}_user_{}'.format(BENCH_PREFIX, number)
+
+
+def seed(products=3000, brands=20, users=50, orders=500, seed_value=0, batch_size=1000, progress=None):
+    """
+    fills the database with a synthetic catalog, rows that already exist are kept, so seeding can be repeated
+    """
+    rng = random.Random(seed_value)
+    report = progress or (lambda message: None)
+    categories = {}
+    for name, slug in CATEGORIES:
+        categories[slug], _ = Category.objects.get_or_create(slug=slug, defaults={'name': name})
+    Brand.objects.bulk_create([
+        Brand(name='Bench brand {}'.format(i), slug='{}-brand-{}'.format(BENCH_PREFIX, i)) for i in range(brands)
+    ], ignore_conflicts=True)
+    brand_ids = list(
+        Brand.objects.filter(slug__startswith=BENCH_PREFIX + '-').order_by('id').values_list('id', flat=True)
+    )
+    image = get_placeholder_image()
+    for model in CatalogEntry.objects.get_clothes_models():
+        model_name = model._meta.model_name
+        category = categories[CATEGORY_BY_MODEL[model_name]]
+        char_fields = [
+            field for field in model._meta.concrete_fields
+            if field.get_internal_type() == 'CharField' and field.name != 'title'
+        ]
+        for start in range(0, products, batch_size):
+            batch = []
+            for i in range(start, min(start + batch_size, products)):
+                obj = model(
+                    category=category, brand_id=rng.choice(brand_ids), image=image, description='',
+                    slug='{}-{}-{}'.format(BENCH_PREFIX, model_name, i),
+                    title='{} {} {}'.format(category.name, model_name, i),
+                    price=Decimal(rng.randint(2000, 50000)) / 100
+                )
+                for field in char_fields:
+                    setattr(obj, field.attname, rng.choice(FIELD_VALUES.get(field.name, ('1', '2', '3', '4'))))
+                batch.append(obj)
+            model._base_manager.bulk_create(batch, ignore_conflicts=True)
+            report('{}: {}'.format(model_name, min(start + batch_size, products)))
+    password = make_password(BENCH_PASSWORD)
+    User.objects.bulk_create([
+        User(username=get_bench_username(i), email='{}@example.com'.format(get_bench_username(i)), password=password)
+        for i in range(users)
+    ], ignore_conflicts=True)
+    bench_users = User.objects.filter(username__startswith=BENCH_PREFIX + '_user_')
+    Client.objects.bulk_create([
+        Client(user_id=user_id)
+        for user_id in bench_users.exclude(client__isnull=False).values_list('id', flat=True)
+    ])
+    report('users: {}'.format(users))
+    refresh_catalog(batch_size)
+    report('catalog and search indexes rebuilt')
+    seed_orders(rng, orders)
+    report('orders: {}'.format(orders))
+
+
+def seed_orders(rng, orders):
+    # every choice comes from "rng" over rows in a fixed order, so the same seed gives the same orders
+    clients = list(Client.objects.filter(user__username__startswith=BENCH_PREFIX + '_user_').order_by('id'))
+    existing = Order.objects.filter(client__in=clients).count()
+    entries = list(CatalogEntry.objects.filter(slug__startswith=BENCH_PREFIX + '-').order_by('id'))
+    if not clients or not entries:
+        return
+    entries = rng.sample(entries, min(len(entries), 500))
+    for _ in range(existing, orders):
+        client = rng.choice(clients)
+        with transaction.atomic():
+            cart = Cart.objects.create(owner=client, in_order=True)
+            cart_products = []
+            for entry in rng.sample(entries, min(len(entries), rng.randint(1, 4))):
+                qty = rng.randint(1, 3)
+                cart_product = CartProduct(
+                    user=client, cart=cart, content_type_id=entry.content_type_id, object_id=entry.object_id,
+                    qty=qty, final_price=qty * entry.price
+                )
+                cart_product.save()
+                cart_products.append(cart_product)
+            cart.clothes.add(*cart_products)
+            final_price = sum(p.final_price for p in cart_products)
+            Cart.objects.filter(pk=cart.pk).update(total_products=len(cart_products), final_price=final_price)
+            order = Order.objects.create(
+                client=client, first_name='Bench', last_name='User', phone='000', cart=cart, final_price=final_price
+            )
+            order.related_client.add(client)
+            OrderLine.objects.create_for_order(order, cart.get_products())
+
+
+def get_targets(limit=200):
+    """
+    products the scenario picks from, with everything needed to build their URLs
+    """
+    content_types = {ct.id: ct.model for ct in ContentType.objects.filter(app_label='mainapp')}
+    entries = CatalogEntry.objects.filter(slug__startswith=BENCH_PREFIX + '-').select_related('category')[:limit]
+    targets = [
+        dict(
+            model_name=content_types[entry.content_type_id], slug=entry.slug,
+            category_url=entry.category.get_absolute_url()
+        )
+        for entry in entries
+    ]
+    if not targets:
+        raise ValueError('No benchmark products found, run "seed_benchmark" first')
+    return targets
+
+
+def get_scenario(rng, targets, views=None):
+    """
+    one visit of a customer: browsing, cart changes, checkout and order history, as (name, method, path, data)
+    """
+    product = rng.choice(targets)
+    kwargs = {'ct_model': product['model_name'], 'slug': product['slug']}
+    scenario = [
+        ('base', 'get', reverse('base'), None),
+        ('category_detail', 'get', product['category_url'], None),
+        ('clothes_detail', 'get', reverse('clothes_detail', kwargs=kwargs), None),
+        ('add_to_cart', 'get', reverse('add_to_cart', kwargs=kwargs), None),
+        ('change_qty', 'post', reverse('change_qty', kwargs=kwargs), {'qty': rng.randint(1, 5)}),
+        ('cart', 'get', reverse('cart'), None),
+        ('checkout', 'get', reverse('checkout'), None),
+        ('delete_from_cart', 'get', reverse('delete_from_cart', kwargs=kwargs), None),
+        ('profile', 'get', reverse('profile'), None),
+    ]
+    return [step for step in scenario if views is None or step[0] in views]
+
+
+def get_server_timing_queries(header):
+    """
+    query count from the "Server-Timing" header of InstrumentationMiddleware, None if it is not sent
+    """
+    match = SERVER_TIMING_QUERIES_RE.search(header or '')
+    return int(match.group(1)) if match else None
+
+
+class TestClientDriver:
+    """
+    sends requests through the django test client (the WSGI handler) in this process, SQL queries are counted
+    """
+    def __init__(self, user):
+        self.client = TestClient()
+        self.client.force_login(user)
+
+    def request(self, method, path, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(self.client, method)(path, data)
+            elapsed = time.perf_counter() - started
+        return response.status_code, elapsed, len(queries)
+
+    def close(self):
+        connection.close()
+
+
+class AsyncTestClientDriver:
+    """
+    sends requests through the django async test client (the ASGI handler) in this process,
+    queries are read from the "Server-Timing" header
+    """
+    def __init__(self, user):
+        self.client = AsyncClient()
+        self.client.force_login(user)
+
+    async def request(self, method, path, data=None):
+        started = time.perf_counter()
+        if method == 'post':
+            # the multipart body of the django 3.2 async client can not be parsed by ASGIRequest
+            response = await self.client.post(
+                path, urllib.parse.urlencode(data or {}), content_type='application/x-www-form-urlencoded'
+            )
+        else:
+            response = await self.client.get(path, data)
+        elapsed = time.perf_counter() - started
+        return response.status_code, elapsed, get_server_timing_queries(response.get('Server-Timing'))
+
+    def close(self):
+        pass
+
+
+class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPDriver:
+    """
+    sends requests to a running server (runserver, gunicorn, uvicorn), one cookie session per driver,
+    queries are read from the "Server-Timing" header when the server sends it
+    """
+    def __init__(self, base_url, username, password=BENCH_PASSWORD, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), NoRedirectHandler
+        )
+        # the login page sets the CSRF cookie needed by every POST
+        self.request('get', reverse('login'))
+        status, _, _ = self.request('post', reverse('login'), {'username': username, 'password': password})
+        if status != 302:
+            raise ValueError('Could not log in as {} on {}'.format(username, self.base_url))
+
+    def get_csrf_token(self):
+        return next((cookie.value for cookie in self.cookies if cookie.name == 'csrftoken'), '')
+
+    def request(self, method, path, data=None):
+        body = None
+        if method == 'post':
+            body = urllib.parse.urlencode(dict(data or {}, csrfmiddlewaretoken=self.get_csrf_token())).encode()
+        started = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, data=body, timeout=self.timeout) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as error:
+            status, headers = error.code, error.headers
+        return status, time.perf_counter() - started, get_server_timing_queries(headers.get('Server-Timing'))
+
+    def close(self):
+        pass
+
+
+def percentile(values, percent):
+    """
+    nearest-rank percentile of sorted values
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def summarize(samples):
+    latencies = sorted(elapsed for _, _, elapsed, _ in samples)
+    queries = [count for _, _, _, count in samples if count is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, status, _, _ in samples if status is None or status >= 400),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'queries_median': statistics.median(queries) if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+def get_bench_users(concurrency):
+    users = list(User.objects.filter(username__startswith=BENCH_PREFIX + '_user_').order_by('id')[:concurrency])
+    if len(users) < concurrency:
+        raise ValueError('Only {} benchmark users exist, seed more users or lower the concurrency'.format(len(users)))
+    return users
+
+
+def build_report(samples, elapsed, concurrency, iterations, failures):
+    views = {}
+    for sample in samples:
+        views.setdefault(sample[0], []).append(sample)
+    return {
+        'concurrency': concurrency,
+        'iterations': iterations,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+        'total': summarize(samples),
+        'views': {name: summarize(view_samples) for name, view_samples in sorted(views.items())},
+        'failures': failures[:20],
+    }
+
+
+def run(make_driver, concurrency=4, iterations=20, warmup=1, seed_value=0, views=None):
+    """
+    every worker thread logs in as its own benchmark user and repeats the scenario, returns the JSON-ready report
+    """
+    targets = get_targets()
+    users = get_bench_users(concurrency)
+    connection.close()
+    samples = []
+    failures = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(number, user):
+        rng = random.Random(seed_value + number)
+        worker_samples = []
+        driver = None
+        try:
+            driver = make_driver(user)
+            for _ in range(warmup):
+                for _, method, path, data in get_scenario(rng, targets, views):
+                    driver.request(method, path, data)
+        except Exception as error:
+            failures.append(repr(error))
+        barrier.wait()
+        try:
+            if driver is not None:
+                for _ in range(iterations):
+                    for name, method, path, data in get_scenario(rng, targets, views):
+                        try:
+                            status, elapsed, queries = driver.request(method, path, data)
+                        except Exception as error:
+                            failures.append(repr(error))
+                            status, elapsed, queries = None, 0, None
+                        worker_samples.append((name, status, elapsed, queries))
+        finally:
+            if driver is not None:
+                driver.close()
+            with lock:
+                samples.extend(worker_samples)
+
+    threads = [threading.Thread(target=worker, args=(i, user)) for i, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return build_report(samples, time.perf_counter() - started, concurrency, iterations, failures)
+
+
+def run_async(make_driver, concurrency=4, iterations=20, warmup=1, seed_value=0, views=None):
+    """
+    same as "run", but the workers are tasks of one event loop and the drivers are awaited
+    """
+    targets = get_targets()
+    drivers = [make_driver(user) for user in get_bench_users(concurrency)]
+    connection.close()
+    samples = []
+    failures = []
+
+    async def worker(number, driver, measured):
+        rng = random.Random(seed_value + number)
+        for _ in range(iterations if measured else warmup):
+            for name, method, path, data in get_scenario(rng, targets, views):
+                try:
+                    status, elapsed, queries = await driver.request(method, path, data)
+                except Exception as error:
+                    failures.append(repr(error))
+                    status, elapsed, queries = None, 0, None
+                if measured:
+                    samples.append((name, status, elapsed, queries))
+
+    async def main():
+        await asyncio.gather(*[worker(i, driver, False) for i, driver in enumerate(drivers)])
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(i, driver, True) for i, driver in enumerate(drivers)])
+        return time.perf_counter() - started
+
+    elapsed = asyncio.run(main())
+    for driver in drivers:
+        driver.close()
+    return build_report(samples, elapsed, concurrency, iterations, failures)
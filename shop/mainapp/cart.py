@@ -0,0 +1,176 @@
+from decimal import Decimal
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.utils.functional import SimpleLazyObject
+
+from .models import Cart, CartProduct, Client
+from .utils import CART_SUMMARY_SESSION_KEY, invalidate_cart_summary, update_cart_totals
+
+
+def get_client_cart(user):
+    """
+    returns the open cart of a logged in user, creating the client and the cart if needed
+    """
+    client = Client.objects.filter(user=user).first()
+    if not client:
+        client = Client.objects.create(user=user)
+    cart = Cart.objects.filter(owner=client, in_order=False).first()
+    if not cart:
+        cart = Cart.objects.create(owner=client)
+    return cart
+
+
+def get_request_cart(request):
+    """
+    returns the cart of the request as a lazy object, the database is only queried on first use
+    """
+    if not hasattr(request, '_cart'):
+        if request.user.is_authenticated:
+            request._cart = SimpleLazyObject(lambda: get_client_cart(request.user))
+        else:
+            request._cart = SessionCart(request.session)
+    return request._cart
+
+
+def get_cart_summary(request):
+    """
+    returns the number of products and the total of the cart, cached in the session until the cart changes
+    """
+    cart = get_request_cart(request)
+    if not request.user.is_authenticated:
+        return {'total_products': cart.total_products, 'final_price': cart.final_price}
+    summary = request.session.get(CART_SUMMARY_SESSION_KEY)
+    if not summary or summary.get('user_id') != request.user.id:
+        summary = {
+            'user_id': request.user.id,
+            'total_products': cart.total_products,
+            'final_price': str(cart.final_price)
+        }
+        request.session[CART_SUMMARY_SESSION_KEY] = summary
+    return {'total_products': summary['total_products'], 'final_price': Decimal(summary['final_price'])}
+
+
+class SessionCartProduct:
+    """
+    cart item of an anonymous user, priced like the cart total at the price kept when it was added,
+    the same as the lines of a client cart
+    """
+    def __init__(self, content_object, qty, price):
+        self.content_object = content_object
+        self.qty = qty
+        self.final_price = qty * price
+
+
+class SessionCart:
+    """
+    cart of an anonymous user, lives in the session and is merged into the client cart on login
+    """
+    SESSION_KEY = 'anon_cart'
+
+    owner = None
+    in_order = False
+    anon_user = True
+
+    def __init__(self, session):
+        self.session = session
+
+    def __str__(self):
+        return 'session'
+
+    @staticmethod
+    def get_item_key(clothes):
+        return '{}:{}'.format(clothes.get_model_name(), clothes.id)
+
+    @property
+    def items(self):
+        return self.session.get(self.SESSION_KEY, {})
+
+    @property
+    def total_products(self):
+        return len(self.items)
+
+    @property
+    def final_price(self):
+        return sum((Decimal(item['price']) * item['qty'] for item in self.items.values()), Decimal(0))
+
+    def save_items(self, items):
+        # the session only notices reassignment, not in-place changes of nested data
+        if items:
+            self.session[self.SESSION_KEY] = items
+        else:
+            self.session.pop(self.SESSION_KEY, None)
+
+    # the session argument keeps the interface of the client cart, this cart lives in its own session
+    def add(self, clothes, session=None):
+        items = dict(self.items)
+        key = self.get_item_key(clothes)
+        if key not in items:
+            items[key] = {'qty': 1, 'price': str(clothes.price)}
+            self.save_items(items)
+
+    def remove(self, clothes, session=None):
+        items = dict(self.items)
+        items.pop(self.get_item_key(clothes), None)
+        self.save_items(items)
+
+    def set_qty(self, clothes, qty, session=None):
+        if qty < 1:
+            raise ValueError('qty must be at least 1')
+        items = dict(self.items)
+        key = self.get_item_key(clothes)
+        if key in items:
+            items[key] = {'qty': qty, 'price': str(clothes.price)}
+            self.save_items(items)
+
+    def clear(self):
+        self.save_items({})
+
+    def get_products(self):
+        """
+        loads the products with one query per product model
+        """
+        ids_by_model = {}
+        for key in self.items:
+            model_name, object_id = key.split(':')
+            ids_by_model.setdefault(model_name, []).append(int(object_id))
+        objects = {}
+        for model_name, ids in ids_by_model.items():
+            model = apps.get_model('mainapp', model_name)
+            for object_id, obj in model.objects.for_listing().in_bulk(ids).items():
+                objects['{}:{}'.format(model_name, object_id)] = obj
+        items = {key: item for key, item in self.items.items() if key in objects}
+        if len(items) != len(self.items):
+            # deleted products leave the cart, so its total keeps matching its lines
+            self.save_items(items)
+        return [SessionCartProduct(objects[key], item['qty'], Decimal(item['price'])) for key, item in items.items()]
+
+    @transaction.atomic
+    def merge_into(self, cart):
+        """
+        moves the items into the persistent cart of the client, the lines keep the prices of the session
+        and the cart totals change by their sum like in "add_cart_product"
+        """
+        products = self.get_products()
+        if not products:
+            self.clear()
+            return
+        products_delta, price_delta = 0, 0
+        for product in products:
+            content_type = ContentType.objects.get_for_model(product.content_object.__class__)
+            cart_product, created = CartProduct.objects.get_or_create(
+                user=cart.owner, cart=cart, content_type=content_type, object_id=product.content_object.id,
+                defaults={'qty': product.qty, 'final_price': product.final_price}
+            )
+            if created:
+                cart.clothes.add(cart_product)
+                products_delta += 1
+            else:
+                CartProduct.objects.filter(pk=cart_product.pk).update(
+                    qty=models.F('qty') + product.qty, final_price=models.F('final_price') + product.final_price
+                )
+            price_delta += product.final_price
+        update_cart_totals(cart, products_delta, price_delta)
+        invalidate_cart_summary(self.session)
+        self.clear()
@@ -0,0 +1,274 @@
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from . import images, page_cache, search
+from .models import Brand, CatalogEntry, Category, Hoodie, LatestProducts, Pants, Shoes, bump_product_version
+
+IMPORT_MODELS = {
+    'brand': Brand,
+    'hoodie': Hoodie,
+    'pants': Pants,
+    'shoes': Shoes
+}
+# foreign keys are written and read as slugs of the related rows
+SLUG_RELATIONS = {
+    'category': Category,
+    'brand': Brand
+}
+FORMATS = ('csv', 'jsonl')
+
+
+def get_columns(model):
+    """
+    importable fields of the model, "slug" first because it identifies the row
+    """
+    names = [
+        field.name for field in model._meta.concrete_fields
+        if not field.primary_key and not getattr(field, 'auto_now', False)
+    ]
+    names.remove('slug')
+    return ['slug'] + names
+
+
+def guess_format(path, default='csv'):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return extension if extension in FORMATS else default
+
+
+def read_rows(file, file_format):
+    """
+    yields the rows of a CSV or JSON Lines file as dicts with their line number
+    """
+    if file_format == 'jsonl':
+        for line_number, line in enumerate(file, 1):
+            if line.strip():
+                yield line_number, json.loads(line)
+    else:
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def write_rows(file, file_format, columns, rows):
+    if file_format == 'jsonl':
+        for row in rows:
+            file.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n')
+    else:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def export_rows(model, chunk_size=2000):
+    """
+    streams the rows of the model in the import column order, related rows are replaced by their slugs
+    """
+    columns = get_columns(model)
+    values = ['{}__slug'.format(name) if name in SLUG_RELATIONS else name for name in columns]
+    rows = model._base_manager.order_by('id').values_list(*values).iterator(chunk_size=chunk_size)
+    return columns, rows
+
+
+def update_rows(model, objs, field_names):
+    """
+    one parametrized UPDATE per row sent with "executemany", much cheaper than the CASE expressions of "bulk_update"
+    """
+    fields = [model._meta.get_field(name) for name in field_names]
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join('{} = %s'.format(connection.ops.quote_name(field.column)) for field in fields),
+        connection.ops.quote_name(model._meta.pk.column)
+    )
+    params = [
+        [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields] + [obj.pk]
+        for obj in objs
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def ingest_image(name, image_dir, derivatives=True, storage=default_storage):
+    """
+    copies the image from the import directory into the storage, returns the stored name
+    """
+    if image_dir and not storage.exists(name):
+        source = os.path.join(image_dir, name)
+        if os.path.exists(source):
+            with open(source, 'rb') as file:
+                name = storage.save(name, File(file))
+    if derivatives:
+        # the import refreshes the caches of its products when it finishes
+        images.generate_derivatives(name, storage, refresh=False)
+    return name
+
+
+class CatalogImporter:
+    """
+    creates and updates rows of one model in batches, rows are matched by slug
+    """
+    def __init__(self, model, batch_size=1000, image_dir=None, workers=4, derivatives=True):
+        self.model = model
+        self.batch_size = batch_size
+        self.image_dir = image_dir
+        self.workers = workers
+        self.derivatives = derivatives
+        self.columns = get_columns(model)
+        self.fields = {name: model._meta.get_field(name) for name in self.columns}
+        self.has_image = 'image' in self.fields
+        # "update_rows" skips "pre_save", so these fields are set by hand for updated rows
+        self.auto_now_fields = [
+            field.name for field in model._meta.concrete_fields if getattr(field, 'auto_now', False)
+        ]
+        self.slug_maps = {
+            name: dict(related_model.objects.values_list('slug', 'id'))
+            for name, related_model in SLUG_RELATIONS.items() if name in self.fields
+        }
+        existing_fields = ('slug', 'id', 'image') if self.has_image else ('slug', 'id')
+        self.existing = {row[0]: row[1:] for row in model._base_manager.values_list(*existing_fields)}
+        self.created = self.updated = 0
+        self.updated_ids = []
+
+    def build(self, line_number, row):
+        obj = self.model()
+        for name, field in self.fields.items():
+            value = row.get(name)
+            if name in self.slug_maps:
+                if value not in self.slug_maps[name]:
+                    raise ValidationError('line {}: unknown {} "{}"'.format(line_number, name, value))
+                setattr(obj, field.attname, self.slug_maps[name][value])
+            elif value is not None:
+                try:
+                    setattr(obj, field.attname, field.to_python(value))
+                except ValidationError as error:
+                    raise ValidationError('line {}: {}: {}'.format(line_number, name, '; '.join(error.messages)))
+        if not obj.slug:
+            raise ValidationError('line {}: empty slug'.format(line_number))
+        return obj
+
+    def run(self, rows, progress=None):
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for line_number, row in rows:
+                batch.append(self.build(line_number, row))
+                if len(batch) >= self.batch_size:
+                    self.write_batch(batch, executor)
+                    batch = []
+                    if progress:
+                        progress(self.created + self.updated)
+            if batch:
+                self.write_batch(batch, executor)
+                if progress:
+                    progress(self.created + self.updated)
+        return self.created, self.updated
+
+    def write_batch(self, batch, executor):
+        # the last row wins when a slug repeats inside the batch
+        batch = list({obj.slug: obj for obj in batch}.values())
+        replaced_images = []
+        if self.has_image:
+            with_image = [obj for obj in batch if obj.image]
+            names = executor.map(
+                lambda name: ingest_image(name, self.image_dir, self.derivatives),
+                [obj.image.name for obj in with_image]
+            )
+            for obj, name in zip(with_image, names):
+                obj.image = name
+        to_create, to_update = [], []
+        for obj in batch:
+            if obj.slug in self.existing:
+                obj.id = self.existing[obj.slug][0]
+                old_image = self.existing[obj.slug][1] if self.has_image else None
+                if old_image and old_image != obj.image.name:
+                    replaced_images.append(old_image)
+                to_update.append(obj)
+            else:
+                to_create.append(obj)
+        now = timezone.now()
+        for obj in to_update:
+            for name in self.auto_now_fields:
+                setattr(obj, name, now)
+        with transaction.atomic():
+            self.model._base_manager.bulk_create(to_create, batch_size=self.batch_size)
+            update_rows(self.model, to_update, [name for name in self.columns if name != 'slug'] + self.auto_now_fields)
+        if to_create and to_create[0].id is None:
+            # only some backends return the primary keys from "bulk_create"
+            ids = dict(self.model._base_manager.filter(
+                slug__in=[obj.slug for obj in to_create]
+            ).values_list('slug', 'id'))
+            for obj in to_create:
+                obj.id = ids[obj.slug]
+        for obj in to_create + to_update:
+            self.existing[obj.slug] = (obj.id, obj.image.name) if self.has_image else (obj.id,)
+        self.created += len(to_create)
+        self.updated += len(to_update)
+        self.updated_ids.extend(obj.id for obj in to_update)
+        for name in replaced_images:
+            images.delete_image(name)
+
+    def finish(self):
+        refresh_catalog(self.batch_size)
+        if self.model is not Brand:
+            for pk in self.updated_ids:
+                bump_product_version(self.model._meta.model_name, pk)
+
+
+def refresh_catalog(batch_size=1000):
+    """
+    bulk writes skip the model signals, so the indexes and caches they maintain are refreshed here
+    """
+    with transaction.atomic():
+        CatalogEntry.objects.rebuild(batch_size=batch_size)
+        search.rebuild_index(batch_size=batch_size)
+    Category.objects.invalidate_categories_for_nav()
+    LatestProducts.objects.rebuild_feed()
+    page_cache.purge_tags(page_cache.NAV_TAG)
+    for model in CatalogEntry.objects.get_clothes_models():
+        model.objects.invalidate_facets()
+
+
+class RoundPrice(models.Func):
+    function = 'ROUND'
+    template = '%(function)s(%(expressions)s, 2)'
+    output_field = models.DecimalField(max_digits=7, decimal_places=2)
+
+
+def change_prices(queryset, percent):
+    """
+    changes the prices of the products by "percent" with one UPDATE of the product table and one of the
+    catalog index, then refreshes the caches the model signals would have refreshed, returns the number of products
+    """
+    model = queryset.model
+    model_name = model._meta.model_name
+    ids = list(queryset.values_list('id', flat=True))
+    if not ids:
+        return 0
+    factor = (Decimal(100) + Decimal(percent)) / 100
+    selected = model._base_manager.filter(id__in=queryset.values('id'))
+    new_price = RoundPrice(models.F('price') * factor)
+    with transaction.atomic():
+        # the index goes first, the selection may depend on the old prices
+        CatalogEntry.objects.filter(
+            content_type=ContentType.objects.get_for_model(model), object_id__in=selected.values('id')
+        ).update(price=models.Subquery(
+            model._base_manager.filter(id=models.OuterRef('object_id')).annotate(
+                new_price=new_price
+            ).values('new_price')[:1]
+        ))
+        selected.update(price=new_price, updated_at=timezone.now())
+    for pk in ids:
+        bump_product_version(model_name, pk)
+    page_cache.purge_tags(
+        page_cache.get_listing_tag(model_name), *[page_cache.get_product_tag(model_name, pk) for pk in ids]
+    )
+    LatestProducts.objects.rebuild_feed()
+    return len(ids)
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+# cache backends whose entries are visible only to the process that wrote them
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+@register()
+def check_task_backend_cache(app_configs, **kwargs):
+    """
+    tasks of the "db" backend run in the "run_tasks" process, the caches they invalidate
+    have to be shared with the web processes
+    """
+    if getattr(settings, 'TASKS_BACKEND', 'thread') != 'db':
+        return []
+    if settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        'TASKS_BACKEND "db" requires a cache shared between processes',
+        hint='Set DJANGO_CACHE_BACKEND to the database, file, Memcached or Redis cache backend.',
+        obj='TASKS_BACKEND',
+        id='mainapp.E001',
+    )]
@@ -0,0 +1,8 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cart import get_cart_summary
+
+
+# makes the cart summary (badge count and total) available to every template
+def cart_summary(request):
+    return {'cart_summary': SimpleLazyObject(lambda: get_cart_summary(request))}
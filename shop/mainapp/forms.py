@@ -10,6 +10,8 @@ class OrderForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.fields['order_date'].label = 'Дата получения заказа'
     order_date = forms.DateField(widget=forms.TextInput(attrs={'type': 'date'}))
+    # generated for every checkout page, a repeated submit with the same key does not create a second order
+    idempotency_key = forms.CharField(max_length=64, widget=forms.HiddenInput)
 
     class Meta:
         model = Order
@@ -17,6 +19,11 @@ class OrderForm(forms.ModelForm):
             'first_name', 'last_name', 'phone', 'address', 'buying_type', 'order_date', 'comment'
         )
 
+# quantity of a cart product, the same limits for the session cart and the client cart
+class CartQTYForm(forms.Form):
+
+    qty = forms.IntegerField(min_value=1, max_value=999)
+
 # login form
 class LoginForm(forms.ModelForm):
 
@@ -0,0 +1,123 @@
+import logging
+import os
+from io import BytesIO
+
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_DIR = 'derivatives'
+DERIVATIVE_WIDTHS = (150, 300, 600)
+DERIVATIVE_FORMATS = (
+    ('jpg', 'JPEG', 'image/jpeg'),
+    ('webp', 'WEBP', 'image/webp'),
+)
+
+
+def get_derivative_name(name, width, extension):
+    stem = os.path.splitext(name)[0]
+    return '{}/{}_{}.{}'.format(DERIVATIVES_DIR, stem, width, extension)
+
+
+def get_derivative_names(name):
+    return [
+        get_derivative_name(name, width, extension)
+        for width in DERIVATIVE_WIDTHS for extension, _, _ in DERIVATIVE_FORMATS
+    ]
+
+
+@task()
+def generate_derivatives(name, storage=default_storage, refresh=True):
+    """
+    creates resized JPEG and WebP copies of the image for every width in DERIVATIVE_WIDTHS,
+    "refresh" drops the cached cards and pages of the products showing the image
+    """
+    if not name or not storage.exists(name):
+        logger.warning('Image %s not found, derivatives are not generated', name)
+        return
+    with storage.open(name) as file:
+        original = Image.open(file)
+        original.load()
+    if original.mode not in ('RGB', 'L'):
+        original = original.convert('RGB')
+    for width in DERIVATIVE_WIDTHS:
+        image = original
+        if original.width > width:
+            height = round(original.height * width / original.width)
+            image = original.resize((width, height), Image.LANCZOS)
+        for extension, image_format, _ in DERIVATIVE_FORMATS:
+            buffer = BytesIO()
+            image.save(buffer, image_format, quality=82)
+            derivative_name = get_derivative_name(name, width, extension)
+            if storage.exists(derivative_name):
+                storage.delete(derivative_name)
+            storage.save(derivative_name, ContentFile(buffer.getvalue()))
+    if refresh:
+        refresh_products_with_image(name)
+
+
+def refresh_products_with_image(name):
+    """
+    cards and pages cached before the derivatives existed have no srcset, they are rendered again
+    """
+    # imported here, the models import this module
+    from . import page_cache
+    from .models import bump_product_version
+
+    CatalogEntry = apps.get_model('mainapp', 'CatalogEntry')
+    tags = []
+    for model in CatalogEntry.objects.get_clothes_models():
+        model_name = model._meta.model_name
+        ids = list(model._base_manager.filter(image=name).values_list('id', flat=True))
+        for pk in ids:
+            bump_product_version(model_name, pk)
+            tags.append(page_cache.get_product_tag(model_name, pk))
+        if ids:
+            tags.append(page_cache.get_listing_tag(model_name))
+    if tags:
+        page_cache.purge_tags(*tags)
+
+
+def delete_derivatives(name, storage=default_storage):
+    for derivative_name in get_derivative_names(name):
+        if storage.exists(derivative_name):
+            storage.delete(derivative_name)
+
+
+def is_image_used(name):
+    """
+    True if a product still shows the image, products imported from one file may share it
+    """
+    CatalogEntry = apps.get_model('mainapp', 'CatalogEntry')
+    return any(model._base_manager.filter(image=name).exists() for model in CatalogEntry.objects.get_clothes_models())
+
+
+@task()
+def delete_image(name, storage=default_storage):
+    """
+    removes the image of a deleted or updated product together with its derivatives,
+    unless another product uses the same file
+    """
+    if is_image_used(name):
+        return
+    delete_derivatives(name, storage)
+    if storage.exists(name):
+        storage.delete(name)
+
+
+def get_srcset(name, extension, storage=default_storage):
+    """
+    srcset for the derivatives of the image, empty if they were not generated yet
+    """
+    largest = get_derivative_name(name, DERIVATIVE_WIDTHS[-1], extension)
+    if not name or not storage.exists(largest):
+        return ''
+    return ', '.join(
+        '{} {}w'.format(storage.url(get_derivative_name(name, width, extension)), width)
+        for width in DERIVATIVE_WIDTHS
+    )
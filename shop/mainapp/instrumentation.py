@@ -0,0 +1,200 @@
+import bisect
+import contextlib
+import contextvars
+import hmac
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# timings of the request handled in the current thread or task
+current_timings = contextvars.ContextVar('mainapp_request_timings', default=None)
+# set while code runs the same statement several times on purpose
+repeats_allowed = contextvars.ContextVar('mainapp_repeats_allowed', default=False)
+
+
+class RequestTimings:
+    """
+    what one request spent on SQL and template rendering, the sync_to_async threads of an async
+    request update it at the same time, so every change takes the lock
+    """
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.statements = Counter()
+        self.lock = threading.Lock()
+
+    def add_query(self, sql, duration, repeat_allowed=False):
+        with self.lock:
+            self.db_time += duration
+            self.queries += 1
+            if not repeat_allowed:
+                self.statements[sql] += 1
+
+    def add_template_time(self, duration):
+        with self.lock:
+            self.template_time += duration
+
+    def get_duplicates(self, threshold):
+        """
+        statements run at least "threshold" times with different parameters, the usual sign of an N+1 loop
+        """
+        with self.lock:
+            statements = self.statements.most_common()
+        return [(sql, count) for sql, count in statements if count >= threshold]
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    database execute wrapper installed on every connection, it also sees queries run by
+    sync_to_async threads because the timings travel with the request context
+    """
+    timings = current_timings.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_query(sql, time.perf_counter() - started, repeats_allowed.get())
+
+
+@contextlib.contextmanager
+def allow_repeated_queries():
+    """
+    the queries run inside are still counted and timed, but not reported as a possible N+1 loop
+    """
+    token = repeats_allowed.set(True)
+    try:
+        yield
+    finally:
+        repeats_allowed.reset(token)
+
+
+def instrument_connection(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class Histogram:
+    """
+    cumulative histogram in the Prometheus layout
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        total = 0
+        for le, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield le, total
+
+
+class ViewStats:
+
+    def __init__(self):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.db_duration = Histogram(DURATION_BUCKETS)
+        self.template_duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.duplicate_query_requests = 0
+
+
+class StatsRegistry:
+    """
+    in-process aggregate of request timings by URL name, every worker process keeps its own
+    """
+    METRICS = (
+        ('duration', 'mainapp_request_duration_seconds', 'Wall time of requests'),
+        ('db_duration', 'mainapp_request_db_duration_seconds', 'Time spent in SQL queries per request'),
+        ('template_duration', 'mainapp_request_template_duration_seconds', 'Time spent in templates per request'),
+        ('queries', 'mainapp_request_queries', 'SQL queries per request'),
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.reported_duplicates = set()
+
+    def record(self, view_name, duration, timings, duplicates):
+        with self.lock:
+            stats = self.views.get(view_name)
+            if stats is None:
+                stats = self.views[view_name] = ViewStats()
+            stats.duration.observe(duration)
+            stats.db_duration.observe(timings.db_time)
+            stats.template_duration.observe(timings.template_time)
+            stats.queries.observe(timings.queries)
+            if duplicates:
+                stats.duplicate_query_requests += 1
+            # every duplicated statement is logged once per view to keep the log readable
+            new_duplicates = [
+                (sql, count) for sql, count in duplicates if (view_name, sql) not in self.reported_duplicates
+            ]
+            self.reported_duplicates.update((view_name, sql) for sql, _ in new_duplicates)
+        for sql, count in new_duplicates:
+            logger.warning('Possible N+1 in view "%s": query repeated %s times: %s', view_name, count, sql[:500])
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+            self.reported_duplicates = set()
+
+    def export(self):
+        """
+        all metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            lines = []
+            for attribute, name, description in self.METRICS:
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} histogram'.format(name))
+                for view_name, stats in sorted(self.views.items()):
+                    histogram = getattr(stats, attribute)
+                    label = 'view="{}"'.format(escape_label(view_name))
+                    for le, count in histogram.get_cumulative_counts():
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, le, count))
+                    lines.append('{}_sum{{{}}} {}'.format(name, label, round(histogram.sum, 6)))
+                    lines.append('{}_count{{{}}} {}'.format(name, label, histogram.count))
+            name = 'mainapp_duplicate_query_requests_total'
+            lines.append('# HELP {} Requests that repeated the same SQL statement'.format(name))
+            lines.append('# TYPE {} counter'.format(name))
+            for view_name, stats in sorted(self.views.items()):
+                lines.append('{}{{view="{}"}} {}'.format(
+                    name, escape_label(view_name), stats.duplicate_query_requests
+                ))
+            return '\n'.join(lines) + '\n'
+
+
+def has_metrics_token(request):
+    """
+    True if the request sends the METRICS_TOKEN setting as a bearer token, for scrapers that do not log in
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if not token:
+        return False
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    return hmac.compare_digest(header.encode(), 'Bearer {}'.format(token).encode())
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = StatsRegistry()
@@ -0,0 +1,75 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment
+
+from mainapp import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs the storefront scenario (home, category, product, cart, checkout, profile) with concurrent workers '
+        'and prints p50/p95/p99 latency, throughput and per-view query counts as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url', help='base URL of a running server, e.g. http://127.0.0.1:8000, '
+                          'by default requests go through the test client in this process'
+        )
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--iterations', type=int, default=20, help='scenario runs per worker')
+        parser.add_argument('--warmup', type=int, default=1, help='scenario runs per worker that are not measured')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--interface', choices=('wsgi', 'asgi', 'both'), default='wsgi',
+            help='handler the test client goes through, "both" runs the scenario twice and compares throughput'
+        )
+        parser.add_argument(
+            '--read-only', action='store_true', help='only the home, category and product pages, no cart changes'
+        )
+        parser.add_argument('--output', help='file for the JSON report, stdout by default')
+
+    def handle(self, *args, **options):
+        views = benchmark.READ_ONLY_VIEWS if options['read_only'] else None
+        if options['url']:
+            def make_driver(user):
+                return benchmark.HTTPDriver(options['url'], user.username)
+            report = self.run_benchmark(benchmark.run, make_driver, views, options)
+            report['mode'] = 'http'
+            report['url'] = options['url']
+        else:
+            setup_test_environment()
+            # the async client reads query counts from the header of InstrumentationMiddleware
+            settings.INSTRUMENTATION_SERVER_TIMING = True
+            reports = {}
+            if options['interface'] in ('wsgi', 'both'):
+                reports['wsgi'] = self.run_benchmark(benchmark.run, benchmark.TestClientDriver, views, options)
+            if options['interface'] in ('asgi', 'both'):
+                reports['asgi'] = self.run_benchmark(
+                    benchmark.run_async, benchmark.AsyncTestClientDriver, views, options
+                )
+            if len(reports) == 1:
+                report = dict(reports.popitem()[1], interface=options['interface'])
+            else:
+                report = dict(reports)
+                wsgi_rps, asgi_rps = reports['wsgi']['throughput_rps'], reports['asgi']['throughput_rps']
+                report['asgi_to_wsgi_throughput'] = round(asgi_rps / wsgi_rps, 2) if wsgi_rps and asgi_rps else None
+            report['mode'] = 'client'
+        report['read_only'] = options['read_only']
+        data = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(data)
+        else:
+            self.stdout.write(data)
+
+    def run_benchmark(self, run, make_driver, views, options):
+        try:
+            return run(
+                make_driver, concurrency=options['concurrency'], iterations=options['iterations'],
+                warmup=options['warmup'], seed_value=options['seed'], views=views
+            )
+        except ValueError as error:
+            raise CommandError(error)
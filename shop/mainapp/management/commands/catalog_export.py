@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.catalog_io import FORMATS, IMPORT_MODELS, export_rows, guess_format, write_rows
+
+
+class Command(BaseCommand):
+    help = 'Writes brands or products to a CSV or JSON Lines file readable by "catalog_import"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(IMPORT_MODELS))
+        parser.add_argument('--output', default='-', help='file to write, stdout by default')
+        parser.add_argument('--format', choices=FORMATS, help='guessed from the file extension by default')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['output']
+        file_format = options['format'] or guess_format(path)
+        columns, rows = export_rows(IMPORT_MODELS[options['model']], chunk_size=options['chunk_size'])
+        if path == '-':
+            write_rows(self.stdout, file_format, columns, rows)
+            return
+        with open(path, 'w', encoding='utf-8', newline='') as file:
+            write_rows(file, file_format, columns, rows)
+        self.stderr.write(self.style.SUCCESS('{} exported to {}'.format(options['model'], path)))
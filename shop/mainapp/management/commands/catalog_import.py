@@ -0,0 +1,44 @@
+import sys
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from mainapp.catalog_io import FORMATS, IMPORT_MODELS, CatalogImporter, guess_format, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Creates and updates brands or products from a CSV or JSON Lines file, rows are matched by slug'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(IMPORT_MODELS))
+        parser.add_argument('path', help='file to import, "-" reads from stdin')
+        parser.add_argument('--format', choices=FORMATS, help='guessed from the file extension by default')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--image-dir', help='directory with the image files referenced by the "image" column')
+        parser.add_argument('--workers', type=int, default=4, help='threads copying images and making derivatives')
+        parser.add_argument('--no-derivatives', action='store_true', help='do not generate image derivatives')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or guess_format(path)
+        importer = CatalogImporter(
+            IMPORT_MODELS[options['model']], batch_size=options['batch_size'], image_dir=options['image_dir'],
+            workers=options['workers'], derivatives=not options['no_derivatives']
+        )
+        file = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+        try:
+            importer.run(
+                read_rows(file, file_format), progress=lambda count: self.stdout.write(str(count), ending='\r')
+            )
+        except ValidationError as error:
+            raise CommandError('; '.join(error.messages))
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            # every batch is committed on its own, the indexes and caches follow the rows written before an error
+            if importer.created or importer.updated:
+                self.stdout.write('Rebuilding the catalog and search indexes...')
+                importer.finish()
+        self.stdout.write(self.style.SUCCESS('{}: {} created, {} updated'.format(
+            options['model'], importer.created, importer.updated
+        )))
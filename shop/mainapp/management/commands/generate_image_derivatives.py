@@ -0,0 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from mainapp.images import DERIVATIVE_FORMATS, DERIVATIVE_WIDTHS, generate_derivatives, get_derivative_name
+from mainapp.models import CatalogEntry
+
+
+class Command(BaseCommand):
+    help = 'Generates thumbnails and WebP variants for existing product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='regenerate existing derivatives')
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        names = set()
+        for model in CatalogEntry.objects.get_clothes_models():
+            names.update(name for name in model._base_manager.values_list('image', flat=True) if name)
+        if not options['force']:
+            extension = DERIVATIVE_FORMATS[-1][0]
+            names = {
+                name for name in names
+                if not default_storage.exists(get_derivative_name(name, DERIVATIVE_WIDTHS[-1], extension))
+            }
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for i, _ in enumerate(executor.map(generate_derivatives, sorted(names)), 1):
+                self.stdout.write('{}/{}'.format(i, len(names)), ending='\r')
+        self.stdout.write(self.style.SUCCESS('Derivatives generated for {} images'.format(len(names))))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.models import CatalogEntry
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the cross-category catalog index from the Hoodie, Pants and Shoes tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        created, updated, deleted = CatalogEntry.objects.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            'Catalog index rebuilt: {} created, {} updated, {} deleted'.format(created, updated, deleted)
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.search import get_backend, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product search index'
+
+    def handle(self, *args, **options):
+        count = rebuild_index()
+        self.stdout.write(self.style.SUCCESS(
+            '{} products indexed with {}'.format(count, get_backend().__name__)
+        ))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import models
+
+from mainapp.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'Verifies the running totals of open carts and repairs the ones that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only report carts with wrong totals')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        carts = Cart.objects.filter(in_order=False).annotate(
+            products_count=models.Count('clothes'),
+            products_sum=models.Sum('clothes__final_price')
+        ).only('id', 'total_products', 'final_price')
+        broken = []
+        for cart in carts.iterator(chunk_size=options['batch_size']):
+            final_price = cart.products_sum or 0
+            if cart.total_products != cart.products_count or cart.final_price != final_price:
+                cart.total_products = cart.products_count
+                cart.final_price = final_price
+                broken.append(cart)
+        if not options['dry_run']:
+            Cart.objects.bulk_update(broken, ['total_products', 'final_price'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('{} carts with wrong totals {}'.format(
+            len(broken), 'found' if options['dry_run'] else 'repaired'
+        )))
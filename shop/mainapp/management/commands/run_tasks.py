@@ -0,0 +1,74 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from mainapp.tasks import claim_tasks, requeue_stale_tasks, run_queued_task
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Runs the tasks queued by the "db" task backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'TASKS_WORKERS', 2))
+        parser.add_argument('--pool', choices=('thread', 'process'), default='thread',
+                            help='processes suit CPU bound tasks such as image resizing')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds to wait when the queue is empty')
+        parser.add_argument('--stale-timeout', type=int, default=600,
+                            help='seconds after which a running task is considered lost and queued again')
+        parser.add_argument('--requeue-interval', type=float, default=60,
+                            help='seconds between the checks for lost tasks')
+        parser.add_argument('--once', action='store_true', help='run the due tasks and exit')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        done = failed = 0
+        running = set()
+        next_requeue = 0
+        with self.get_executor(options['pool'], workers) as executor:
+            try:
+                while True:
+                    # tasks of workers that died at any time are picked up, not only those found at the start
+                    if time.monotonic() >= next_requeue:
+                        requeued = requeue_stale_tasks(options['stale_timeout'])
+                        if requeued:
+                            self.stdout.write('{} lost tasks queued again'.format(requeued))
+                        next_requeue = time.monotonic() + options['requeue_interval']
+                    # every task is submitted on its own, a free worker takes the next task
+                    # without waiting for the slow ones of its batch
+                    if len(running) < workers:
+                        running.update(
+                            executor.submit(run_queued_task, pk) for pk in claim_tasks(workers - len(running))
+                        )
+                    if not running:
+                        if options['once']:
+                            break
+                        time.sleep(options['poll_interval'])
+                        continue
+                    finished, running = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        try:
+                            result = future.result()
+                        except Exception:
+                            # the task stays running and is queued again after the stale timeout
+                            logger.exception('Task worker failed')
+                            result = False
+                        done += result
+                        failed += not result
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write(self.style.SUCCESS('{} tasks done, {} attempts failed'.format(done, failed)))
+
+    @staticmethod
+    def get_executor(pool, workers):
+        if pool == 'process':
+            # forked workers must not share the database connections of the parent
+            connections.close_all()
+            return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tasks')
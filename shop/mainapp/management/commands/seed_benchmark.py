@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from mainapp import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Fills the database with a synthetic catalog, users and orders for the "benchmark" command, '
+        'point DJANGO_DB_NAME at a separate database file to keep them out of the shop data'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=3000, help='products per category')
+        parser.add_argument('--brands', type=int, default=20)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--orders', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0, help='random seed, the same seed gives the same data')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        benchmark.seed(
+            products=options['products'], brands=options['brands'], users=options['users'],
+            orders=options['orders'], seed_value=options['seed'], batch_size=options['batch_size'],
+            progress=self.stdout.write
+        )
+        self.stdout.write(self.style.SUCCESS('Benchmark data is ready'))
@@ -0,0 +1,113 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.urls import reverse
+from django.utils import timezone
+
+from mainapp.models import CatalogEntry, User
+
+# SQLite defaults: rollback journal, fsync on every commit, python's 5 second busy timeout, deferred transactions
+BASELINE = {'pragmas': {'journal_mode': 'delete', 'synchronous': 'full', 'busy_timeout': 5000}, 'transaction_mode': None}
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs concurrent catalog, cart and order requests against a copy of the SQLite database, '
+        'once with SQLite defaults and once with the OPTIONS of the database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--iterations', type=int, default=25, help='iterations per thread')
+
+    def handle(self, *args, **options):
+        database = connections['default']
+        if database.vendor != 'sqlite':
+            raise CommandError('The load test only makes sense for the SQLite backend')
+        setup_test_environment()
+        source = database.settings_dict['NAME']
+        tuned = database.settings_dict['OPTIONS']
+        for label, database_options in (('SQLite defaults', BASELINE), ('tuned settings', tuned)):
+            result = self.run_load(source, database_options, options['threads'], options['iterations'])
+            self.stdout.write(
+                '{}: {requests} requests in {elapsed:.2f}s, {rps:.1f} req/s, '
+                '{locked} "database is locked" errors, {failed} other failures'.format(label, **result)
+            )
+
+    def run_load(self, source, database_options, threads, iterations):
+        original_name = connections.databases['default']['NAME']
+        original_options = connections.databases['default']['OPTIONS']
+        with tempfile.TemporaryDirectory() as directory:
+            connections.close_all()
+            path = os.path.join(directory, 'loadtest.sqlite3')
+            shutil.copy(source, path)
+            connections.databases['default']['NAME'] = path
+            connections.databases['default']['OPTIONS'] = database_options
+            try:
+                return self.run_threads(threads, iterations)
+            finally:
+                connections.close_all()
+                connections.databases['default']['NAME'] = original_name
+                connections.databases['default']['OPTIONS'] = original_options
+
+    def run_threads(self, threads, iterations):
+        entries = list(CatalogEntry.objects.select_related('category')[:100])
+        if not entries:
+            raise CommandError('The catalog is empty, there is nothing to load test')
+        users = [User.objects.create_user('loadtest_{}'.format(i)) for i in range(threads)]
+        connections.close_all()
+        stats = {'requests': 0, 'locked': 0, 'failed': 0}
+        lock = threading.Lock()
+
+        def worker(user):
+            client = Client(raise_request_exception=True)
+            client.force_login(user)
+            requests = locked = failed = 0
+            try:
+                for i in range(iterations):
+                    entry = random.choice(entries)
+                    kwargs = {'ct_model': entry.get_model_name(), 'slug': entry.slug}
+                    calls = [
+                        ('get', entry.category.get_absolute_url(), None),
+                        ('get', reverse('add_to_cart', kwargs=kwargs), None),
+                        ('post', reverse('change_qty', kwargs=kwargs), {'qty': random.randint(1, 5)}),
+                    ]
+                    if i % 5 == 4:
+                        calls.append(('post', reverse('make_order'), {
+                            'first_name': 'Load', 'last_name': 'Test', 'phone': '1', 'buying_type': 'self',
+                            'order_date': timezone.now().date().isoformat()
+                        }))
+                    for method, url, data in calls:
+                        requests += 1
+                        try:
+                            getattr(client, method)(url, data)
+                        except OperationalError as error:
+                            if 'locked' in str(error):
+                                locked += 1
+                            else:
+                                failed += 1
+                        except Exception:
+                            failed += 1
+            finally:
+                connections.close_all()
+                with lock:
+                    stats['requests'] += requests
+                    stats['locked'] += locked
+                    stats['failed'] += failed
+
+        workers = [threading.Thread(target=worker, args=(user,)) for user in users]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return dict(stats, elapsed=elapsed, rps=stats['requests'] / elapsed)
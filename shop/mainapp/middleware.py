@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.asgi import ASGIRequest
+
+from . import page_cache
+from .instrumentation import RequestTimings, current_timings, registry
+
+SERVER_TIMING = 'db;dur={:.1f};desc="{} queries, {} duplicated", tpl;dur={:.1f}, total;dur={:.1f}'
+
+
+class AsyncCapableMiddleware:
+    """
+    base for middleware that works in both the sync and the async handler without switching threads
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # the handler checks this marker to await the middleware instead of running it in a thread
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.acall(request)
+        return self.call(request)
+
+
+class InstrumentationMiddleware(AsyncCapableMiddleware):
+    """
+    records wall, SQL and template time and the query count of every request by URL name,
+    optionally reports them to the client in the "Server-Timing" header
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'INSTRUMENTATION_ENABLED', True):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.duplicate_threshold = getattr(settings, 'INSTRUMENTATION_DUPLICATE_THRESHOLD', 3)
+        self.server_timing_header = getattr(settings, 'INSTRUMENTATION_SERVER_TIMING', False)
+        if asyncio.iscoroutinefunction(get_response):
+            # the async handler would run the sync hook in a thread
+            self.process_template_response = self.aprocess_template_response
+
+    def call(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - started)
+
+    async def acall(self, request):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timings.reset(token)
+        return self.finish(request, response, timings, time.perf_counter() - started)
+
+    def process_template_response(self, request, response):
+        return self.time_render(response)
+
+    async def aprocess_template_response(self, request, response):
+        return self.time_render(response)
+
+    @staticmethod
+    def time_render(response):
+        """
+        times the render of the template response, the handler renders it after the template response hooks
+        """
+        timings = current_timings.get()
+        if timings is None:
+            return response
+        render = response.render
+
+        def timed_render():
+            started = time.perf_counter()
+            try:
+                return render()
+            finally:
+                timings.add_template_time(time.perf_counter() - started)
+                # the rendered response is pickled by the page cache, the wrapper must not stay on it
+                del response.render
+
+        response.render = timed_render
+        return response
+
+    def finish(self, request, response, timings, duration):
+        match = request.resolver_match
+        if match:
+            view_name = match.url_name or match.view_name
+        else:
+            view_name = 'page_cache' if getattr(response, 'page_cache_hit', False) else 'unresolved'
+        duplicates = timings.get_duplicates(self.duplicate_threshold)
+        registry.record(view_name, duration, timings, duplicates)
+        if self.server_timing_header:
+            response['Server-Timing'] = SERVER_TIMING.format(
+                timings.db_time * 1000, timings.queries, len(duplicates), timings.template_time * 1000, duration * 1000
+            )
+        return response
+
+
+class ASGIURLConfMiddleware(AsyncCapableMiddleware):
+    """
+    serves requests coming through shop/asgi.py with ASGI_ROOT_URLCONF, where the read-only
+    catalog views are native async views
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'ASGI_ROOT_URLCONF', None):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def set_urlconf(self, request):
+        if isinstance(request, ASGIRequest):
+            request.urlconf = settings.ASGI_ROOT_URLCONF
+
+    def call(self, request):
+        self.set_urlconf(request)
+        return self.get_response(request)
+
+    async def acall(self, request):
+        self.set_urlconf(request)
+        return await self.get_response(request)
+
+
+class PageCacheMiddleware(AsyncCapableMiddleware):
+    """
+    serves tagged pages to anonymous visitors from the cache without running the views,
+    see mainapp.page_cache for the tags and the purge
+    """
+    def __init__(self, get_response):
+        if not page_cache.is_enabled():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def call(self, request):
+        response = page_cache.get_page(request)
+        if response is None:
+            response = self.get_response(request)
+            page_cache.store_page(request, response)
+        return response
+
+    async def acall(self, request):
+        response = await sync_to_async(page_cache.get_page)(request)
+        if response is None:
+            response = await self.get_response(request)
+            await sync_to_async(page_cache.store_page)(request, response)
+        return response
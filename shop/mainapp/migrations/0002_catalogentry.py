@@ -0,0 +1,61 @@
+# Generated by Django 3.2.5 on 2026-10-17 00:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_catalog(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    CatalogEntry = apps.get_model('mainapp', 'CatalogEntry')
+    entries = []
+    for model_name in ('hoodie', 'pants', 'shoes'):
+        model = apps.get_model('mainapp', model_name)
+        content_type, _ = ContentType.objects.get_or_create(app_label='mainapp', model=model_name)
+        for obj in model.objects.order_by('id'):
+            entries.append(CatalogEntry(
+                content_type=content_type, object_id=obj.id, category_id=obj.category_id, brand_id=obj.brand_id,
+                title=obj.title, slug=obj.slug, price=obj.price, image=obj.image.name or ''
+            ))
+    CatalogEntry.objects.bulk_create(entries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('mainapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('title', models.CharField(max_length=255, verbose_name='Наименование')),
+                ('slug', models.SlugField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=7, verbose_name='Цена')),
+                ('image', models.ImageField(blank=True, upload_to='', verbose_name='Изображение')),
+                ('brand', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.brand', verbose_name='Бренд')),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.category', verbose_name='Категория')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(fields=['category', 'price'], name='catalog_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(fields=['category', '-id'], name='catalog_category_newest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(fields=['price'], name='catalog_price_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='catalogentry',
+            constraint=models.UniqueConstraint(fields=('content_type', 'object_id'), name='unique_catalog_entry'),
+        ),
+        migrations.RunPython(fill_catalog, migrations.RunPython.noop),
+    ]
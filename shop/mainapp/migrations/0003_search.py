@@ -0,0 +1,105 @@
+# Generated by Django 3.2.5 on 2026-10-17 00:40
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_fts_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        if 'ENABLE_FTS5' not in {row[0] for row in cursor.fetchall()}:
+            return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS mainapp_search_fts USING fts5('
+        'content_type_id UNINDEXED, object_id UNINDEXED, body, tokenize = "unicode61 remove_diacritics 2")'
+    )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS mainapp_search_fts')
+
+
+# frozen copy of the tokenizer of mainapp.search, the migration must not depend on code that changes later
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(r'[а-я]')
+RUSSIAN_ENDINGS = sorted((
+    'ивши', 'ывши', 'ившись', 'ывшись', 'вши', 'вшись',
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его', 'ого', 'ему',
+    'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею',
+    'ла', 'на', 'ете', 'йте', 'ли', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно', 'ать', 'ять', 'ить', 'ыть',
+    'а', 'ев', 'ов', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'й', 'иям', 'ям', 'ием',
+    'ам', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я', 'ость', 'ост'
+), key=len, reverse=True)
+
+
+def stem(word):
+    word = word.lower().replace('ё', 'е')
+    if not CYRILLIC_RE.search(word):
+        return word
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def get_document(obj):
+    parts = [obj.brand.name]
+    for field in obj._meta.concrete_fields:
+        if isinstance(field, (models.CharField, models.TextField)) and not isinstance(field, models.SlugField):
+            parts.append(getattr(obj, field.attname) or '')
+    return ' '.join(stem(word) for word in WORD_RE.findall(' '.join(parts)))
+
+
+def fill_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    SearchTerm = apps.get_model('mainapp', 'SearchTerm')
+    use_fts = connection.vendor == 'sqlite' and 'mainapp_search_fts' in connection.introspection.table_names()
+    for model_name in ('hoodie', 'pants', 'shoes'):
+        model = apps.get_model('mainapp', model_name)
+        content_type, _ = ContentType.objects.get_or_create(app_label='mainapp', model=model_name)
+        documents = [(content_type.id, obj.id, get_document(obj)) for obj in model.objects.select_related('brand')]
+        if use_fts:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    'INSERT INTO mainapp_search_fts (content_type_id, object_id, body) VALUES (%s, %s, %s)',
+                    documents
+                )
+        else:
+            SearchTerm.objects.bulk_create([
+                SearchTerm(term=term[:100], content_type_id=content_type_id, object_id=object_id)
+                for content_type_id, object_id, document in documents
+                for term in set(document.split())
+            ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('mainapp', '0002_catalogentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_index=True, max_length=100)),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='searchterm',
+            index=models.Index(fields=['content_type', 'object_id'], name='search_term_object_idx'),
+        ),
+        migrations.RunPython(create_fts_table, drop_fts_table),
+        migrations.RunPython(fill_search_index, migrations.RunPython.noop),
+    ]
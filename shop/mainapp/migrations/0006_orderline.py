@@ -0,0 +1,68 @@
+# Generated by Django 3.2.5 on 2026-10-17 00:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_order_lines(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    CartProduct = apps.get_model('mainapp', 'CartProduct')
+    Order = apps.get_model('mainapp', 'Order')
+    OrderLine = apps.get_model('mainapp', 'OrderLine')
+    models_by_content_type = {
+        content_type.id: apps.get_model('mainapp', content_type.model)
+        for content_type in ContentType.objects.filter(app_label='mainapp', model__in=('hoodie', 'pants', 'shoes'))
+    }
+    cart_ids = dict(Order.objects.exclude(cart=None).values_list('cart_id', 'id'))
+    cart_products = list(CartProduct.objects.filter(cart_id__in=cart_ids).order_by('id'))
+    ids_by_content_type = {}
+    for cart_product in cart_products:
+        ids_by_content_type.setdefault(cart_product.content_type_id, set()).add(cart_product.object_id)
+    products = {}
+    for content_type_id, ids in ids_by_content_type.items():
+        model = models_by_content_type.get(content_type_id)
+        if model is not None:
+            for obj in model.objects.filter(id__in=ids):
+                products[content_type_id, obj.id] = obj
+    lines = []
+    for cart_product in cart_products:
+        model = models_by_content_type.get(cart_product.content_type_id)
+        obj = products.get((cart_product.content_type_id, cart_product.object_id))
+        qty = cart_product.qty or 1
+        lines.append(OrderLine(
+            order_id=cart_ids[cart_product.cart_id],
+            model_name=model._meta.model_name if model is not None else '',
+            object_id=cart_product.object_id,
+            slug=obj.slug if obj is not None else '',
+            title=obj.title if obj is not None else 'Товар удален',
+            price=cart_product.final_price / qty,
+            qty=qty,
+            final_price=cart_product.final_price
+        ))
+    OrderLine.objects.bulk_create(lines, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('mainapp', '0005_order_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=32, verbose_name='Тип товара')),
+                ('object_id', models.PositiveIntegerField(verbose_name='Товар')),
+                ('slug', models.SlugField()),
+                ('title', models.CharField(max_length=255, verbose_name='Наименование')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=7, verbose_name='Цена')),
+                ('qty', models.PositiveIntegerField(default=1, verbose_name='Количество')),
+                ('final_price', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Общая цена')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='mainapp.order', verbose_name='Заказ')),
+            ],
+        ),
+        migrations.RunPython(fill_order_lines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.5 on 2026-10-17 01:48
+
+from django.db import migrations, models
+
+
+def fill_order_totals(apps, schema_editor):
+    Cart = apps.get_model('mainapp', 'Cart')
+    Order = apps.get_model('mainapp', 'Order')
+    Order.objects.exclude(cart=None).update(
+        final_price=models.Subquery(Cart.objects.filter(pk=models.OuterRef('cart_id')).values('final_price')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0008_queuedtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='final_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=9, verbose_name='Общая цена'),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,20 @@
+import asyncio
+import hashlib
+from calendar import timegm
+from datetime import datetime, timezone
+
+from asgiref.sync import markcoroutinefunction, sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.shortcuts import redirect
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic import View
 
-from .models import Category, Cart, Client, Hoodie, Shoes, Pants
+from .cart import get_cart_summary, get_request_cart
+from .models import Category, Hoodie, Shoes, Pants
+from .utils import paginate_by_keyset
 
 
 class CategoryDetailMixin(SingleObjectMixin):
@@ -15,36 +26,132 @@ class CategoryDetailMixin(SingleObjectMixin):
         'hoodies': Hoodie,
         'pants': Pants
     }
+    SORT_ORDERING = {
+        'new': ('-id',),
+        'price': ('price', 'id'),
+        '-price': ('-price', '-id')
+    }
+    paginate_by = 12
 
     def get_context_data(self, **kwargs):
-        if isinstance(self.get_object(), Category):
-            model = self.CATEGORY_SLUG_TO_CLOTHES_MODEL[self.get_object().slug]
-            context = super().get_context_data(**kwargs)
-            context['categories'] = Category.objects.get_categories_for_nav()
-            context['category_clothes'] = model.objects.all()
-            return context
         context = super().get_context_data(**kwargs)
         context['categories'] = Category.objects.get_categories_for_nav()
+        if isinstance(self.object, Category):
+            context.update(self.get_category_clothes_context(self.object))
         return context
 
+    def get_category_clothes_context(self, category):
+        model = self.CATEGORY_SLUG_TO_CLOTHES_MODEL[category.slug]
+        params = self.request.GET
+        sort = params.get('sort') if params.get('sort') in self.SORT_ORDERING else 'new'
+        clothes, next_cursor = paginate_by_keyset(
+            model.objects.for_listing().filter_by_facets(params), self.SORT_ORDERING[sort], params.get('after'), self.paginate_by
+        )
+        facets = model.objects.get_cached_facets()
+        selected_facets = [
+            dict(facet, values=[
+                dict(value, selected=str(value['value']) in params.getlist(facet['name'])) for value in facet['values']
+            ])
+            for facet in facets
+        ]
+        next_page_params = None
+        if next_cursor:
+            next_page_params = params.copy()
+            next_page_params['after'] = next_cursor
+            next_page_params = next_page_params.urlencode()
+        return {
+            'category_clothes': clothes,
+            'facets': selected_facets,
+            'sort': sort,
+            'next_page_params': next_page_params
+        }
+
+
+class ConditionalGetMixin:
+    """
+    Mixin for catalog pages, answers GET requests with 304 while the version stamp of the page stays the same
+    """
+    def get_last_modified(self):
+        """
+        modification time of the page content, None disables conditional responses
+        """
+        return None
+
+    def get_etag(self, last_modified):
+        # the page also shows the navigation counts, the user menu and the cart badge
+        user = self.request.user
+        summary = get_cart_summary(self.request)
+        parts = (
+            self.request.get_full_path(), last_modified.isoformat(), Category.objects.get_nav_version(),
+            user.pk, user.is_superuser, summary['total_products'], summary['final_price']
+        )
+        return '"{}"'.format(hashlib.md5(':'.join(map(str, parts)).encode()).hexdigest())
+
+    def is_public(self):
+        """
+        pages without user or cart data may be stored by shared caches
+        """
+        return not self.request.user.is_authenticated and not get_cart_summary(self.request)['total_products']
+
+    def dispatch(self, request, *args, **kwargs):
+        # pending messages are rendered once, such a page must not be answered with 304 or cached
+        if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+            return super().dispatch(request, *args, **kwargs)
+        last_modified = self.get_last_modified()
+        if last_modified is None:
+            return super().dispatch(request, *args, **kwargs)
+        nav_modified = datetime.fromtimestamp(Category.objects.get_nav_version() / 10 ** 9, timezone.utc)
+        last_modified = max(last_modified, nav_modified)
+        etag = self.get_etag(last_modified)
+        response = get_conditional_response(request, etag=etag, last_modified=timegm(last_modified.utctimetuple()))
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            return self.set_cache_headers_async(response, etag, last_modified)
+        return self.set_cache_headers(response, etag, last_modified)
+
+    def set_cache_headers(self, response, etag, last_modified):
+        if response.status_code not in (200, 304):
+            return response
+        response.headers.setdefault('ETag', etag)
+        response.headers.setdefault('Last-Modified', http_date(timegm(last_modified.utctimetuple())))
+        max_age = getattr(settings, 'CATALOG_PAGE_SHARED_MAX_AGE', 60)
+        if self.is_public():
+            # browsers revalidate every time, reverse proxies may keep the page for "s-maxage" seconds
+            patch_cache_control(response, public=True, max_age=0, s_maxage=max_age)
+        else:
+            patch_cache_control(response, private=True, max_age=0)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+    async def set_cache_headers_async(self, response, etag, last_modified):
+        return self.set_cache_headers(await response, etag, last_modified)
+
+
+class AsyncViewMixin:
+    """
+    Mixin for class-based views with "async def" handlers, the handler awaits them instead of running them in a thread
+    """
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # the handler awaits views marked as coroutine functions
+        return markcoroutinefunction(view)
+
+    async def dispatch(self, request, *args, **kwargs):
+        # the dispatch of sync mixins (e.g. the cart lookup) runs in a thread, the handler it returns is awaited here
+        response = await sync_to_async(super().dispatch)(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
 
 class CartMixin(View):
     """
     Mixin for displaying cart
     """
     def dispatch(self, request, *args, **kwargs):
-        if request.user.is_authenticated:
-            client = Client.objects.filter(user=request.user).first()
-            if not client:
-                client = Client.objects.create(user=request.user)
-            cart = Cart.objects.filter(owner=client, in_order=False).first()
-            if not cart:
-                cart = Cart.objects.create(owner=client)
-        else:
-            cart = Cart.objects.filter(anon_user=True).first()
-            if not cart:
-                cart = Cart.objects.create(anon_user=True)
-        self.cart = cart
+        self.cart = get_request_cart(request)
         return super().dispatch(request, *args, **kwargs)
 
 
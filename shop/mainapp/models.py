@@ -1,4 +1,8 @@
-from django.db import models
+import time
+
+from django.conf import settings
+from django.db import models, transaction
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -6,6 +10,9 @@ from django.urls import reverse
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 
+from . import images
+from .instrumentation import allow_repeated_queries
+
 User = get_user_model()
 
 def get_clothes_url(obj, viewname):
@@ -13,33 +20,89 @@ def get_clothes_url(obj, viewname):
     return reverse(viewname, kwargs={'ct_model': ct_model, 'slug': obj.slug})
 
 
+# version counter kept in the cache, starting from the current time keeps an evicted counter from reusing
+# an old version and lets the version double as a modification time
+def get_cache_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def get_product_version_key(model_name, pk):
+    return 'mainapp:product_version:{}:{}'.format(model_name, pk)
+
+
+# version of a product used in fragment cache keys, bumped on every change of the product
+def get_product_version(model_name, pk):
+    return get_cache_version(get_product_version_key(model_name, pk))
+
+
+def bump_product_version(model_name, pk):
+    bump_cache_version(get_product_version_key(model_name, pk))
+
+
 def get_models_for_count(*model_names):
     return [models.Count(model_name) for model_name in model_names]
 
 
 class LatestProductsManager:
     """
-    displays up to four products of each category with the option to display a specific product category first
+    displays the newest products of each category with the option to display a specific product category first,
+    the feed is kept in the cache and rebuilt by signals when products change
     """
+    FEED_CACHE_KEY = 'mainapp:latest_products:{}'
+
     @staticmethod
-    def get_products_for_main_page(*args, **kwargs):
+    def get_count():
+        return getattr(settings, 'LATEST_PRODUCTS_PER_CATEGORY', 4)
+
+    def get_feed(self):
+        """
+        catalog entries of the newest products by model name
+        """
+        feed = cache.get(self.FEED_CACHE_KEY.format(self.get_count()))
+        if feed is None:
+            feed = self.rebuild_feed()
+        return feed
+
+    def build_feed(self):
+        # one query per model reads only "count" rows of the (content_type, object_id) index, a window function
+        # in a single query would number every catalog entry, the feed is rebuilt only when products change
+        count = self.get_count()
+        with allow_repeated_queries():
+            return {
+                model._meta.model_name: list(
+                    CatalogEntry.objects.filter(content_type=ContentType.objects.get_for_model(model))
+                    .order_by('-object_id')[:count]
+                )
+                for model in CatalogEntry.objects.get_clothes_models()
+            }
+
+    def rebuild_feed(self):
+        feed = self.build_feed()
+        cache.set(self.FEED_CACHE_KEY.format(self.get_count()), feed, None)
+        return feed
+
+    def get_products_for_main_page(self, *args, **kwargs):
+        feed = self.get_feed()
+        clothes = [entry for model_name in args for entry in feed.get(model_name, [])]
         respect_to = kwargs.get('respect_to')
-        clothes = []
-        ct_models = ContentType.objects.filter(model__in=args)
-        for ct_model in ct_models:
-            model_clothes = ct_model.model_class()._base_manager.all().order_by('-id')[:4]
-            clothes.extend(model_clothes)
-        if respect_to:
-            ct_model = ContentType.objects.filter(model=respect_to)
-            if ct_model.exists():
-                if respect_to in args:
-                    return sorted(
-                        clothes, key=lambda x: x.__class__._meta.model_name.startswith(respect_to), reverse=True)
+        if respect_to and respect_to in feed and respect_to in args:
+            return sorted(clothes, key=lambda x: x.get_model_name() == respect_to, reverse=True)
         return clothes
 
 
 class LatestProducts:
-    objects = LatestProductsManager
+    objects = LatestProductsManager()
 
 
 class CategoryManager(models.Manager):
@@ -48,11 +111,23 @@ class CategoryManager(models.Manager):
         'Брюки': 'pants__count',
         'Обувь': 'shoes__count'
     }
+    NAV_CACHE_KEY = 'mainapp:categories_for_nav'
+    NAV_VERSION_KEY = 'mainapp:categories_for_nav_version'
 
     def get_queryset(self):
         return super().get_queryset()
 
     def get_categories_for_nav(self):
+        """
+        navigation data is kept in the cache and dropped by signals when categories or products change
+        """
+        data = cache.get(self.NAV_CACHE_KEY)
+        if data is None:
+            data = self.build_categories_for_nav()
+            cache.set(self.NAV_CACHE_KEY, data, None)
+        return data
+
+    def build_categories_for_nav(self):
         models = get_models_for_count('pants', 'shoes', 'hoodie')
         qs = list(self.get_queryset().annotate(*models))
         data = [
@@ -61,6 +136,16 @@ class CategoryManager(models.Manager):
         ]
         return data
 
+    def get_nav_version(self):
+        """
+        changes with every invalidation of the navigation data, part of the version stamp of catalog pages
+        """
+        return get_cache_version(self.NAV_VERSION_KEY)
+
+    def invalidate_categories_for_nav(self):
+        cache.delete(self.NAV_CACHE_KEY)
+        bump_cache_version(self.NAV_VERSION_KEY)
+
 
 class Category(models.Model):
     name = models.CharField(max_length=255, verbose_name='Имя категории')
@@ -82,10 +167,80 @@ class Brand(models.Model):
         return self.name
 
 
+class ClothesQuerySet(models.QuerySet):
+    """
+    facet filtering and counting for product listings, projections for listing and detail pages
+    """
+    # fields of a product card, "__str__" also needs the category name
+    LISTING_FIELDS = (
+        'slug', 'title', 'price', 'image', 'category__name', 'category__slug', 'brand__name', 'brand__slug'
+    )
+
+    def for_listing(self):
+        """
+        products shown as cards or cart rows: card fields only, category and brand joined
+        """
+        return self.select_related('category', 'brand').only(*self.LISTING_FIELDS)
+
+    def for_detail(self):
+        """
+        products shown on their own page: all fields, category and brand joined
+        """
+        return self.select_related('category', 'brand')
+
+    def filter_by_facets(self, params):
+        lookups = {}
+        for field_name in self.model.FACET_FIELDS:
+            values = [value for value in params.getlist(field_name) if value]
+            if values:
+                lookup = 'brand__slug__in' if field_name == 'brand' else '{}__in'.format(field_name)
+                lookups[lookup] = values
+        return self.filter(**lookups)
+
+    def get_facet_counts(self):
+        """
+        counts products for every facet value with one grouped query
+        """
+        columns = ['brand__slug' if f == 'brand' else f for f in self.model.FACET_FIELDS]
+        rows = self.order_by().values('brand__name', *columns).annotate(count=models.Count('id'))
+        counts = {field_name: {} for field_name in self.model.FACET_FIELDS}
+        for row in rows:
+            for field_name, column in zip(self.model.FACET_FIELDS, columns):
+                label = row['brand__name'] if field_name == 'brand' else row[column]
+                value = counts[field_name].setdefault(row[column], dict(value=row[column], label=label, count=0))
+                value['count'] += row['count']
+        return [
+            dict(
+                name=field_name,
+                label=self.model._meta.get_field(field_name).verbose_name,
+                values=sorted(counts[field_name].values(), key=lambda v: str(v['label']))
+            )
+            for field_name in self.model.FACET_FIELDS
+        ]
+
+
+class ClothesManager(models.Manager.from_queryset(ClothesQuerySet)):
+
+    def get_facets_cache_key(self):
+        return 'mainapp:facets:{}'.format(self.model._meta.model_name)
+
+    def get_cached_facets(self):
+        facets = cache.get(self.get_facets_cache_key())
+        if facets is None:
+            facets = self.get_queryset().get_facet_counts()
+            cache.set(self.get_facets_cache_key(), facets, None)
+        return facets
+
+    def invalidate_facets(self):
+        cache.delete(self.get_facets_cache_key())
+
+
 class Clothes(models.Model):
     """
     general product model
     """
+    FACET_FIELDS = ('brand', 'color')
+
     class Meta:
         abstract = True
 
@@ -94,7 +249,8 @@ class Clothes(models.Model):
     image = models.ImageField(verbose_name='Изображение', default=None)
     description = models.TextField(verbose_name='Описание', null=True)
     price = models.DecimalField(max_digits=7, decimal_places=2, verbose_name='Цена')
-
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Дата изменения')
+    objects = ClothesManager()
 
     def __str__(self):
         return self.title
@@ -102,29 +258,54 @@ class Clothes(models.Model):
     def get_model_name(self):
         return self.__class__.__name__.lower()
 
-    # overridden "delete" method, also removes product image
+    # remembers the category the product was loaded with, a save compares it without another query
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'category_id' in field_names:
+            instance._loaded_category_id = instance.category_id
+        return instance
+
+    # overridden "delete" method, the product image and its derivatives are removed by a task
+    # once the deletion is committed
     def delete(self, *args, **kwargs):
-        self.image.delete()
+        if self.image:
+            images.delete_image.delay(self.image.name)
+        self.bump_version()
         return super().delete(*args, **kwargs)
 
-    # method of changing the product image
+    # invalidates cached fragments of the product once the transaction is committed
+    def bump_version(self):
+        model_name, pk = self.get_model_name(), self.pk
+        transaction.on_commit(lambda: bump_product_version(model_name, pk))
+
+    # method of changing the product image, returns True if the saved image will be a new one
     def remove_on_image_update(self):
         try:
             obj = self.__class__.objects.get(id=self.id)
         except ObjectDoesNotExist:
-            return
-        if obj.image and self.image and obj.image != self.image:
-            obj.image.delete()
+            return True
+        if self.image and obj.image != self.image:
+            if obj.image:
+                images.delete_image.delay(obj.image.name)
+            return True
+        return False
 
     def save(self, *args, **kwargs):
-        self.remove_on_image_update()
-        return super().save(*args, **kwargs)
+        image_updated = self.remove_on_image_update()
+        result = super().save(*args, **kwargs)
+        self.bump_version()
+        if image_updated and self.image:
+            images.generate_derivatives.delay(self.image.name)
+        return result
 
 
 class Hoodie(Clothes):
     """
     model "Hoodie" inherited from "Clothes"
     """
+    FACET_FIELDS = ('brand', 'color', 'pattern')
+
     color = models.CharField(max_length=255, verbose_name='Цвет')
     length = models.CharField(max_length=255, verbose_name='Длина')
     length_sleeve = models.CharField(max_length=255, verbose_name='Длина рукава')
@@ -143,6 +324,8 @@ class Pants(Clothes):
     """
     model "Pants" inherited from "Clothes"
     """
+    FACET_FIELDS = ('brand', 'color', 'pattern')
+
     color = models.CharField(max_length=255, verbose_name='Цвет')
     length_inside = models.CharField(max_length=15, verbose_name='Длина по внутреннему шву')
     length_side = models.CharField(max_length=15, verbose_name='Длина по боковому шву')
@@ -163,6 +346,10 @@ class Shoes(Clothes):
     """
     model "Shoes" inherited from "Clothes"
     """
+    FACET_FIELDS = (
+        'brand', 'color', 'size', 'outsole_material', 'insole_material', 'inner_material', 'top_material'
+    )
+
     color = models.CharField(max_length=255, verbose_name='Цвет')
     size = models.CharField(max_length=255, verbose_name='Размер')
     outsole_material = models.CharField(max_length=200, verbose_name='Материал подошвы')
@@ -179,6 +366,117 @@ class Shoes(Clothes):
         return get_clothes_url(self, 'clothes_detail')
 
 
+class CatalogEntryManager(models.Manager):
+    """
+    keeps the catalog index in sync with the product tables
+    """
+    @staticmethod
+    def get_clothes_models():
+        return [Hoodie, Pants, Shoes]
+
+    @staticmethod
+    def get_entry_fields(obj):
+        return dict(
+            category_id=obj.category_id,
+            brand_id=obj.brand_id,
+            title=obj.title,
+            slug=obj.slug,
+            price=obj.price,
+            image=obj.image.name or ''
+        )
+
+    def sync(self, obj):
+        content_type = ContentType.objects.get_for_model(obj.__class__)
+        self.update_or_create(content_type=content_type, object_id=obj.id, defaults=self.get_entry_fields(obj))
+
+    def remove(self, obj):
+        content_type = ContentType.objects.get_for_model(obj.__class__)
+        self.filter(content_type=content_type, object_id=obj.id).delete()
+
+    def rebuild(self, batch_size=500):
+        """
+        recreates the index in bulk, existing entries keep their ids so the "newest" order survives
+        """
+        fields = ['category', 'brand', 'title', 'slug', 'price', 'image']
+        columns = ['category_id', 'brand_id', 'title', 'slug', 'price', 'image']
+        created = updated = deleted = 0
+        for model in self.get_clothes_models():
+            content_type = ContentType.objects.get_for_model(model)
+            # unchanged entries are skipped, "bulk_update" is expensive for large batches
+            existing = {
+                row[0]: row[1:] for row in self.filter(content_type=content_type).values_list('object_id', 'id', *columns)
+            }
+            to_create, to_update = [], []
+            for obj in model._base_manager.order_by('id').iterator(chunk_size=batch_size):
+                entry_fields = self.get_entry_fields(obj)
+                entry = self.model(content_type=content_type, object_id=obj.id, **entry_fields)
+                if obj.id in existing:
+                    entry_id, *values = existing.pop(obj.id)
+                    if values != [entry_fields[column] for column in columns]:
+                        entry.id = entry_id
+                        to_update.append(entry)
+                else:
+                    to_create.append(entry)
+            self.bulk_create(to_create, batch_size=batch_size)
+            self.bulk_update(to_update, fields, batch_size=batch_size)
+            deleted += self.filter(id__in=[values[0] for values in existing.values()]).delete()[0]
+            created += len(to_create)
+            updated += len(to_update)
+        return created, updated, deleted
+
+
+class CatalogEntry(models.Model):
+    """
+    denormalized index of products from all categories
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    category = models.ForeignKey(Category, verbose_name='Категория', on_delete=models.CASCADE)
+    brand = models.ForeignKey(Brand, verbose_name='Бренд', on_delete=models.CASCADE)
+    title = models.CharField(max_length=255, verbose_name='Наименование')
+    slug = models.SlugField()
+    price = models.DecimalField(max_digits=7, decimal_places=2, verbose_name='Цена')
+    image = models.ImageField(verbose_name='Изображение', blank=True)
+    objects = CatalogEntryManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_type', 'object_id'], name='unique_catalog_entry')
+        ]
+        indexes = [
+            models.Index(fields=['category', 'price'], name='catalog_category_price_idx'),
+            models.Index(fields=['category', '-id'], name='catalog_category_newest_idx'),
+            models.Index(fields=['price'], name='catalog_price_idx'),
+        ]
+
+    def __str__(self):
+        return self.title
+
+    def get_model_name(self):
+        return ContentType.objects.get_for_id(self.content_type_id).model
+
+    def get_absolute_url(self):
+        return reverse('clothes_detail', kwargs={'ct_model': self.get_model_name(), 'slug': self.slug})
+
+
+class SearchTerm(models.Model):
+    """
+    inverted search index for databases without full-text search
+    """
+    term = models.CharField(max_length=100, db_index=True)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_type', 'object_id'], name='search_term_object_idx'),
+        ]
+
+    def __str__(self):
+        return self.term
+
+
 class CartProduct(models.Model):
     """
     product model for cart
@@ -191,13 +489,14 @@ class CartProduct(models.Model):
     qty = models.PositiveIntegerField(default=1)
     final_price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Общая цена')
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'content_type', 'object_id'], name='unique_cart_product')
+        ]
+
     def __str__(self):
         return "Товар: {} (для корзины)".format(self.content_object.title)
 
-    def save(self, *args, **kwargs):
-        self.final_price = self.qty * self.content_object.price
-        super().save(*args, **kwargs)
-
 
 class Cart(models.Model):
     """
@@ -210,9 +509,39 @@ class Cart(models.Model):
     in_order = models.BooleanField(default=False)
     anon_user = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'in_order'], name='cart_owner_in_order_idx'),
+        ]
+
     def __str__(self):
         return str(self.id)
 
+    def get_products(self):
+        """
+        cart products with their clothes loaded in one query per product model
+        """
+        return list(self.clothes.prefetch_related('content_object'))
+
+    # the same interface as the session cart of an anonymous user, lines missing from the cart are ignored
+    def add(self, clothes, session=None):
+        from .utils import add_cart_product
+        add_cart_product(self, clothes, session)
+
+    def remove(self, clothes, session=None):
+        from .utils import remove_cart_product
+        try:
+            remove_cart_product(self, clothes, session)
+        except CartProduct.DoesNotExist:
+            pass
+
+    def set_qty(self, clothes, qty, session=None):
+        from .utils import change_cart_product_qty
+        try:
+            change_cart_product_qty(self, clothes, qty, session)
+        except CartProduct.DoesNotExist:
+            pass
+
 
 class Client(models.Model):
     """
@@ -262,6 +591,84 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now=True, verbose_name='Дата создания заказа')
     order_date = models.DateField(verbose_name='Дата поучения заказа', default=timezone.now)
     cart = models.ForeignKey(Cart, verbose_name='Корзина', on_delete=models.CASCADE, null=True, blank=True)
+    # the total at the checkout, the order shows it without reading the cart
+    final_price = models.DecimalField(max_digits=9, decimal_places=2, default=0, verbose_name='Общая цена')
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['client', '-created_at'], name='order_client_created_idx'),
+        ]
 
     def __str__(self):
         return str(self.id)
+
+
+class OrderLineManager(models.Manager):
+
+    def create_for_order(self, order, cart_products):
+        """
+        copies the cart products into the order, products deleted before the checkout are skipped
+        """
+        return self.bulk_create([
+            self.model(
+                order=order, model_name=cart_product.content_object.get_model_name(),
+                object_id=cart_product.object_id, slug=cart_product.content_object.slug,
+                title=cart_product.content_object.title, price=cart_product.content_object.price,
+                qty=cart_product.qty, final_price=cart_product.final_price
+            )
+            for cart_product in cart_products if cart_product.content_object is not None
+        ])
+
+
+class OrderLine(models.Model):
+    """
+    product of an order as it was at the checkout, does not change when the product is repriced or deleted
+    """
+    order = models.ForeignKey(Order, verbose_name='Заказ', on_delete=models.CASCADE, related_name='lines')
+    model_name = models.CharField(max_length=32, verbose_name='Тип товара')
+    object_id = models.PositiveIntegerField(verbose_name='Товар')
+    slug = models.SlugField()
+    title = models.CharField(max_length=255, verbose_name='Наименование')
+    price = models.DecimalField(max_digits=7, decimal_places=2, verbose_name='Цена')
+    qty = models.PositiveIntegerField(default=1, verbose_name='Количество')
+    final_price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Общая цена')
+
+    objects = OrderLineManager()
+
+    def __str__(self):
+        return '{} x {}'.format(self.title, self.qty)
+
+
+class QueuedTask(models.Model):
+    """
+    task of the "db" task backend waiting for the "run_tasks" worker, done tasks are deleted
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_FAILED, 'Ошибка')
+    )
+
+    name = models.CharField(max_length=255, verbose_name='Задача')
+    args = models.JSONField(default=list, blank=True, verbose_name='Аргументы')
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name='Именованные аргументы')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, verbose_name='Статус')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Попытки')
+    max_attempts = models.PositiveIntegerField(default=3, verbose_name='Максимум попыток')
+    run_at = models.DateTimeField(default=timezone.now, verbose_name='Запустить после')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата запуска')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='queuedtask_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return '{} #{}'.format(self.name, self.id)
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.mail import send_mail
+from django.template.loader import render_to_string
+
+from .models import Order
+from .tasks import task
+
+
+@task(max_attempts=5, retry_delay=5)
+def send_order_notification(order_id):
+    """
+    sends the customer the summary of the placed order, orders of users without an email are skipped
+    """
+    order = Order.objects.select_related('client__user').filter(id=order_id).first()
+    if order is None or not order.client.user.email:
+        return
+    context = {'order': order, 'lines': order.lines.order_by('id')}
+    send_mail(
+        'Заказ №{} оформлен'.format(order.id),
+        render_to_string('emails/order_placed.txt', context),
+        settings.DEFAULT_FROM_EMAIL,
+        [order.client.user.email]
+    )
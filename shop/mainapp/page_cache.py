@@ -0,0 +1,112 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from .models import get_cache_version, bump_cache_version
+
+PAGE_CACHE_KEY = 'mainapp:page:{}'
+TAG_VERSION_KEY = 'mainapp:page_tag:{}'
+# moved by every purge, a page rendered while it moved may show data older than its tag versions
+PURGE_COUNT_KEY = 'mainapp:page_purges'
+# every page shows the navigation counts, so this tag is purged whenever they change
+NAV_TAG = 'nav'
+
+
+def get_product_tag(model_name, pk):
+    return 'product:{}:{}'.format(model_name, pk)
+
+
+def get_listing_tag(model_name):
+    return 'listing:{}'.format(model_name)
+
+
+def get_brand_tag(pk):
+    return 'brand:{}'.format(pk)
+
+
+def get_entry_tags(entries):
+    return [get_product_tag(entry.get_model_name(), entry.object_id) for entry in entries]
+
+
+def set_page_tags(response, *tags):
+    """
+    marks the response as cacheable for anonymous visitors, the page is purged with any of the tags
+    """
+    response.page_cache_tags = {NAV_TAG, *tags}
+    return response
+
+
+def purge_tags(*tags):
+    # the counter goes first, so a page that saw one of the new tag versions also sees the new count
+    bump_cache_version(PURGE_COUNT_KEY)
+    for tag in tags:
+        bump_cache_version(TAG_VERSION_KEY.format(tag))
+
+
+def is_enabled():
+    return getattr(settings, 'PAGE_CACHE_ENABLED', True)
+
+
+def is_anonymous_request(request):
+    """
+    requests without a session or messages cookie can not see a cart, a user or a message
+    """
+    return (
+        request.method in ('GET', 'HEAD')
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+        and CookieStorage.cookie_name not in request.COOKIES
+    )
+
+
+def get_page_key(request):
+    return PAGE_CACHE_KEY.format(hashlib.md5(request.build_absolute_uri().encode()).hexdigest())
+
+
+def get_page(request):
+    """
+    cached response for the request, None if it is missing or one of its tags was purged
+    """
+    if not is_anonymous_request(request):
+        return None
+    page_key = get_page_key(request)
+    entries = cache.get_many([page_key, PURGE_COUNT_KEY])
+    # taken before the view runs, see "store_page"
+    request.page_cache_purge_count = entries.get(PURGE_COUNT_KEY)
+    if request.page_cache_purge_count is None:
+        request.page_cache_purge_count = get_cache_version(PURGE_COUNT_KEY)
+    entry = entries.get(page_key)
+    if entry is None:
+        return None
+    response, tag_versions = entry
+    if cache.get_many(list(tag_versions)) != tag_versions:
+        return None
+    response = get_conditional_response(
+        request, etag=response.get('ETag'), last_modified=parse_http_date_safe(response.get('Last-Modified', '')),
+        response=response
+    )
+    response.page_cache_hit = True
+    return response
+
+
+def store_page(request, response):
+    """
+    keeps the response of an anonymous request if the view tagged it and it carries no per-visitor data,
+    a page rendered during a purge is not kept, it may show the data from before the purge
+    """
+    tags = getattr(response, 'page_cache_tags', None)
+    if (
+        not tags or request.method != 'GET' or response.status_code != 200 or response.streaming
+        or response.cookies or 'private' in response.get('Cache-Control', '') or not is_anonymous_request(request)
+    ):
+        return
+    tag_versions = {
+        TAG_VERSION_KEY.format(tag): get_cache_version(TAG_VERSION_KEY.format(tag)) for tag in tags
+    }
+    if get_cache_version(PURGE_COUNT_KEY) != getattr(request, 'page_cache_purge_count', None):
+        return
+    # the timeout is only a safety net, pages are purged by their tags
+    cache.set(get_page_key(request), (response, tag_versions), getattr(settings, 'PAGE_CACHE_TIMEOUT', 3600))
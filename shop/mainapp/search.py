@@ -0,0 +1,239 @@
+import re
+from functools import lru_cache
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models
+
+from .models import CatalogEntry, SearchTerm
+
+FTS_TABLE = 'mainapp_search_fts'
+SEARCH_RESULTS_LIMIT = 48
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(r'[а-я]')
+
+# endings of russian words, longest first, stripped by the light stemmer
+RUSSIAN_ENDINGS = sorted((
+    'ивши', 'ывши', 'ившись', 'ывшись', 'вши', 'вшись',
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его', 'ого', 'ему',
+    'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею',
+    'ла', 'на', 'ете', 'йте', 'ли', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно', 'ать', 'ять', 'ить', 'ыть',
+    'а', 'ев', 'ов', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'й', 'иям', 'ям', 'ием',
+    'ам', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия', 'ья', 'я', 'ость', 'ост'
+), key=len, reverse=True)
+MIN_STEM_LENGTH = 3
+
+
+def stem(word):
+    """
+    light russian stemmer, strips one inflectional ending
+    """
+    word = word.lower().replace('ё', 'е')
+    if not CYRILLIC_RE.search(word):
+        return word
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    return [stem(word) for word in WORD_RE.findall(text or '')]
+
+
+def get_document(obj):
+    """
+    text of a product: title, description, brand and all specification fields
+    """
+    parts = [obj.brand.name]
+    for field in obj._meta.concrete_fields:
+        if isinstance(field, (models.CharField, models.TextField)) and not isinstance(field, models.SlugField):
+            parts.append(getattr(obj, field.attname) or '')
+    return ' '.join(tokenize(' '.join(parts)))
+
+
+@lru_cache(maxsize=None)
+def fts_available():
+    return connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+
+
+class FTSSearchBackend:
+    """
+    search over the SQLite FTS5 virtual table
+    """
+    @staticmethod
+    def index(content_type_id, object_id, document):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM {} WHERE content_type_id = %s AND object_id = %s'.format(FTS_TABLE),
+                [content_type_id, object_id]
+            )
+            cursor.execute(
+                'INSERT INTO {} (content_type_id, object_id, body) VALUES (%s, %s, %s)'.format(FTS_TABLE),
+                [content_type_id, object_id, document]
+            )
+
+    @staticmethod
+    def index_many(documents):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO {} (content_type_id, object_id, body) VALUES (%s, %s, %s)'.format(FTS_TABLE),
+                documents
+            )
+
+    @staticmethod
+    def remove(content_type_id, object_id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM {} WHERE content_type_id = %s AND object_id = %s'.format(FTS_TABLE),
+                [content_type_id, object_id]
+            )
+
+    @staticmethod
+    def remove_many(content_type_id, object_ids):
+        """
+        "object_ids" is a values queryset, it becomes a subquery of the single DELETE
+        """
+        sql, params = object_ids.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM {} WHERE content_type_id = %s AND object_id IN ({})'.format(FTS_TABLE, sql),
+                [content_type_id, *params]
+            )
+
+    @staticmethod
+    def clear():
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM {}'.format(FTS_TABLE))
+
+    @staticmethod
+    def search(terms, limit):
+        # every term is a prefix query, terms are joined with AND
+        query = ' AND '.join('"{}"*'.format(term) for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT content_type_id, object_id FROM {} WHERE {} MATCH %s ORDER BY rank LIMIT %s'.format(
+                    FTS_TABLE, FTS_TABLE
+                ),
+                [query, limit]
+            )
+            return [(int(content_type_id), int(object_id)) for content_type_id, object_id in cursor.fetchall()]
+
+
+class TermSearchBackend:
+    """
+    inverted index kept in the "SearchTerm" table, used on databases without FTS5
+    """
+    @staticmethod
+    def index(content_type_id, object_id, document):
+        SearchTerm.objects.filter(content_type_id=content_type_id, object_id=object_id).delete()
+        SearchTerm.objects.bulk_create([
+            SearchTerm(term=term[:100], content_type_id=content_type_id, object_id=object_id)
+            for term in set(document.split())
+        ])
+
+    @staticmethod
+    def index_many(documents):
+        SearchTerm.objects.bulk_create([
+            SearchTerm(term=term[:100], content_type_id=content_type_id, object_id=object_id)
+            for content_type_id, object_id, document in documents
+            for term in set(document.split())
+        ])
+
+    @staticmethod
+    def remove(content_type_id, object_id):
+        SearchTerm.objects.filter(content_type_id=content_type_id, object_id=object_id).delete()
+
+    @staticmethod
+    def remove_many(content_type_id, object_ids):
+        SearchTerm.objects.filter(content_type_id=content_type_id, object_id__in=object_ids).delete()
+
+    @staticmethod
+    def clear():
+        SearchTerm.objects.all().delete()
+
+    @staticmethod
+    def search(terms, limit):
+        scores = None
+        for term in terms:
+            matches = {}
+            for key in SearchTerm.objects.filter(term__startswith=term).values_list('content_type_id', 'object_id'):
+                matches[key] = matches.get(key, 0) + 1
+            if scores is None:
+                scores = matches
+            else:
+                scores = {key: scores[key] + count for key, count in matches.items() if key in scores}
+        return sorted(scores, key=lambda key: scores[key], reverse=True)[:limit]
+
+
+def get_backend():
+    return FTSSearchBackend if fts_available() else TermSearchBackend
+
+
+def index_object(obj):
+    content_type = ContentType.objects.get_for_model(obj.__class__)
+    get_backend().index(content_type.id, obj.id, get_document(obj))
+
+
+def remove_object(obj):
+    content_type = ContentType.objects.get_for_model(obj.__class__)
+    get_backend().remove(content_type.id, obj.id)
+
+
+def index_queryset(backend, content_type, queryset, batch_size):
+    documents = []
+    count = 0
+    for obj in queryset.select_related('brand').iterator(chunk_size=batch_size):
+        documents.append((content_type.id, obj.id, get_document(obj)))
+        if len(documents) >= batch_size:
+            backend.index_many(documents)
+            count += len(documents)
+            documents = []
+    backend.index_many(documents)
+    return count + len(documents)
+
+
+def index_brand(brand, batch_size=1000):
+    """
+    reindexes the products of a brand, its name is part of their documents, with one delete and
+    batched inserts per product model instead of a delete and an insert per product
+    """
+    backend = get_backend()
+    for model in CatalogEntry.objects.get_clothes_models():
+        content_type = ContentType.objects.get_for_model(model)
+        products = model._base_manager.filter(brand=brand)
+        backend.remove_many(content_type.id, products.values('id'))
+        index_queryset(backend, content_type, products, batch_size)
+
+
+def rebuild_index(batch_size=1000):
+    """
+    the index is emptied first, so documents are inserted in batches without looking up old rows
+    """
+    backend = get_backend()
+    backend.clear()
+    count = 0
+    for model in CatalogEntry.objects.get_clothes_models():
+        content_type = ContentType.objects.get_for_model(model)
+        count += index_queryset(backend, content_type, model._base_manager.all(), batch_size)
+    return count
+
+
+def search_products(query, limit=SEARCH_RESULTS_LIMIT):
+    """
+    returns catalog entries matching every word of the query, best matches first
+    """
+    terms = tokenize(query)
+    if not terms:
+        return []
+    keys = get_backend().search(terms, limit)
+    if not keys:
+        return []
+    condition = models.Q()
+    for content_type_id in {content_type_id for content_type_id, _ in keys}:
+        condition |= models.Q(
+            content_type_id=content_type_id,
+            object_id__in=[object_id for ct_id, object_id in keys if ct_id == content_type_id]
+        )
+    entries = {(e.content_type_id, e.object_id): e for e in CatalogEntry.objects.filter(condition)}
+    return [entries[key] for key in keys if key in entries]
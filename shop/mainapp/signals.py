@@ -0,0 +1,153 @@
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from . import instrumentation, page_cache, search
+from .cart import SessionCart, get_client_cart
+from .models import Brand, Category, CatalogEntry, Hoodie, LatestProducts, Pants, Shoes
+
+
+# drops the cached navigation counts once the change is committed, this also moves the version stamp of
+# catalog pages, brand names are shown there too
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Hoodie)
+@receiver(post_delete, sender=Hoodie)
+@receiver(post_save, sender=Pants)
+@receiver(post_delete, sender=Pants)
+@receiver(post_save, sender=Shoes)
+@receiver(post_delete, sender=Shoes)
+def refresh_categories_for_nav(sender, **kwargs):
+    transaction.on_commit(Category.objects.invalidate_categories_for_nav)
+
+
+# keeps the catalog index in sync with every "Clothes" subclass
+@receiver(post_save, sender=Hoodie)
+@receiver(post_save, sender=Pants)
+@receiver(post_save, sender=Shoes)
+def sync_catalog_entry(sender, instance, raw=False, **kwargs):
+    if not raw:
+        CatalogEntry.objects.sync(instance)
+
+
+@receiver(post_delete, sender=Hoodie)
+@receiver(post_delete, sender=Pants)
+@receiver(post_delete, sender=Shoes)
+def remove_catalog_entry(sender, instance, **kwargs):
+    CatalogEntry.objects.remove(instance)
+
+
+# rebuilds the cached home page feed once the change of the product is committed, cache invalidation stays
+# in the web process, a task worker may have a cache of its own
+@receiver(post_save, sender=Hoodie)
+@receiver(post_delete, sender=Hoodie)
+@receiver(post_save, sender=Pants)
+@receiver(post_delete, sender=Pants)
+@receiver(post_save, sender=Shoes)
+@receiver(post_delete, sender=Shoes)
+def refresh_latest_products(sender, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(LatestProducts.objects.rebuild_feed)
+
+
+# notes a move to another category, the navigation counts of every cached page change then, products
+# loaded from the database know their old category, others are looked up
+@receiver(pre_save, sender=Hoodie)
+@receiver(pre_save, sender=Pants)
+@receiver(pre_save, sender=Shoes)
+def check_category_change(sender, instance, raw=False, **kwargs):
+    if not instance.pk or raw:
+        return
+    if hasattr(instance, '_loaded_category_id'):
+        instance._category_changed = instance._loaded_category_id != instance.category_id
+    else:
+        instance._category_changed = sender._base_manager.filter(pk=instance.pk).exclude(
+            category_id=instance.category_id
+        ).exists()
+    instance._loaded_category_id = instance.category_id
+
+
+# purges the cached pages that show the changed object once the change is committed
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Hoodie)
+@receiver(post_delete, sender=Hoodie)
+@receiver(post_save, sender=Pants)
+@receiver(post_delete, sender=Pants)
+@receiver(post_save, sender=Shoes)
+@receiver(post_delete, sender=Shoes)
+def purge_cached_pages(sender, instance, created=True, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is Category:
+        tags = [page_cache.NAV_TAG]
+    elif sender is Brand:
+        tags = [page_cache.get_brand_tag(instance.pk)] + [
+            page_cache.get_listing_tag(model._meta.model_name) for model in CatalogEntry.objects.get_clothes_models()
+        ]
+    else:
+        model_name = instance.get_model_name()
+        tags = [page_cache.get_product_tag(model_name, instance.pk), page_cache.get_listing_tag(model_name)]
+        if created or getattr(instance, '_category_changed', False):
+            tags.append(page_cache.NAV_TAG)
+    transaction.on_commit(lambda: page_cache.purge_tags(*tags))
+
+
+# moves the anonymous session cart into the client cart
+@receiver(user_logged_in)
+def merge_session_cart(sender, request, user, **kwargs):
+    session_cart = SessionCart(request.session)
+    if session_cart.total_products:
+        session_cart.merge_into(get_client_cart(user))
+
+
+# drops the cached facet counts of the product category, brand names are facet values of every category
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Hoodie)
+@receiver(post_delete, sender=Hoodie)
+@receiver(post_save, sender=Pants)
+@receiver(post_delete, sender=Pants)
+@receiver(post_save, sender=Shoes)
+@receiver(post_delete, sender=Shoes)
+def refresh_facets(sender, **kwargs):
+    if sender is Brand:
+        for model in CatalogEntry.objects.get_clothes_models():
+            transaction.on_commit(model.objects.invalidate_facets)
+    else:
+        transaction.on_commit(sender.objects.invalidate_facets)
+
+
+# keeps the search index in sync with the products
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Hoodie)
+@receiver(post_save, sender=Pants)
+@receiver(post_save, sender=Shoes)
+def index_search_document(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is Brand:
+        search.index_brand(instance)
+    else:
+        search.index_object(instance)
+
+
+@receiver(post_delete, sender=Hoodie)
+@receiver(post_delete, sender=Pants)
+@receiver(post_delete, sender=Shoes)
+def remove_search_document(sender, instance, **kwargs):
+    search.remove_object(instance)
+
+
+# lets the instrumentation middleware count the queries of every connection
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if getattr(settings, 'INSTRUMENTATION_ENABLED', True):
+        instrumentation.instrument_connection(connection)
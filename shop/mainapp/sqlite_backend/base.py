@@ -0,0 +1,65 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+# values accepted for every supported pragma, the pragmas are written into SQL, so nothing else gets through
+PRAGMA_CHOICES = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal', 'off'),
+    'synchronous': ('off', 'normal', 'full', 'extra'),
+    'temp_store': ('default', 'file', 'memory'),
+    'busy_timeout': int,
+    'mmap_size': int,
+    'cache_size': int,
+}
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+def get_pragma_statements(pragmas):
+    statements = []
+    for name, value in pragmas.items():
+        choices = PRAGMA_CHOICES.get(name)
+        if choices is None:
+            raise ImproperlyConfigured('Unsupported SQLite pragma "{}"'.format(name))
+        if choices is int:
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ImproperlyConfigured('SQLite pragma "{}" must be an integer, got {!r}'.format(name, value))
+        elif str(value).lower() not in choices:
+            raise ImproperlyConfigured('SQLite pragma "{}" must be one of {}, got {!r}'.format(
+                name, ', '.join(choices), value
+            ))
+        else:
+            value = str(value).lower()
+        statements.append('PRAGMA {} = {}'.format(name, value))
+    return statements
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite backend with two more OPTIONS: "pragmas" run on every new connection and "transaction_mode"
+    used to begin atomic blocks, the same option as in Django 5.1
+    """
+    def get_connection_params(self):
+        options = self.settings_dict['OPTIONS']
+        self.pragma_statements = get_pragma_statements(options.get('pragmas', {}))
+        self.transaction_mode = options.get('transaction_mode')
+        if self.transaction_mode is not None and self.transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured('SQLite transaction_mode must be one of {}, got {!r}'.format(
+                ', '.join(TRANSACTION_MODES), self.transaction_mode
+            ))
+        params = super().get_connection_params()
+        params.pop('pragmas', None)
+        params.pop('transaction_mode', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for statement in self.pragma_statements:
+            conn.execute(statement)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        # IMMEDIATE takes the write lock when the block starts, so concurrent writers wait for the busy
+        # timeout instead of failing with "database is locked" when a read lock is upgraded
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute('BEGIN {}'.format(self.transaction_mode.upper()))
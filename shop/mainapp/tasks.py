@@ -0,0 +1,194 @@
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('thread', 'db', 'sync')
+
+
+class Task:
+    """
+    function run by the task queue, "delay" queues a call of it instead of running it in the request
+    """
+    def __init__(self, func, max_attempts, retry_delay):
+        self.func = func
+        self.name = '{}.{}'.format(func.__module__, func.__name__)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def __repr__(self):
+        return '<Task {}>'.format(self.name)
+
+    def get_retry_delay(self, attempt):
+        # exponential backoff, the first retry waits "retry_delay" seconds
+        return self.retry_delay * 2 ** (attempt - 1)
+
+    def delay(self, *args, **kwargs):
+        """
+        queues the call, it runs only if the current transaction is committed,
+        the arguments have to be JSON serializable
+        """
+        get_backend().enqueue(self, args, kwargs)
+
+
+def task(max_attempts=3, retry_delay=1):
+    def decorator(func):
+        return Task(func, max_attempts, retry_delay)
+    return decorator
+
+
+def get_task(name):
+    obj = import_string(name)
+    if not isinstance(obj, Task):
+        raise ValueError('{} is not a task'.format(name))
+    return obj
+
+
+def run_with_retries(task, args, kwargs):
+    """
+    runs the task in the current thread, retrying it with a growing delay until it succeeds
+    or runs out of attempts
+    """
+    for attempt in range(1, task.max_attempts + 1):
+        try:
+            return task(*args, **kwargs)
+        except Exception:
+            if attempt == task.max_attempts:
+                logger.exception('Task %s failed after %s attempts', task.name, attempt)
+                return None
+            logger.warning('Task %s failed, attempt %s of %s', task.name, attempt, task.max_attempts, exc_info=True)
+            time.sleep(task.get_retry_delay(attempt))
+
+
+def run_in_thread(task, args, kwargs):
+    close_old_connections()
+    try:
+        return run_with_retries(task, args, kwargs)
+    finally:
+        close_old_connections()
+
+
+class SyncBackend:
+    """
+    runs the tasks in the request thread right after the commit, for tests and debugging
+    """
+    def enqueue(self, task, args, kwargs):
+        transaction.on_commit(lambda: run_with_retries(task, args, kwargs))
+
+
+class ThreadBackend:
+    """
+    runs the tasks in a thread pool of the web process, tasks still queued when the process exits are lost
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=getattr(settings, 'TASKS_WORKERS', 2), thread_name_prefix='tasks')
+
+    def enqueue(self, task, args, kwargs):
+        transaction.on_commit(lambda: self.executor.submit(run_in_thread, task, args, kwargs))
+
+
+class DatabaseBackend:
+    """
+    stores the tasks in the "QueuedTask" table, the row is written in the transaction of the change,
+    so the task exists only if the change was committed, the "run_tasks" command executes them
+    """
+    def enqueue(self, task, args, kwargs):
+        QueuedTask = apps.get_model('mainapp', 'QueuedTask')
+        QueuedTask.objects.create(name=task.name, args=list(args), kwargs=kwargs, max_attempts=task.max_attempts)
+
+
+backends = {}
+
+
+def get_backend():
+    name = getattr(settings, 'TASKS_BACKEND', 'thread')
+    if name not in backends:
+        if name == 'thread':
+            backends[name] = ThreadBackend()
+        elif name == 'db':
+            backends[name] = DatabaseBackend()
+        elif name == 'sync':
+            backends[name] = SyncBackend()
+        else:
+            raise ValueError('Unknown task backend "{}", choose one of {}'.format(name, ', '.join(BACKENDS)))
+    return backends[name]
+
+
+def claim_tasks(limit):
+    """
+    marks up to "limit" due tasks as running, returns their ids, the conditional update keeps
+    two workers from claiming the same task
+    """
+    QueuedTask = apps.get_model('mainapp', 'QueuedTask')
+    now = timezone.now()
+    ids = list(QueuedTask.objects.filter(
+        status=QueuedTask.STATUS_PENDING, run_at__lte=now
+    ).order_by('run_at', 'id').values_list('id', flat=True)[:limit])
+    return [
+        pk for pk in ids
+        if QueuedTask.objects.filter(id=pk, status=QueuedTask.STATUS_PENDING).update(
+            status=QueuedTask.STATUS_RUNNING, attempts=models.F('attempts') + 1, started_at=now
+        )
+    ]
+
+
+def requeue_stale_tasks(timeout):
+    """
+    returns to the queue the tasks of workers that died while running them
+    """
+    QueuedTask = apps.get_model('mainapp', 'QueuedTask')
+    return QueuedTask.objects.filter(
+        status=QueuedTask.STATUS_RUNNING, started_at__lt=timezone.now() - timedelta(seconds=timeout)
+    ).update(status=QueuedTask.STATUS_PENDING)
+
+
+def execute_queued_task(pk):
+    """
+    runs one attempt of a claimed task, done tasks are deleted, failed ones are scheduled for
+    a retry or kept with the error once they run out of attempts
+    """
+    QueuedTask = apps.get_model('mainapp', 'QueuedTask')
+    queued_task = QueuedTask.objects.get(id=pk)
+    task = None
+    try:
+        task = get_task(queued_task.name)
+        task(*queued_task.args, **queued_task.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        if queued_task.attempts < queued_task.max_attempts:
+            logger.warning('Task %s failed, attempt %s of %s', queued_task.name, queued_task.attempts,
+                           queued_task.max_attempts, exc_info=True)
+            delay = task.get_retry_delay(queued_task.attempts) if task is not None else 0
+            QueuedTask.objects.filter(id=pk).update(
+                status=QueuedTask.STATUS_PENDING, run_at=timezone.now() + timedelta(seconds=delay), last_error=error
+            )
+        else:
+            logger.error('Task %s failed after %s attempts', queued_task.name, queued_task.attempts, exc_info=True)
+            QueuedTask.objects.filter(id=pk).update(status=QueuedTask.STATUS_FAILED, last_error=error)
+        return False
+    QueuedTask.objects.filter(id=pk).delete()
+    return True
+
+
+def run_queued_task(pk):
+    """
+    "execute_queued_task" for the worker pool, every worker thread or process uses its own connection
+    """
+    close_old_connections()
+    try:
+        return execute_queued_task(pk)
+    finally:
+        close_old_connections()
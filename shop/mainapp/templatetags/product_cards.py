@@ -0,0 +1,15 @@
+from django import template
+
+from mainapp.models import get_product_version
+
+register = template.Library()
+
+
+@register.simple_tag
+def product_card_key(clothes):
+    """
+    fragment cache key of a product card: model, product id and product version
+    """
+    model_name = clothes.get_model_name()
+    pk = getattr(clothes, 'object_id', clothes.pk)
+    return '{}:{}:{}'.format(model_name, pk, get_product_version(model_name, pk))
@@ -0,0 +1,23 @@
+from django import template
+from django.utils.html import format_html
+
+from mainapp.images import get_srcset
+
+register = template.Library()
+
+
+@register.simple_tag
+def responsive_image(image, sizes='100vw', css_class='', alt='...'):
+    """
+    renders <picture> with WebP and JPEG derivatives, falls back to the original image
+    """
+    if not image:
+        return ''
+    webp_srcset = get_srcset(image.name, 'webp')
+    if not webp_srcset:
+        return format_html('<img class="{}" src="{}" alt="{}" loading="lazy" />', css_class, image.url, alt)
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img class="{}" src="{}" srcset="{}" sizes="{}" alt="{}" loading="lazy" /></picture>',
+        webp_srcset, sizes, css_class, image.url, get_srcset(image.name, 'jpg'), sizes, alt
+    )
@@ -1,3 +1,1325 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import Executor, Future
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, transaction
+from django.db.models import Count, Sum
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.http import HttpResponse, QueryDict
+from django.template.base import Template
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from . import benchmark, images, page_cache, search
+from .admin import get_estimated_count
+from .cart import SessionCart
+from .checks import check_task_backend_cache
+from .instrumentation import RequestTimings, registry
+from .management.commands.run_tasks import Command as RunTasksCommand
+from .middleware import InstrumentationMiddleware
+from .models import (
+    Brand, Cart, CartProduct, CatalogEntry, Category, Client, Hoodie, LatestProducts, Order, OrderLine, Pants,
+    QueuedTask, SearchTerm, Shoes, get_cache_version
+)
+from .tasks import claim_tasks, execute_queued_task
+from .templatetags.product_cards import product_card_key
+from .utils import add_cart_product, change_cart_product_qty, paginate_by_keyset, remove_cart_product
+from .views import (
+    AsyncBaseView, AsyncCategoryDetailView, AsyncClothesDetailView, ClothesDetailView, UsersExportView, UsersView
+)
+
+User = get_user_model()
+
+
+class CatalogMixin:
+    """
+    creates a small catalog and a client
+    """
+    @classmethod
+    def create_catalog(cls):
+        categories = {
+            slug: Category.objects.create(name=name, slug=slug)
+            for name, slug in (('Худи', 'hoodies'), ('Брюки', 'pants'), ('Обувь', 'shoes'))
+        }
+        brand = Brand.objects.create(name='Brand', slug='brand')
+        cls.clothes = []
+        for i in range(3):
+            cls.clothes.append(Hoodie.objects.create(
+                category=categories['hoodies'], brand=brand, title='Hoodie {}'.format(i), image='hoodie.jpg',
+                description='', price=Decimal('10.00'), color='black', length='70', length_sleeve='60',
+                pattern='none', slug='hoodie-{}'.format(i)
+            ))
+            cls.clothes.append(Pants.objects.create(
+                category=categories['pants'], brand=brand, title='Pants {}'.format(i), image='pants.jpg',
+                description='', price=Decimal('20.00'), color='blue', length_inside='80', length_side='100',
+                bottom_width='20', pattern='none', claps='zip', slug='pants-{}'.format(i)
+            ))
+            cls.clothes.append(Shoes.objects.create(
+                category=categories['shoes'], brand=brand, title='Shoes {}'.format(i), image='shoes.jpg',
+                description='', price=Decimal('30.00'), color='white', size='42', outsole_material='rubber',
+                insole_material='foam', inner_material='textile', top_material='leather', slug='shoes-{}'.format(i)
+            ))
+        cls.user = User.objects.create_user('client', 'client@example.com', 'password')
+        cls.client_obj = Client.objects.create(user=cls.user)
+
+
+@override_settings(TASKS_BACKEND='sync')
+class CatalogTestCase(CatalogMixin, TestCase):
+    """
+    base test case with a small catalog and a logged in client
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_catalog()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def fill_cart(self, cart, clothes):
+        for obj in clothes:
+            cart_product = CartProduct.objects.create(
+                user=cart.owner, cart=cart, content_type=ContentType.objects.get_for_model(obj), object_id=obj.id,
+                final_price=obj.price
+            )
+            cart.clothes.add(cart_product)
+
+    def count_queries(self, url):
+        # the first request warms up the navigation and cart summary caches
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def use_temporary_media_root(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        return media_root.name
+
+
+class CartProductPrefetchTest(CatalogTestCase):
+
+    def test_cart_queries_do_not_depend_on_cart_size(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:3])
+        small = self.count_queries('/cart/')
+        self.fill_cart(cart, self.clothes[3:])
+        self.assertEqual(self.count_queries('/cart/'), small)
+        self.assertEqual(self.count_queries('/checkout/'), small)
+
+    def test_profile_queries_do_not_depend_on_order_history(self):
+        def make_order(clothes):
+            cart = Cart.objects.create(owner=self.client_obj, in_order=True)
+            self.fill_cart(cart, clothes)
+            order = Order.objects.create(client=self.client_obj, first_name='a', last_name='b', phone='1', cart=cart)
+            OrderLine.objects.create_for_order(order, cart.get_products())
+
+        make_order(self.clothes[:3])
+        small = self.count_queries('/profile/')
+        make_order(self.clothes[3:5])
+        make_order(self.clothes[5:])
+        self.assertEqual(self.count_queries('/profile/'), small)
+
+
+class CatalogCartQueriesTest(CatalogTestCase):
+    """
+    catalog pages show the cart badge from the session, the cart and the client are not read
+    """
+    def get_cart_queries(self, url):
+        # the first request puts the cart summary into the session
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [
+            query['sql'] for query in context
+            if re.search(r'"mainapp_(cart|cartproduct|cart_clothes|client)"', query['sql'])
+        ]
+
+    def get_catalog_urls(self):
+        return ['/', '/category/hoodies/', '/category/shoes/?sort=price', self.clothes[0].get_absolute_url()]
+
+    def test_anonymous_user(self):
+        self.client.logout()
+        self.client.get('/add-to-cart/hoodie/{}/'.format(self.clothes[0].slug))
+        for url in self.get_catalog_urls():
+            with self.subTest(url=url):
+                self.assertEqual(self.get_cart_queries(url), [])
+
+    def test_logged_in_client(self):
+        self.client.get('/add-to-cart/hoodie/{}/'.format(self.clothes[0].slug))
+        for url in self.get_catalog_urls():
+            with self.subTest(url=url):
+                self.assertEqual(self.get_cart_queries(url), [])
+        # the badge still shows the product added to the cart
+        self.assertContains(self.client.get('/'), 'rounded-pill">1</span>')
+
+
+class QueryShapingTest(CatalogTestCase):
+
+    def add_hoodies(self, count):
+        hoodie = Hoodie.objects.get(pk=self.clothes[0].pk)
+        for i in range(count):
+            hoodie.pk = hoodie.id = None
+            hoodie.slug = 'extra-hoodie-{}'.format(i)
+            hoodie.save()
+
+    def test_listing_projection(self):
+        with CaptureQueriesContext(connection) as context:
+            clothes = list(Hoodie.objects.for_listing())
+            for obj in clothes:
+                str(obj), obj.get_absolute_url(), obj.brand.name, obj.image.name
+        self.assertEqual(len(context), 1)
+        self.assertNotIn('description', context[0]['sql'])
+
+    def test_detail_projection(self):
+        with self.assertNumQueries(1):
+            obj = Pants.objects.for_detail().get(slug='pants-0')
+            str(obj), obj.brand.name, obj.description, obj.claps
+
+    def test_listing_queries_do_not_depend_on_product_count(self):
+        self.user.is_superuser = self.user.is_staff = True
+        self.user.save()
+        category_page = self.count_queries('/category/hoodies/')
+        changelist = self.count_queries('/admin/mainapp/hoodie/')
+        self.add_hoodies(5)
+        self.assertEqual(self.count_queries('/category/hoodies/'), category_page)
+        self.assertEqual(self.count_queries('/admin/mainapp/hoodie/'), changelist)
+
+
+class CatalogEntryTest(CatalogTestCase):
+
+    def get_entries(self):
+        return sorted(CatalogEntry.objects.values_list('slug', 'category__slug', 'brand__slug', 'title', 'price'))
+
+    def get_entry(self, obj):
+        return CatalogEntry.objects.get(content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk)
+
+    def test_entry_follows_the_product(self):
+        hoodie = Hoodie.objects.get(pk=self.clothes[0].pk)
+        hoodie.pk = hoodie.id = None
+        hoodie.slug = 'extra-hoodie'
+        hoodie.save()
+        entry = self.get_entry(hoodie)
+        self.assertEqual((entry.slug, entry.title, entry.price), ('extra-hoodie', 'Hoodie 0', Decimal('10.00')))
+        hoodie.title, hoodie.price = 'Renamed', Decimal('15.00')
+        hoodie.category = Category.objects.get(slug='pants')
+        hoodie.save()
+        entry.refresh_from_db()
+        self.assertEqual((entry.title, entry.price, entry.category.slug), ('Renamed', Decimal('15.00'), 'pants'))
+        self.assertEqual(CatalogEntry.objects.count(), 10)
+        hoodie.delete()
+        self.assertFalse(CatalogEntry.objects.filter(pk=entry.pk).exists())
+        self.assertEqual(CatalogEntry.objects.count(), 9)
+
+    def test_rebuild_restores_a_truncated_index(self):
+        entries = self.get_entries()
+        kept = self.get_entry(self.clothes[1])
+        CatalogEntry.objects.exclude(pk=kept.pk).delete()
+        CatalogEntry.objects.filter(pk=kept.pk).update(price=Decimal('1.00'))
+        call_command('rebuild_catalog', stdout=io.StringIO())
+        self.assertEqual(self.get_entries(), entries)
+        # the entry that was left keeps its id, the "newest" order depends on it
+        self.assertEqual(self.get_entry(self.clothes[1]).pk, kept.pk)
+
+
+class CategoryNavCacheTest(CatalogTestCase):
+
+    def get_nav_counts(self):
+        response = self.client.get('/')
+        return {category['name']: category['count'] for category in response.context['categories']}
+
+    def test_second_render_reads_the_counts_from_the_cache(self):
+        self.client.get('/')
+        with CaptureQueriesContext(connection) as queries:
+            counts = self.get_nav_counts()
+        self.assertEqual(counts, {'Худи': 3, 'Брюки': 3, 'Обувь': 3})
+        self.assertFalse([query for query in queries if 'FROM "mainapp_category"' in query['sql']])
+
+    def test_product_save_refreshes_the_counts_after_commit(self):
+        self.get_nav_counts()
+        hoodie = Hoodie.objects.get(pk=self.clothes[0].pk)
+        hoodie.pk = hoodie.id = None
+        hoodie.slug = 'extra-hoodie'
+        with self.captureOnCommitCallbacks(execute=True):
+            hoodie.save()
+            # the cached counts stay until the change is committed
+            self.assertEqual(self.get_nav_counts(), {'Худи': 3, 'Брюки': 3, 'Обувь': 3})
+        self.assertEqual(self.get_nav_counts(), {'Худи': 4, 'Брюки': 3, 'Обувь': 3})
+
+
+class ProductCardCacheTest(CatalogTestCase):
+
+    def assertCardPrices(self, prices):
+        response = self.client.get('/category/hoodies/')
+        for price, count in prices.items():
+            self.assertContains(response, '{} BYN'.format(price), count=count)
+
+    def test_saved_product_gets_a_new_card(self):
+        hoodie, other = Hoodie.objects.get(pk=self.clothes[0].pk), self.clothes[3]
+        self.assertCardPrices({'10,00': 3})
+        keys = product_card_key(hoodie), product_card_key(other)
+        # a change that bypasses the model keeps the cached card
+        Hoodie.objects.filter(pk=hoodie.pk).update(price=Decimal('11.00'))
+        self.assertCardPrices({'10,00': 3, '11,00': 0})
+        hoodie.price = Decimal('12.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            hoodie.save()
+        self.assertNotEqual(product_card_key(hoodie), keys[0])
+        self.assertEqual(product_card_key(other), keys[1])
+        self.assertCardPrices({'10,00': 2, '12,00': 1})
+
+    def test_admin_price_change_gets_new_cards(self):
+        self.user.is_superuser = self.user.is_staff = True
+        self.user.save()
+        hoodie, other = self.clothes[0], self.clothes[3]
+        self.assertCardPrices({'10,00': 3})
+        keys = product_card_key(hoodie), product_card_key(other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/admin/mainapp/hoodie/', {
+                'action': 'change_price', 'percent': '10', '_selected_action': [hoodie.pk]
+            })
+        self.assertNotEqual(product_card_key(hoodie), keys[0])
+        self.assertEqual(product_card_key(other), keys[1])
+        self.assertCardPrices({'10,00': 2, '11,00': 1})
+
+
+class AdminTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user.is_superuser = self.user.is_staff = True
+        self.user.save()
+
+    def make_orders(self, count):
+        for i in range(count):
+            cart = Cart.objects.create(owner=self.client_obj, in_order=True)
+            self.fill_cart(cart, self.clothes[:2])
+            Order.objects.create(client=self.client_obj, first_name='a', last_name='b', phone=str(i), cart=cart)
+
+    @skipUnless(connection.vendor == 'sqlite', 'sqlite_stat1 is SQLite specific')
+    def test_estimated_count_ignores_partial_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            cursor.execute('SELECT tbl, idx, stat FROM sqlite_stat1 WHERE tbl = %s', ['mainapp_hoodie'])
+            rows = cursor.fetchall()
+            # the row of a partial index comes first, its count is not the row count of the table
+            cursor.execute('DELETE FROM sqlite_stat1 WHERE tbl = %s', ['mainapp_hoodie'])
+            cursor.executemany(
+                'INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (%s, %s, %s)',
+                [('mainapp_hoodie', 'hoodie_partial_idx', '1 1')] + rows
+            )
+        self.assertEqual(get_estimated_count(Hoodie), 3)
+
+    def test_changelist_queries_do_not_depend_on_row_count(self):
+        self.make_orders(2)
+        urls = ('/admin/mainapp/order/', '/admin/mainapp/cartproduct/', '/admin/mainapp/cart/')
+        small = [self.count_queries(url) for url in urls]
+        self.make_orders(5)
+        self.assertEqual([self.count_queries(url) for url in urls], small)
+
+    def test_bulk_price_change(self):
+        hoodies = [obj for obj in self.clothes if isinstance(obj, Hoodie)][:2]
+        with CaptureQueriesContext(connection) as context:
+            self.client.post('/admin/mainapp/hoodie/', {
+                'action': 'change_price', 'percent': '10', '_selected_action': [obj.pk for obj in hoodies]
+            })
+        self.assertEqual(len([query for query in context if query['sql'].startswith('UPDATE')]), 2)
+        for obj in hoodies:
+            self.assertEqual(Hoodie.objects.get(pk=obj.pk).price, Decimal('11.00'))
+            self.assertEqual(CatalogEntry.objects.get(slug=obj.slug).price, Decimal('11.00'))
+        self.assertEqual(Hoodie.objects.exclude(pk__in=[obj.pk for obj in hoodies]).get().price, Decimal('10.00'))
+
+    def test_bulk_status_change(self):
+        self.make_orders(3)
+        ids = list(Order.objects.values_list('id', flat=True)[:2])
+        with CaptureQueriesContext(connection) as context:
+            self.client.post('/admin/mainapp/order/', {'action': 'mark_ready', '_selected_action': ids})
+        self.assertEqual(len([query for query in context if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(Order.objects.filter(status=Order.STATUS_READY).count(), 2)
+
+
+class UsersViewTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user.is_superuser = self.user.is_staff = True
+        self.user.save()
+        self.users = [self.user] + [
+            User.objects.create_user('user{}'.format(i), 'user{}@example.com'.format(i)) for i in range(4)
+        ]
+
+    def test_requires_a_superuser(self):
+        self.client.force_login(self.users[1])
+        self.assertRedirects(self.client.get('/users/'), '/')
+        self.assertRedirects(self.client.get('/users/export/'), '/')
+
+    @mock.patch.object(UsersView, 'users_per_page', 2)
+    def test_pages(self):
+        seen = []
+        params = {}
+        for _ in range(3):
+            response = self.client.get('/users/', params)
+            seen += [user.username for user in response.context['users']]
+            params = response.context['next_page_params']
+            if params is None:
+                break
+            params = QueryDict(params)
+        self.assertIsNone(params)
+        self.assertEqual(seen, [user.username for user in self.users])
+
+    def test_search(self):
+        response = self.client.get('/users/', {'q': 'USER2'})
+        self.assertEqual([user.username for user in response.context['users']], ['user2'])
+        response = self.client.get('/users/', {'q': 'client@'})
+        self.assertEqual([user.username for user in response.context['users']], ['client'])
+
+    @mock.patch.object(UsersExportView, 'chunk_size', 2)
+    def test_csv_export_is_streamed(self):
+        response = self.client.get('/users/export/', {'format': 'csv', 'q': 'user'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="users.csv"')
+        chunks = [chunk.decode() for chunk in response.streaming_content]
+        self.assertEqual(len(chunks), 3)
+        rows = list(csv.reader(io.StringIO(''.join(chunks))))
+        self.assertEqual(rows[0], list(UsersExportView.EXPORT_FIELDS))
+        self.assertEqual([row[1] for row in rows[1:]], ['user0', 'user1', 'user2', 'user3'])
+
+    def test_json_export(self):
+        response = self.client.get('/users/export/', {'format': 'json', 'q': 'user3'})
+        rows = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([(row['id'], row['email']) for row in rows], [(self.users[4].id, 'user3@example.com')])
+
+    def test_csv_export_escapes_formulas(self):
+        User.objects.filter(id=self.users[1].id).update(first_name='=HYPERLINK("http://example.com")', last_name='-1')
+        User.objects.filter(id=self.users[2].id).update(first_name='@SUM(A1)', last_name='+7 900')
+        response = self.client.get('/users/export/', {'format': 'csv', 'q': 'user'})
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row[2:4] for row in rows[1:3]], [
+            ["'=HYPERLINK(\"http://example.com\")", "'-1"], ["'@SUM(A1)", "'+7 900"]
+        ])
+        self.assertEqual(rows[1][0], str(self.users[1].id))
+
+
+class KeysetPaginationTest(CatalogTestCase):
+
+    def test_pages_follow_the_cursor(self):
+        hoodies = sorted(Hoodie.objects.all(), key=lambda obj: obj.id, reverse=True)
+        page, cursor = paginate_by_keyset(Hoodie.objects.all(), ('-id',), page_size=2)
+        self.assertEqual(page, hoodies[:2])
+        self.assertEqual(cursor, str(hoodies[1].id))
+        page, cursor = paginate_by_keyset(Hoodie.objects.all(), ('-id',), cursor, page_size=2)
+        self.assertEqual(page, hoodies[2:])
+        self.assertIsNone(cursor)
+
+    def test_equal_values_are_split_by_the_unique_field(self):
+        Hoodie.objects.filter(id=self.clothes[6].id).update(price=Decimal('5.00'))
+        page, cursor = paginate_by_keyset(Hoodie.objects.all(), ('price', 'id'), page_size=2)
+        self.assertEqual([obj.id for obj in page], [self.clothes[6].id, self.clothes[0].id])
+        self.assertEqual(cursor, '10.00|{}'.format(self.clothes[0].id))
+        page, cursor = paginate_by_keyset(Hoodie.objects.all(), ('price', 'id'), cursor, page_size=2)
+        self.assertEqual([obj.id for obj in page], [self.clothes[3].id])
+        self.assertIsNone(cursor)
+
+    def test_bad_cursor_starts_from_the_first_page(self):
+        first_page, _ = paginate_by_keyset(Hoodie.objects.all(), ('price', 'id'), page_size=2)
+        for cursor in ('abc|1', '10.00', '10.00|x', '10|99999999999999999999999', 'NaN|1', 'Infinity|1'):
+            with self.subTest(cursor=cursor):
+                page, _ = paginate_by_keyset(Hoodie.objects.all(), ('price', 'id'), cursor, page_size=2)
+                self.assertEqual(page, first_page)
+        for cursor in ('abc|x', '10|99999999999999999999999'):
+            response = self.client.get('/category/hoodies/', {'sort': 'price', 'after': cursor})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['category_clothes']), 3)
+        response = self.client.get('/category/hoodies/', {'after': '-99999999999999999999999'})
+        self.assertEqual(len(response.context['category_clothes']), 3)
+
+    def test_facet_filter_and_counts(self):
+        Hoodie.objects.filter(id=self.clothes[0].id).update(color='red')
+        self.assertEqual(
+            list(Hoodie.objects.filter_by_facets(QueryDict('color=red&color=green&brand=brand'))), [self.clothes[0]]
+        )
+        self.assertEqual(Hoodie.objects.filter_by_facets(QueryDict('color=')).count(), 3)
+        facets = {facet['name']: facet['values'] for facet in Hoodie.objects.get_facet_counts()}
+        self.assertEqual(facets['brand'], [dict(value='brand', label='Brand', count=3)])
+        self.assertEqual(facets['color'], [
+            dict(value='black', label='black', count=2), dict(value='red', label='red', count=1)
+        ])
+
+    def test_cached_facets_follow_products_and_brands(self):
+        self.assertEqual(Hoodie.objects.get_cached_facets()[1]['values'][0]['count'], 3)
+        Pants.objects.get_cached_facets()
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.filter(slug='hoodies').get().save()
+        self.assertIsNotNone(cache.get(Hoodie.objects.get_facets_cache_key()))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.clothes[0].color = 'red'
+            self.clothes[0].save()
+        self.assertIsNone(cache.get(Hoodie.objects.get_facets_cache_key()))
+        self.assertIsNotNone(cache.get(Pants.objects.get_facets_cache_key()))
+        Hoodie.objects.get_cached_facets()
+        with self.captureOnCommitCallbacks(execute=True):
+            Brand.objects.update_or_create(slug='brand', defaults={'name': 'New brand'})
+        self.assertIsNone(cache.get(Hoodie.objects.get_facets_cache_key()))
+        self.assertIsNone(cache.get(Pants.objects.get_facets_cache_key()))
+
+
+class CatalogImportTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.use_temporary_media_root(), 'hoodie.jsonl')
+
+    def import_rows(self, rows, **options):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            file.writelines(json.dumps(row) + '\n' for row in rows)
+        call_command('catalog_import', 'hoodie', self.path, no_derivatives=True, stdout=io.StringIO(), **options)
+
+    def test_export_import_round_trip(self):
+        call_command('catalog_export', 'hoodie', output=self.path, stderr=io.StringIO())
+        Hoodie.objects.update(title='Changed', price=Decimal('1.00'))
+        out = io.StringIO()
+        call_command('catalog_import', 'hoodie', self.path, no_derivatives=True, stdout=out)
+        self.assertIn('hoodie: 0 created, 3 updated', out.getvalue())
+        self.assertEqual(
+            sorted(Hoodie.objects.values_list('slug', 'title', 'price', 'brand__slug', 'category__slug')),
+            [('hoodie-{}'.format(i), 'Hoodie {}'.format(i), Decimal('10.00'), 'brand', 'hoodies') for i in range(3)]
+        )
+
+    def test_failed_batch_keeps_indexes_of_written_batches(self):
+        row = {
+            'slug': 'hoodie-new', 'category': 'hoodies', 'brand': 'brand', 'title': 'New hoodie', 'image': '',
+            'description': '', 'price': '15.00', 'color': 'red', 'length': '70', 'length_sleeve': '60',
+            'pattern': 'none'
+        }
+        with self.assertRaisesMessage(CommandError, 'unknown brand "missing"'):
+            self.import_rows([row, dict(row, slug='hoodie-broken', brand='missing')], batch_size=1)
+        self.assertTrue(CatalogEntry.objects.filter(slug='hoodie-new').exists())
+        self.assertFalse(Hoodie.objects.filter(slug='hoodie-broken').exists())
+        self.assertContains(self.client.get('/category/hoodies/'), 'New hoodie')
+
+    def test_replaced_image_is_kept_while_another_product_uses_it(self):
+        default_storage.save('hoodie.jpg', ContentFile(b'image'))
+        call_command('catalog_export', 'hoodie', output=self.path, stderr=io.StringIO())
+        with open(self.path, encoding='utf-8') as file:
+            rows = [json.loads(line) for line in file]
+        rows[0]['image'] = 'new.jpg'
+        self.import_rows(rows)
+        self.assertTrue(default_storage.exists('hoodie.jpg'))
+        Hoodie.objects.filter(slug='hoodie-0').update(image='hoodie.jpg')
+        for row in rows[1:]:
+            row['image'] = 'other.jpg'
+        self.import_rows(rows)
+        self.assertFalse(default_storage.exists('hoodie.jpg'))
+
+
+class ImageDerivativesTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.use_temporary_media_root()
+
+    @staticmethod
+    def save_image(name):
+        buffer = io.BytesIO()
+        Image.new('RGB', (800, 400), (10, 20, 30)).save(buffer, 'JPEG')
+        default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_derivatives_and_srcset(self):
+        self.save_image('hoodie.jpg')
+        self.assertEqual(images.get_srcset('hoodie.jpg', 'webp'), '')
+        images.generate_derivatives('hoodie.jpg')
+        for name in images.get_derivative_names('hoodie.jpg'):
+            self.assertTrue(default_storage.exists(name))
+        with default_storage.open(images.get_derivative_name('hoodie.jpg', 300, 'webp')) as file:
+            self.assertEqual(Image.open(file).size, (300, 150))
+        self.assertEqual(
+            images.get_srcset('hoodie.jpg', 'jpg'),
+            '/media/derivatives/hoodie_150.jpg 150w, /media/derivatives/hoodie_300.jpg 300w, '
+            '/media/derivatives/hoodie_600.jpg 600w'
+        )
+
+    def test_derivatives_refresh_cached_cards_and_pages(self):
+        self.save_image('hoodie.jpg')
+        self.client.logout()
+        self.assertNotContains(self.client.get('/category/hoodies/'), 'image/webp')
+        images.generate_derivatives('hoodie.jpg')
+        self.assertContains(self.client.get('/category/hoodies/'), 'image/webp', count=3)
+
+    def test_first_image_of_a_product_gets_derivatives(self):
+        self.save_image('new.jpg')
+        product = self.clothes[0]
+        Hoodie.objects.filter(pk=product.pk).update(image='')
+        product.refresh_from_db()
+        product.image = 'new.jpg'
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertTrue(default_storage.exists(images.get_derivative_name('new.jpg', 600, 'webp')))
+
+
+class BenchmarkSeedTest(CatalogTestCase):
+
+    def get_seeded_data(self):
+        return (
+            list(Hoodie.objects.filter(slug__startswith='bench-').order_by('slug').values_list(
+                'slug', 'brand__slug', 'color', 'price'
+            )),
+            list(OrderLine.objects.filter(order__first_name='Bench').order_by('id').values_list(
+                'order__client__user__username', 'slug', 'qty'
+            ))
+        )
+
+    def test_same_seed_gives_same_data(self):
+        self.use_temporary_media_root()
+        options = dict(products=5, brands=3, users=3, orders=4, seed_value=1)
+        benchmark.seed(**options)
+        data = self.get_seeded_data()
+        self.assertTrue(data[1])
+        Order.objects.all().delete()
+        Cart.objects.all().delete()
+        for model in (Hoodie, Pants, Shoes):
+            model.objects.filter(slug__startswith='bench-').delete()
+        benchmark.seed(**options)
+        self.assertEqual(self.get_seeded_data(), data)
+
+
+class CartTotalsTest(CatalogTestCase):
+
+    def assertTotals(self, cart, total_products, final_price):
+        cart.refresh_from_db()
+        self.assertEqual((cart.total_products, cart.final_price), (total_products, Decimal(final_price)))
+        lines = cart.clothes.aggregate(count=Count('id'), total=Sum('final_price'))
+        self.assertEqual((lines['count'], lines['total'] or 0), (total_products, Decimal(final_price)))
+
+    def test_totals_follow_cart_changes(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        hoodie, pants = self.clothes[0], self.clothes[1]
+        add_cart_product(cart, hoodie)
+        add_cart_product(cart, pants)
+        add_cart_product(cart, pants)
+        self.assertTotals(cart, 2, '30.00')
+        change_cart_product_qty(cart, pants, 3)
+        self.assertTotals(cart, 2, '70.00')
+        change_cart_product_qty(cart, pants, 3)
+        self.assertTotals(cart, 2, '70.00')
+        remove_cart_product(cart, hoodie)
+        self.assertTotals(cart, 1, '60.00')
+
+    def test_repair_cart_totals(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:2])
+        Cart.objects.filter(pk=cart.pk).update(total_products=7, final_price=Decimal('999.00'))
+        out = io.StringIO()
+        call_command('repair_cart_totals', dry_run=True, stdout=out)
+        self.assertIn('1 carts with wrong totals found', out.getvalue())
+        cart.refresh_from_db()
+        self.assertEqual(cart.total_products, 7)
+        call_command('repair_cart_totals', stdout=io.StringIO())
+        self.assertTotals(cart, 2, '30.00')
+
+
+class SessionCartTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.logout()
+
+    def test_lines_and_total_use_the_same_price(self):
+        hoodie, pants = self.clothes[0], self.clothes[1]
+        for product in (hoodie, pants):
+            self.client.get('/add-to-cart/{}/{}/'.format(product.get_model_name(), product.slug))
+        self.client.post('/change-qty/hoodie/{}/'.format(hoodie.slug), {'qty': 2})
+        Hoodie.objects.filter(pk=hoodie.pk).update(price=Decimal('99.00'))
+        pants.delete()
+        response = self.client.get('/cart/')
+        cart = response.context['cart']
+        lines = cart.get_products()
+        self.assertEqual([(line.content_object.slug, line.qty, line.final_price) for line in lines], [
+            ('hoodie-0', 2, Decimal('20.00'))
+        ])
+        self.assertEqual((cart.total_products, cart.final_price), (1, Decimal('20.00')))
+
+    def test_session_cart_is_merged_on_login(self):
+        hoodie, pants = self.clothes[0], self.clothes[1]
+        client_cart = Cart.objects.create(owner=self.client_obj)
+        add_cart_product(client_cart, pants)
+        for product in (hoodie, pants):
+            self.client.get('/add-to-cart/{}/{}/'.format(product.get_model_name(), product.slug))
+        self.assertEqual(Cart.objects.count(), 1)
+        self.client.post('/login/', {'username': 'client', 'password': 'password'})
+        client_cart.refresh_from_db()
+        self.assertEqual(
+            sorted((line.content_object.slug, line.qty) for line in client_cart.get_products()),
+            [('hoodie-0', 1), ('pants-0', 2)]
+        )
+        self.assertEqual((client_cart.total_products, client_cart.final_price), (2, Decimal('50.00')))
+        self.assertNotIn(SessionCart.SESSION_KEY, self.client.session)
+
+    def test_merge_keeps_the_session_prices(self):
+        hoodie = self.clothes[0]
+        client_cart = Cart.objects.create(owner=self.client_obj)
+        add_cart_product(client_cart, hoodie)
+        self.client.get('/add-to-cart/hoodie/{}/'.format(hoodie.slug))
+        Hoodie.objects.filter(pk=hoodie.pk).update(price=Decimal('99.00'))
+        request = RequestFactory().get('/')
+        request.session = self.client.session
+        with CaptureQueriesContext(connection) as context:
+            SessionCart(request.session).merge_into(client_cart)
+        # the product is loaded once by the session cart, the cart line is not priced again
+        self.assertEqual(len([query for query in context if 'FROM "mainapp_hoodie"' in query['sql']]), 1)
+        client_cart.refresh_from_db()
+        line = client_cart.clothes.get()
+        self.assertEqual((line.qty, line.final_price), (2, Decimal('20.00')))
+        self.assertEqual((client_cart.total_products, client_cart.final_price), (1, Decimal('20.00')))
+
+
+    def test_invalid_qty_is_rejected_for_both_carts(self):
+        hoodie = self.clothes[0]
+        for logged_in in (False, True):
+            if logged_in:
+                self.client.login(username='client', password='password')
+            self.client.get('/add-to-cart/hoodie/{}/'.format(hoodie.slug))
+            for qty in ('abc', '', 0, -1, 1000):
+                response = self.client.post('/change-qty/hoodie/{}/'.format(hoodie.slug), {'qty': qty})
+                self.assertRedirects(response, '/cart/', fetch_redirect_response=False)
+            cart = self.client.get('/cart/').context['cart']
+            self.assertEqual([line.qty for line in cart.get_products()], [1])
+            self.assertEqual(cart.final_price, Decimal('10.00'))
+
+    def test_client_cart_ignores_products_it_does_not_contain(self):
+        hoodie = self.clothes[0]
+        self.client.login(username='client', password='password')
+        self.client.post('/change-qty/hoodie/{}/'.format(hoodie.slug), {'qty': 2})
+        response = self.client.get('/remove-from-cart/hoodie/{}/'.format(hoodie.slug))
+        self.assertRedirects(response, '/cart/', fetch_redirect_response=False)
+        self.assertFalse(CartProduct.objects.exists())
+
+
+class MakeOrderTest(CatalogTestCase):
+
+    def test_repeated_submit_creates_one_order(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:2])
+        data = {
+            'first_name': 'a', 'last_name': 'b', 'phone': '1', 'address': '', 'buying_type': 'self',
+            'order_date': '2030-01-01', 'comment': '', 'idempotency_key': 'key'
+        }
+        for _ in range(2):
+            self.assertRedirects(self.client.post('/make-order/', data), '/', fetch_redirect_response=False)
+        order = Order.objects.get(client=self.client_obj)
+        self.assertEqual(order.cart, cart)
+        self.assertEqual(order.idempotency_key, 'key')
+        self.assertEqual(list(order.related_client.all()), [self.client_obj])
+        cart.refresh_from_db()
+        self.assertTrue(cart.in_order)
+        self.assertEqual((cart.total_products, cart.final_price), (2, Decimal('30.00')))
+
+    def test_submit_without_key_or_products_creates_no_order(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:1])
+        data = {
+            'first_name': 'a', 'last_name': 'b', 'phone': '1', 'buying_type': 'self', 'order_date': '2030-01-01'
+        }
+        for _ in range(2):
+            self.assertRedirects(self.client.post('/make-order/', data), '/checkout/', fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        # the second checkout page has its own key but the cart was ordered by the first one
+        self.client.post('/make-order/', dict(data, idempotency_key='first'))
+        response = self.client.post('/make-order/', dict(data, idempotency_key='second'))
+        self.assertRedirects(response, '/checkout/', fetch_redirect_response=False)
+        self.assertEqual(list(Order.objects.values_list('idempotency_key', flat=True)), ['first'])
+        self.assertContains(self.client.get('/checkout/'), 'Корзина пуста')
+
+    def test_deleted_products_are_not_charged(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:3])
+        self.clothes[1].delete()
+        self.client.post('/make-order/', {
+            'first_name': 'a', 'last_name': 'b', 'phone': '1', 'buying_type': 'self', 'order_date': '2030-01-01',
+            'idempotency_key': 'key'
+        })
+        order = Order.objects.get(client=self.client_obj)
+        self.assertEqual(sorted(order.lines.values_list('slug', flat=True)), ['hoodie-0', 'shoes-0'])
+        self.assertEqual(order.final_price, Decimal('40.00'))
+        cart.refresh_from_db()
+        self.assertEqual((cart.total_products, cart.final_price), (2, Decimal('40.00')))
+        self.assertEqual(cart.clothes.count(), 2)
+        self.assertEqual(CartProduct.objects.filter(cart=cart).count(), 2)
+
+    def test_order_lines_do_not_follow_product_changes(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:1])
+        self.client.post('/make-order/', {
+            'first_name': 'a', 'last_name': 'b', 'phone': '1', 'buying_type': 'self', 'order_date': '2030-01-01',
+            'idempotency_key': 'key'
+        })
+        product = self.clothes[0]
+        product.price = Decimal('99.00')
+        product.save()
+        line = OrderLine.objects.get(order__client=self.client_obj)
+        self.assertEqual(
+            (line.model_name, line.slug, line.title, line.price, line.qty),
+            ('hoodie', 'hoodie-0', 'Hoodie 0', Decimal('10.00'), 1)
+        )
+        # the order shows its own total, not the one of the cart row
+        Cart.objects.filter(order__client=self.client_obj).update(final_price=Decimal('999.00'))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/profile/')
+        order_queries = [query['sql'] for query in context if 'FROM "mainapp_order"' in query['sql']]
+        self.assertEqual(len(order_queries), 1)
+        self.assertNotIn('mainapp_cart', order_queries[0])
+        self.assertContains(response, 'Hoodie 0 x 1')
+        self.assertContains(response, '10,00 BYN')
+        self.assertNotContains(response, '999')
+
+
+class TaskQueueTest(CatalogTestCase):
+
+    def make_order(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:1])
+        self.client.post('/make-order/', {
+            'first_name': 'a', 'last_name': 'b', 'phone': '1', 'buying_type': 'self', 'order_date': '2030-01-01',
+            'idempotency_key': 'key'
+        })
+
+    def test_order_notification_is_sent_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.make_order()
+        self.assertEqual(mail.outbox, [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['client@example.com'])
+        self.assertIn('Hoodie 0 x 1: 10,00 BYN', mail.outbox[0].body)
+        self.assertIn('Итого: 10,00 BYN', mail.outbox[0].body)
+
+    @override_settings(TASKS_BACKEND='db')
+    def test_db_backend_queues_tasks_in_the_transaction(self):
+        self.make_order()
+        queued_task = QueuedTask.objects.get()
+        self.assertEqual(queued_task.name, 'mainapp.notifications.send_order_notification')
+        self.assertEqual(queued_task.args, [Order.objects.get().id])
+        self.assertEqual(claim_tasks(10), [queued_task.id])
+        self.assertTrue(execute_queued_task(queued_task.id))
+        self.assertFalse(QueuedTask.objects.exists())
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed_task_is_retried_with_backoff(self):
+        queued_task = QueuedTask.objects.create(name='mainapp.tasks.missing_task', max_attempts=2)
+        with self.assertLogs('mainapp.tasks', 'WARNING'):
+            for _ in range(2):
+                for pk in claim_tasks(10):
+                    self.assertFalse(execute_queued_task(pk))
+        queued_task.refresh_from_db()
+        self.assertEqual((queued_task.status, queued_task.attempts), (QueuedTask.STATUS_FAILED, 2))
+        self.assertIn('ImportError', queued_task.last_error)
+        self.assertEqual(claim_tasks(10), [])
+
+    @override_settings(TASKS_BACKEND='db')
+    def test_cache_invalidation_does_not_wait_for_the_worker(self):
+        product = self.clothes[0]
+        tag_key = page_cache.TAG_VERSION_KEY.format(page_cache.get_product_tag('hoodie', product.pk))
+        version = get_cache_version(tag_key)
+        LatestProducts.objects.get_feed()
+        with self.captureOnCommitCallbacks(execute=True):
+            product.title = 'Renamed'
+            product.save()
+        self.assertFalse(QueuedTask.objects.exists())
+        self.assertNotEqual(get_cache_version(tag_key), version)
+        self.assertEqual(LatestProducts.objects.get_feed()['hoodie'][-1].title, 'Renamed')
+
+    def test_db_backend_requires_a_shared_cache(self):
+        with override_settings(TASKS_BACKEND='db'):
+            self.assertEqual([error.id for error in check_task_backend_cache(None)], ['mainapp.E001'])
+        shared_cache = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}
+        with override_settings(TASKS_BACKEND='db', CACHES=shared_cache):
+            self.assertEqual(check_task_backend_cache(None), [])
+
+
+@override_settings(INSTRUMENTATION_SERVER_TIMING=True)
+class LatestProductsTest(CatalogTestCase):
+
+    def test_home_page_does_not_query_products(self):
+        self.client.get('/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+        self.assertEqual(len(response.context['all_clothes']), 9)
+        product_queries = [
+            query['sql'] for query in queries
+            if re.search(r'mainapp_(hoodie|pants|shoes|catalogentry)\b', query['sql'])
+        ]
+        self.assertEqual(product_queries, [])
+
+    def test_feed_is_rebuilt_on_product_changes(self):
+        LatestProducts.objects.get_feed()
+        new_hoodie = Hoodie.objects.get(pk=self.clothes[0].pk)
+        new_hoodie.pk = new_hoodie.id = None
+        new_hoodie.slug, new_hoodie.image = 'hoodie-new', ''
+        with self.captureOnCommitCallbacks(execute=True):
+            new_hoodie.save()
+        self.assertEqual(LatestProducts.objects.get_feed()['hoodie'][0].object_id, new_hoodie.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            new_hoodie.delete()
+        self.assertNotIn('hoodie-new', [entry.slug for entry in LatestProducts.objects.get_feed()['hoodie']])
+
+    @override_settings(LATEST_PRODUCTS_PER_CATEGORY=2)
+    def test_respect_to_and_count(self):
+        clothes = LatestProducts.objects.get_products_for_main_page('hoodie', 'pants', 'shoes', respect_to='shoes')
+        self.assertEqual([entry.get_model_name() for entry in clothes], ['shoes'] * 2 + ['hoodie'] * 2 + ['pants'] * 2)
+        self.assertEqual(clothes[0].slug, 'shoes-2')
+
+    def test_feed_rebuild_is_not_reported_as_n_plus_one(self):
+        registry.reset()
+        with self.assertNoLogs('mainapp.instrumentation', 'WARNING'):
+            response = self.client.get('/')
+        self.assertEqual(len(response.context['all_clothes']), 9)
+        self.assertEqual(registry.views['base'].duplicate_query_requests, 0)
+
+
+class ConditionalGetTest(CatalogTestCase):
+
+    def test_product_page_is_not_modified_until_the_product_changes(self):
+        obj = self.clothes[0]
+        response = self.client.get(obj.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+        etag = response['ETag']
+        self.assertEqual(self.client.get(obj.get_absolute_url(), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        obj.price = Decimal('11.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.save()
+        response = self.client.get(obj.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '11,00')
+
+    def test_cart_changes_the_etag(self):
+        obj = self.clothes[0]
+        etag = self.client.get(obj.get_absolute_url())['ETag']
+        self.client.get('/add-to-cart/hoodie/{}/'.format(obj.slug))
+        # pages with pending messages are never answered with 304, the home page shows them
+        self.client.get('/')
+        response = self.client.get(obj.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_anonymous_category_page_is_public(self):
+        self.client.logout()
+        response = self.client.get('/category/hoodies/')
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('s-maxage=60', response['Cache-Control'])
+        response = self.client.get('/category/hoodies/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+
+class PageCacheTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.logout()
+
+    def test_anonymous_page_is_served_without_the_view(self):
+        url = self.clothes[0].get_absolute_url()
+        response = self.client.get(url)
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(url)
+        self.assertEqual(cached_response.content, response.content)
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertTrue(queries)
+
+    def test_product_change_purges_only_its_pages(self):
+        hoodie, pants = self.clothes[0], self.clothes[1]
+        pages = [hoodie.get_absolute_url(), pants.get_absolute_url(), '/category/hoodies/', '/category/pants/', '/']
+        for url in pages:
+            self.client.get(url)
+        hoodie.price = Decimal('11.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            hoodie.save()
+        for url in (pants.get_absolute_url(), '/category/pants/'):
+            with self.assertNumQueries(0):
+                self.client.get(url)
+        for url in (hoodie.get_absolute_url(), '/category/hoodies/', '/'):
+            self.assertContains(self.client.get(url), '11,00')
+
+    def test_category_move_is_found_without_a_lookup(self):
+        product = Hoodie.objects.get(pk=self.clothes[0].pk)
+        for category_slug, nav_purged in (('hoodies', False), ('pants', True)):
+            product.category = Category.objects.get(slug=category_slug)
+            with mock.patch.object(page_cache, 'purge_tags') as purge_tags, \
+                    CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+                product.save()
+            self.assertEqual(page_cache.NAV_TAG in purge_tags.call_args.args, nav_purged)
+            self.assertFalse([query for query in queries if query['sql'].startswith('SELECT (1) AS "a"')])
+
+    def test_other_models_do_not_reach_the_catalog_receivers(self):
+        for model in (Cart, CartProduct, Client, Order, QueuedTask, User):
+            for signal in (pre_save, post_save, post_delete):
+                with self.subTest(model=model, signal=signal):
+                    self.assertFalse(signal.has_listeners(model))
+
+    def test_page_rendered_during_a_purge_is_not_kept(self):
+        product = self.clothes[0]
+        get_context_data = ClothesDetailView.get_context_data
+
+        def get_context_data_with_purge(view, **kwargs):
+            # a change committed by another request while this one renders
+            page_cache.purge_tags(page_cache.get_product_tag('hoodie', product.pk))
+            return get_context_data(view, **kwargs)
+
+        with mock.patch.object(ClothesDetailView, 'get_context_data', get_context_data_with_purge):
+            self.client.get(product.get_absolute_url())
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(product.get_absolute_url())
+        self.assertTrue(queries)
+        with self.assertNumQueries(0):
+            self.client.get(product.get_absolute_url())
+
+
+class InstrumentationTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        registry.reset()
+
+    def test_views_are_recorded(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.fill_cart(cart, self.clothes[:3])
+        response = self.client.get('/cart/')
+        self.assertIn('0 duplicated', response['Server-Timing'])
+        stats = registry.views['cart']
+        self.assertEqual(stats.duration.count, 1)
+        self.assertGreater(stats.queries.sum, 0)
+        self.assertGreater(stats.template_duration.sum, 0)
+        self.assertEqual(stats.duplicate_query_requests, 0)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertIn('mainapp_request_queries_count{view="cart"} 1', self.client.get('/metrics/').content.decode())
+
+    def test_templates_are_timed_without_patching_them(self):
+        render = Template.render
+        InstrumentationMiddleware(lambda request: HttpResponse())
+        self.assertIs(Template.render, render)
+        self.client.logout()
+        self.client.get('/')
+        # the page cache keeps the rendered response, the timing wrapper is not stored with it
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get('/'), 'Hoodie 0')
+        self.assertGreater(registry.views['base'].template_duration.sum, 0)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_need_a_staff_user_or_the_token(self):
+        # behind a local reverse proxy every request comes from an internal address
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.client.logout()
+        for header, status_code in (('Bearer secret', 200), ('Bearer other', 403), ('Bearer секрет', 403)):
+            with self.subTest(header=header):
+                self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION=header).status_code, status_code)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+
+    def test_repeated_query_is_flagged(self):
+        def n_plus_one(request):
+            for obj in self.clothes[:3]:
+                Brand.objects.get(pk=obj.brand_id)
+            return HttpResponse()
+
+        middleware = InstrumentationMiddleware(n_plus_one)
+        with self.assertLogs('mainapp.instrumentation', 'WARNING'):
+            response = middleware(RequestFactory().get('/'))
+        self.assertIn('3 queries, 1 duplicated', response['Server-Timing'])
+        self.assertEqual(registry.views['unresolved'].duplicate_query_requests, 1)
+
+    def test_timings_from_several_threads(self):
+        timings = RequestTimings()
+        barrier = threading.Barrier(8)
+
+        def record():
+            barrier.wait()
+            for _ in range(2000):
+                timings.add_query('SELECT 1', 0.001)
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(timings.queries, 16000)
+        self.assertEqual(timings.get_duplicates(3), [('SELECT 1', 16000)])
+        self.assertAlmostEqual(timings.db_time, 16)
+
+
+class SearchTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the result is cached per process, it must come from the test database
+        search.fts_available.cache_clear()
+        self.addCleanup(search.fts_available.cache_clear)
+
+    def search_titles(self, query):
+        return sorted(entry.title for entry in search.search_products(query))
+
+    def test_stem(self):
+        self.assertEqual(search.stem('Чёрные'), 'черн')
+        self.assertEqual(search.stem('худи'), 'худ')
+        self.assertEqual(search.stem('Hoodie'), 'hoodie')
+        # a too short stem keeps the whole word
+        self.assertEqual(search.stem('еда'), 'еда')
+        self.assertEqual(search.tokenize('Чёрные худи, Hoodie-2'), ['черн', 'худ', 'hoodie', '2'])
+
+    def test_fts_query(self):
+        if not search.fts_available():
+            self.skipTest('SQLite is built without FTS5')
+        self.assertIs(search.get_backend(), search.FTSSearchBackend)
+        self.assertEqual(self.search_titles('hood'), ['Hoodie 0', 'Hoodie 1', 'Hoodie 2'])
+        self.assertEqual(self.search_titles('hoodie 1'), ['Hoodie 1'])
+        self.assertEqual(self.search_titles('leather shoes 2'), ['Shoes 2'])
+        self.assertEqual(self.search_titles('"hoodie'), ['Hoodie 0', 'Hoodie 1', 'Hoodie 2'])
+        self.assertEqual(self.search_titles('missing'), [])
+        self.assertEqual(search.search_products('!!'), [])
+
+    def test_term_fallback(self):
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            self.assertEqual(search.rebuild_index(), len(self.clothes))
+            self.assertEqual(self.search_titles('hood'), ['Hoodie 0', 'Hoodie 1', 'Hoodie 2'])
+            self.assertEqual(self.search_titles('hoodie 1'), ['Hoodie 1'])
+            self.assertEqual(self.search_titles('missing'), [])
+            self.clothes[0].title = 'Свитер'
+            self.clothes[0].save()
+            self.assertEqual(self.search_titles('свитера'), ['Свитер'])
+            self.clothes[0].delete()
+            self.assertEqual(self.search_titles('свитер'), [])
+
+    def rename_brand(self):
+        brand = Brand.objects.get(slug='brand')
+        brand.name = 'Acme'
+        with CaptureQueriesContext(connection) as context:
+            brand.save()
+        return [query['sql'] for query in context if 'mainapp_search' in query['sql']]
+
+    def test_brand_rename_reindexes_its_products_in_batches(self):
+        statements = self.rename_brand()
+        self.assertEqual(self.search_titles('acme hoodie'), ['Hoodie 0', 'Hoodie 1', 'Hoodie 2'])
+        self.assertEqual(self.search_titles('brand'), [])
+        # one delete and one insert per product model, whatever the number of products
+        self.assertLessEqual(len(statements), 6)
+
+    def test_brand_rename_with_the_term_fallback(self):
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            search.rebuild_index()
+            self.rename_brand()
+            self.assertEqual(self.search_titles('acme pants'), ['Pants 0', 'Pants 1', 'Pants 2'])
+            self.assertEqual(self.search_titles('brand'), [])
+            self.assertEqual(SearchTerm.objects.filter(term='brand').count(), 0)
+
+    def test_fts_available(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            has_fts5 = 'ENABLE_FTS5' in {row[0] for row in cursor.fetchall()}
+        self.assertEqual(search.fts_available(), has_fts5)
+
+    def test_migration_fills_the_index(self):
+        migration = import_module('mainapp.migrations.0003_search')
+        search.get_backend().clear()
+        migration.fill_search_index(apps, mock.Mock(connection=connection))
+        self.assertEqual(self.search_titles('hoodie 2'), ['Hoodie 2'])
+        self.assertEqual(self.search_titles('rubber'), ['Shoes 0', 'Shoes 1', 'Shoes 2'])
+
+
+@override_settings(TASKS_BACKEND='sync')
+class AsyncViewsTest(CatalogMixin, TransactionTestCase):
+    """
+    the async views run their queries in other threads, so the catalog has to be committed
+    """
+    def setUp(self):
+        cache.clear()
+        self.create_catalog()
+
+    async def test_catalog_pages_are_async_under_asgi(self):
+        registry.reset()
+        pages = (
+            ('/', AsyncBaseView),
+            ('/category/hoodies/', AsyncCategoryDetailView),
+            (self.clothes[0].get_absolute_url(), AsyncClothesDetailView),
+        )
+        for path, view_class in pages:
+            response = await self.async_client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertIs(response.asgi_request.resolver_match.func.view_class, view_class)
+            self.assertContains(response, 'Hoodie 0')
+        self.assertEqual(len(registry.views), 3)
+        for stats in registry.views.values():
+            self.assertGreater(stats.template_duration.sum, 0)
+
+    def test_views_and_middleware_are_marked_as_coroutine_functions(self):
+        async def get_response(request):
+            return HttpResponse()
+
+        self.assertTrue(asyncio.iscoroutinefunction(AsyncBaseView.as_view()))
+        self.assertFalse(asyncio.iscoroutinefunction(ClothesDetailView.as_view()))
+        self.assertTrue(asyncio.iscoroutinefunction(InstrumentationMiddleware(get_response)))
+        self.assertFalse(asyncio.iscoroutinefunction(InstrumentationMiddleware(lambda request: HttpResponse())))
+
+
+class InlineExecutor(Executor):
+    """
+    runs the submitted calls in the calling thread, connections of other threads to the in-memory
+    test database lock each other's tables
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+class RunTasksCommandTest(TransactionTestCase):
+    """
+    the worker closes the connection after every task, so the tasks have to be committed
+    """
+    @mock.patch.object(RunTasksCommand, 'get_executor', staticmethod(lambda pool, workers: InlineExecutor()))
+    def test_worker_runs_due_and_lost_tasks(self):
+        QueuedTask.objects.create(name='mainapp.images.delete_image', args=['missing.jpg'])
+        QueuedTask.objects.create(
+            name='mainapp.images.delete_image', args=['lost.jpg'], status=QueuedTask.STATUS_RUNNING, attempts=1,
+            started_at=timezone.now() - timedelta(hours=1)
+        )
+        out = io.StringIO()
+        call_command('run_tasks', once=True, workers=2, stale_timeout=60, stdout=out)
+        self.assertIn('1 lost tasks queued again', out.getvalue())
+        self.assertIn('2 tasks done, 0 attempts failed', out.getvalue())
+        self.assertFalse(QueuedTask.objects.exists())
+
+
+@skipUnless(connection.vendor == 'sqlite', 'the pragmas are SQLite specific')
+class SqliteBackendTest(TestCase):
+
+    def get_connection(self, **options):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = dict(connection.settings_dict, NAME=os.path.join(directory.name, 'db.sqlite3'))
+        settings_dict['OPTIONS'] = dict(settings_dict['OPTIONS'], **options)
+        new_connection = connections['default'].__class__(settings_dict, alias='pragmas')
+        self.addCleanup(new_connection.close)
+        return new_connection
+
+    def test_new_connection_gets_the_pragmas(self):
+        new_connection = self.get_connection()
+        with new_connection.cursor() as cursor:
+            values = {}
+            for name in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size', 'temp_store'):
+                cursor.execute('PRAGMA {}'.format(name))
+                values[name] = cursor.fetchone()[0]
+        self.assertEqual(values, {
+            'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 20000, 'mmap_size': 128 * 1024 * 1024,
+            'cache_size': -32000, 'temp_store': 2
+        })
+
+    def test_atomic_blocks_use_the_transaction_mode(self):
+        new_connection = self.get_connection(transaction_mode='IMMEDIATE')
+        connections['pragmas'] = new_connection
+        self.addCleanup(connections.__delitem__, 'pragmas')
+        with CaptureQueriesContext(new_connection) as context:
+            with transaction.atomic(using='pragmas'):
+                pass
+        self.assertEqual(context[0]['sql'], 'BEGIN IMMEDIATE')
+
+    def test_pragmas_are_checked(self):
+        bad_options = (
+            {'pragmas': {'journal_mode': 'wal; DROP TABLE auth_user'}},
+            {'pragmas': {'busy_timeout': '1; DROP TABLE auth_user'}},
+            {'pragmas': {'writable_schema': 'on'}},
+            {'transaction_mode': 'IMMEDIATE; DROP TABLE auth_user'},
+        )
+        for options in bad_options:
+            with self.subTest(options=options), self.assertRaises(ImproperlyConfigured):
+                self.get_connection(**options).ensure_connection()
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class HotPathIndexTest(CatalogTestCase):
+    """
+    fails if a lookup of the cart, cart product or order views falls back to a full table scan
+    """
+    def get_full_scans(self, plan):
+        return [line for line in plan.splitlines() if re.search(r'SCAN (TABLE )?mainapp_\w+$', line.strip())]
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        self.assertFalse(self.get_full_scans(plan), plan)
+
+    def assertViewUsesIndexes(self, method, url, data=None):
+        """
+        explains every statement the view runs against the tables of the app
+        """
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 400)
+        for query in context:
+            sql = query['sql']
+            if not re.match(r'(SELECT|UPDATE|DELETE)\b', sql) or 'mainapp_' not in sql:
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = '\n'.join(row[-1] for row in cursor.fetchall())
+            self.assertFalse(self.get_full_scans(plan), '{}\n{}'.format(sql, plan))
+
+    def test_cart_lookup(self):
+        self.assertUsesIndex(Cart.objects.filter(owner=self.client_obj, in_order=False))
+
+    def test_cart_product_lookup(self):
+        cart = Cart.objects.create(owner=self.client_obj)
+        self.assertUsesIndex(CartProduct.objects.filter(
+            user=self.client_obj, cart=cart, content_type=ContentType.objects.get_for_model(Hoodie),
+            object_id=self.clothes[0].id
+        ))
+
+    def test_order_history(self):
+        self.assertUsesIndex(Order.objects.filter(client=self.client_obj).order_by('-created_at'))
+
+    def test_client_lookup(self):
+        self.assertUsesIndex(Client.objects.filter(user=self.user))
+
+    def test_cart_views(self):
+        kwargs = {'ct_model': 'hoodie', 'slug': self.clothes[0].slug}
+        self.assertViewUsesIndexes('get', '/add-to-cart/{ct_model}/{slug}/'.format(**kwargs))
+        self.assertViewUsesIndexes('post', '/change-qty/{ct_model}/{slug}/'.format(**kwargs), {'qty': 2})
+        self.assertViewUsesIndexes('get', '/cart/')
+        self.assertViewUsesIndexes('get', '/checkout/')
+        self.assertViewUsesIndexes('get', '/remove-from-cart/{ct_model}/{slug}/'.format(**kwargs))
+
+    def test_profile_view(self):
+        cart = Cart.objects.create(owner=self.client_obj, in_order=True)
+        self.fill_cart(cart, self.clothes[:2])
+        Order.objects.create(client=self.client_obj, first_name='a', last_name='b', phone='1', cart=cart)
+        self.assertViewUsesIndexes('get', '/profile/')
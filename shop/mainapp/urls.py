@@ -7,6 +7,7 @@ urlpatterns = [
     path('', BaseView.as_view(), name='base'),
     path('clothes/<str:ct_model>/<str:slug>/', ClothesDetailView.as_view(), name='clothes_detail'),
     path('category/<str:slug>/', CategoryDetailView.as_view(), name='category_detail'),
+    path('search/', SearchView.as_view(), name='search'),
     path('cart/', CartView.as_view(), name='cart'),
     path('add-to-cart/<str:ct_model>/<str:slug>/', AddToCartView.as_view(), name='add_to_cart'),
     path('remove-from-cart/<str:ct_model>/<str:slug>/', DeleteFromCartView.as_view(), name='delete_from_cart'),
@@ -24,5 +25,14 @@ urlpatterns = [
     path('<str:ct_model>/<str:slug>/update/', ClothesUpdateView.as_view(), name='clothes_update'),
     path('clothes-delete/<str:ct_model>/<str:slug>/', ClothesDelete.as_view(), name='clothes_delete'),
 
-    path('users/', UsersView.as_view(), name='show_users')
+    path('users/', UsersView.as_view(), name='show_users'),
+    path('users/export/', UsersExportView.as_view(), name='export_users'),
+    path('metrics/', MetricsView.as_view(), name='metrics')
+]
+
+# native async versions of the read-only catalog views, used for requests served through shop/asgi.py
+async_urlpatterns = [
+    path('', AsyncBaseView.as_view(), name='base'),
+    path('clothes/<str:ct_model>/<str:slug>/', AsyncClothesDetailView.as_view(), name='clothes_detail'),
+    path('category/<str:slug>/', AsyncCategoryDetailView.as_view(), name='category_detail'),
 ]
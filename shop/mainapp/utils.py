@@ -1,11 +1,141 @@
-from django.db import models
-
-# calculates the final price of the cart
-def recalc_cart(cart):
-    cart_data = cart.clothes.aggregate(models.Sum('final_price'), models.Count('id'))
-    if cart_data.get('final_price__sum'):
-        cart.final_price = cart_data['final_price__sum']
-    else:
-        cart.final_price = 0
-    cart.total_products = cart_data['id__count']
-    cart.save()
\ No newline at end of file
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, models, transaction
+
+from .models import Cart, CartProduct
+
+CART_SUMMARY_SESSION_KEY = 'cart_summary'
+
+
+# drops the cart summary cached in the session
+def invalidate_cart_summary(session):
+    if session is not None:
+        session.pop(CART_SUMMARY_SESSION_KEY, None)
+
+
+# applies a change of the cart totals in a single UPDATE statement
+def update_cart_totals(cart, products_delta, price_delta):
+    Cart.objects.filter(pk=cart.pk).update(
+        total_products=models.F('total_products') + products_delta,
+        final_price=models.F('final_price') + price_delta
+    )
+
+
+# adds a product to the cart
+@transaction.atomic
+def add_cart_product(cart, clothes, session=None):
+    content_type = ContentType.objects.get_for_model(clothes.__class__)
+    cart_product, created = CartProduct.objects.get_or_create(
+        user=cart.owner, cart=cart, content_type=content_type, object_id=clothes.id,
+        defaults={'qty': 1, 'final_price': clothes.price}
+    )
+    if created:
+        cart.clothes.add(cart_product)
+        update_cart_totals(cart, 1, cart_product.final_price)
+        invalidate_cart_summary(session)
+    return cart_product
+
+
+# removes a product from the cart
+@transaction.atomic
+def remove_cart_product(cart, clothes, session=None):
+    content_type = ContentType.objects.get_for_model(clothes.__class__)
+    # the row is locked, the delta below must come from the price that is removed
+    cart_product = CartProduct.objects.select_for_update().get(
+        user=cart.owner, cart=cart, content_type=content_type, object_id=clothes.id
+    )
+    # the cart relation rows are removed together with the product
+    cart_product.delete()
+    update_cart_totals(cart, -1, -cart_product.final_price)
+    invalidate_cart_summary(session)
+
+
+# changes the quantity of a product in the cart
+@transaction.atomic
+def change_cart_product_qty(cart, clothes, qty, session=None):
+    if qty < 1:
+        raise ValueError('qty must be at least 1')
+    content_type = ContentType.objects.get_for_model(clothes.__class__)
+    # the row is locked, a concurrent change of the same line would otherwise apply its delta to the
+    # same old price and the cart total would drift
+    cart_product = CartProduct.objects.select_for_update().get(
+        user=cart.owner, cart=cart, content_type=content_type, object_id=clothes.id
+    )
+    final_price = qty * clothes.price
+    CartProduct.objects.filter(pk=cart_product.pk).update(qty=qty, final_price=final_price)
+    update_cart_totals(cart, 0, final_price - cart_product.final_price)
+    invalidate_cart_summary(session)
+
+
+# recalculates the cart lines from the current product prices, returns the lines and the cart total,
+# lines of deleted products are left out, the order does not contain them
+def freeze_cart_prices(cart):
+    cart_products = [cart_product for cart_product in cart.get_products() if cart_product.content_object is not None]
+    changed = []
+    for cart_product in cart_products:
+        final_price = cart_product.qty * cart_product.content_object.price
+        if cart_product.final_price != final_price:
+            cart_product.final_price = final_price
+            changed.append(cart_product)
+    CartProduct.objects.bulk_update(changed, ['final_price'])
+    return cart_products, sum((cart_product.final_price for cart_product in cart_products), 0)
+
+
+# integer cursor parts outside of this range cannot be passed to the database as parameters
+CURSOR_INT_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+
+def is_valid_cursor_value(value):
+    if isinstance(value, int):
+        return CURSOR_INT_RANGE[0] <= value <= CURSOR_INT_RANGE[1]
+    if isinstance(value, Decimal):
+        return value.is_finite()
+    return True
+
+
+# returns one page of the queryset after the cursor and the cursor of the next page, without OFFSET
+def paginate_by_keyset(queryset, ordering, cursor=None, page_size=12):
+    """
+    "ordering" must end with a unique field, e.g. ('price', 'id') or ('-id',)
+    """
+    fields = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        try:
+            values = [
+                queryset.model._meta.get_field(name).to_python(value)
+                for (name, _), value in zip(fields, cursor.split('|'))
+            ]
+        except (ValidationError, ValueError, TypeError):
+            values = []
+        if not all(is_valid_cursor_value(value) for value in values):
+            # a value the database cannot compare with is treated like a bad cursor, the first page is shown
+            values = []
+        if len(values) == len(fields):
+            condition = models.Q()
+            for i, (name, descending) in enumerate(fields):
+                step = models.Q(**{'{}__{}'.format(name, 'lt' if descending else 'gt'): values[i]})
+                for j, (prev_name, _) in enumerate(fields[:i]):
+                    step &= models.Q(**{prev_name: values[j]})
+                condition |= step
+            queryset = queryset.filter(condition)
+    items = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = '|'.join(str(getattr(items[-1], name)) for name, _ in fields)
+    return items, next_cursor
+
+
+# runs a read-only database call in a worker thread with its own connection, so several calls can run at once
+async def run_in_thread(func, *args, **kwargs):
+    def call():
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # worker threads live outside the request cycle, so their connections are recycled here
+            close_old_connections()
+    return await sync_to_async(call, thread_sensitive=False)()
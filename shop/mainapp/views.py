@@ -1,16 +1,34 @@
-from django.db import transaction
-from django.shortcuts import render
+import asyncio
+import csv
+import io
+import json
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Q
 from django.views.generic import DetailView, View, UpdateView, CreateView
-from django.http import HttpResponseRedirect
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse
+from django.template.response import TemplateResponse
 from django.contrib.contenttypes.models import ContentType
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.urls.base import reverse_lazy
 
-from .models import Shoes, Pants, Hoodie, Category, LatestProducts, Client, CartProduct, Order, Brand, User
-from .mixins import CategoryDetailMixin, CartMixin, AuthenticatedSuperuserMixin, AuthenticatedUserMixin
-from .forms import OrderForm, LoginForm, RegistrationForm, ShoesForm, PantsForm, HoodieForm, BrandForm
-from .utils import recalc_cart
+from .models import Shoes, Pants, Hoodie, Category, LatestProducts, Client, Cart, CartProduct, Order, OrderLine, Brand, User
+from .mixins import (
+    AsyncViewMixin, CategoryDetailMixin, CartMixin, ConditionalGetMixin, AuthenticatedSuperuserMixin,
+    AuthenticatedUserMixin
+)
+from .forms import CartQTYForm, OrderForm, LoginForm, RegistrationForm, ShoesForm, PantsForm, HoodieForm, BrandForm
+from .instrumentation import has_metrics_token, registry
+from .notifications import send_order_notification
+from .page_cache import get_brand_tag, get_entry_tags, get_listing_tag, get_product_tag, set_page_tags
+from .search import search_products
+from .utils import (
+    invalidate_cart_summary, freeze_cart_prices, paginate_by_keyset, run_in_thread
+)
 
 # displays the start page
 class BaseView(CartMixin, View):
@@ -23,10 +41,10 @@ class BaseView(CartMixin, View):
             'all_clothes': clothes,
             'cart': self.cart
         }
-        return render(request, 'base.html', context)
+        return set_page_tags(TemplateResponse(request, 'base.html', context), *get_entry_tags(clothes))
 
 # displays the clothes page
-class ClothesDetailView(CartMixin, CategoryDetailMixin, DetailView):
+class ClothesDetailView(ConditionalGetMixin, CartMixin, CategoryDetailMixin, DetailView):
 
     CT_MODEL_MODEL_CLASS = {
         'shoes': Shoes,
@@ -36,13 +54,22 @@ class ClothesDetailView(CartMixin, CategoryDetailMixin, DetailView):
 
     def dispatch(self, request, *args, **kwargs):
         self.model = self.CT_MODEL_MODEL_CLASS[kwargs['ct_model']]
-        self.queryset = self.model._base_manager.all()
+        self.queryset = self.model.objects.for_detail()
         return super().dispatch(request, *args, **kwargs)
 
     context_object_name = 'clothes'
     template_name = 'clothes_detail.html'
     slug_url_kwarg = 'slug'
 
+    def get_last_modified(self):
+        return self.queryset.filter(slug=self.kwargs['slug']).values_list('updated_at', flat=True).first()
+
+    def render_to_response(self, context, **response_kwargs):
+        return set_page_tags(
+            super().render_to_response(context, **response_kwargs),
+            get_product_tag(self.model._meta.model_name, self.object.pk), get_brand_tag(self.object.brand_id)
+        )
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['ct_model'] = self.model._meta.model_name
@@ -50,7 +77,7 @@ class ClothesDetailView(CartMixin, CategoryDetailMixin, DetailView):
         return context
 
 # displays the category page
-class CategoryDetailView(CartMixin, CategoryDetailMixin, DetailView):
+class CategoryDetailView(ConditionalGetMixin, CartMixin, CategoryDetailMixin, DetailView):
 
     model = Category
     queryset = Category.objects.all()
@@ -58,109 +85,200 @@ class CategoryDetailView(CartMixin, CategoryDetailMixin, DetailView):
     template_name = 'category_detail.html'
     slug_url_kwarg = 'slug'
 
+    def get_last_modified(self):
+        clothes_model = self.CATEGORY_SLUG_TO_CLOTHES_MODEL.get(self.kwargs['slug'])
+        if clothes_model is None:
+            return None
+        return clothes_model._base_manager.aggregate(Max('updated_at'))['updated_at__max']
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super().render_to_response(context, **response_kwargs)
+        clothes_model = self.CATEGORY_SLUG_TO_CLOTHES_MODEL.get(self.object.slug)
+        if clothes_model is None:
+            return response
+        return set_page_tags(response, get_listing_tag(clothes_model._meta.model_name))
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['cart'] = self.cart
         return context
 
+# displays the start page, async version served under ASGI
+class AsyncBaseView(AsyncViewMixin, CartMixin, View):
+
+    async def get(self, request):
+        categories, clothes = await asyncio.gather(
+            run_in_thread(Category.objects.get_categories_for_nav),
+            run_in_thread(LatestProducts.objects.get_products_for_main_page, 'hoodie', 'pants', 'shoes')
+        )
+        context = {
+            'categories': categories,
+            'all_clothes': clothes,
+            'cart': self.cart
+        }
+        response = TemplateResponse(request, 'base.html', context)
+        return set_page_tags(response, *get_entry_tags(clothes))
+
+# displays the clothes page, async version served under ASGI
+class AsyncClothesDetailView(AsyncViewMixin, ClothesDetailView):
+
+    async def get(self, request, *args, **kwargs):
+        self.object, categories = await asyncio.gather(
+            run_in_thread(self.get_object), run_in_thread(Category.objects.get_categories_for_nav)
+        )
+        context = {
+            'object': self.object,
+            'clothes': self.object,
+            'view': self,
+            'ct_model': self.model._meta.model_name,
+            'cart': self.cart,
+            'categories': categories
+        }
+        return self.render_to_response(context)
+
+# displays the category page, async version served under ASGI
+class AsyncCategoryDetailView(AsyncViewMixin, CategoryDetailView):
+
+    async def get(self, request, *args, **kwargs):
+        self.object = await run_in_thread(self.get_object)
+        category_context, categories = await asyncio.gather(
+            run_in_thread(self.get_category_clothes_context, self.object),
+            run_in_thread(Category.objects.get_categories_for_nav)
+        )
+        context = {
+            'object': self.object,
+            'category': self.object,
+            'view': self,
+            'cart': self.cart,
+            'categories': categories,
+            **category_context
+        }
+        return self.render_to_response(context)
+
+# displays the product search results
+class SearchView(CartMixin, View):
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        context = {
+            'categories': Category.objects.get_categories_for_nav(),
+            'query': query,
+            'search_results': search_products(query),
+            'cart': self.cart
+        }
+        return TemplateResponse(request, 'search.html', context)
+
 # adding an item to the cart
-class AddToCartView(AuthenticatedUserMixin, CartMixin, View):
+class AddToCartView(CartMixin, View):
 
     def get(self, request, **kwargs):
         ct_model, clothes_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        clothes = content_type.model_class().objects.get(slug=clothes_slug)
-        cart_product, created = CartProduct.objects.get_or_create(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=clothes.id
-        )
-        if created:
-            self.cart.clothes.add(cart_product)
-        recalc_cart(self.cart)
+        content_type = ContentType.objects.get_by_natural_key('mainapp', ct_model)
+        clothes = content_type.model_class().objects.for_listing().get(slug=clothes_slug)
+        self.cart.add(clothes, request.session)
         messages.add_message(request, messages.INFO, "Товар добавлен")
         return HttpResponseRedirect('/cart/')
 
 # removing an item from the cart
-class DeleteFromCartView(AuthenticatedUserMixin, CartMixin, View):
+class DeleteFromCartView(CartMixin, View):
 
     def get(self, request, **kwargs):
         ct_model, clothes_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        clothes = content_type.model_class().objects.get(slug=clothes_slug)
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=clothes.id
-        )
-        self.cart.clothes.remove(cart_product)
-        cart_product.delete()
-        recalc_cart(self.cart)
+        content_type = ContentType.objects.get_by_natural_key('mainapp', ct_model)
+        clothes = content_type.model_class().objects.for_listing().get(slug=clothes_slug)
+        self.cart.remove(clothes, request.session)
         messages.add_message(request, messages.INFO, "Товар удален")
         return HttpResponseRedirect('/cart/')
 
 # changing the number of items in the cart
-class ChangeQTYView(AuthenticatedUserMixin, CartMixin, View):
+class ChangeQTYView(CartMixin, View):
 
     def post(self, request, **kwargs):
         ct_model, clothes_slug = kwargs.get('ct_model'), kwargs.get('slug')
-        content_type = ContentType.objects.get(model=ct_model)
-        clothes = content_type.model_class().objects.get(slug=clothes_slug)
-        cart_product = CartProduct.objects.get(
-            user=self.cart.owner, cart=self.cart, content_type=content_type, object_id=clothes.id
-        )
-        qty = int(request.POST.get('qty'))
-        cart_product.qty = qty
-        cart_product.save()
-        recalc_cart(self.cart)
+        content_type = ContentType.objects.get_by_natural_key('mainapp', ct_model)
+        clothes = content_type.model_class().objects.for_listing().get(slug=clothes_slug)
+        form = CartQTYForm(request.POST)
+        if not form.is_valid():
+            messages.add_message(request, messages.ERROR, "Неверное кол-во товара")
+            return HttpResponseRedirect('/cart/')
+        self.cart.set_qty(clothes, form.cleaned_data['qty'], request.session)
         messages.add_message(request, messages.INFO, "Изменено кол-во товара")
         return HttpResponseRedirect('/cart/')
 
 # displays the cart page
-class CartView(AuthenticatedUserMixin, CartMixin, CategoryDetailMixin, View):
+class CartView(CartMixin, CategoryDetailMixin, View):
 
     def get(self, request):
         categories = (Category.objects.get_categories_for_nav())
         context = {
             'cart': self.cart,
+            'cart_products': self.cart.get_products(),
             'categories': categories
         }
-        return render(request, 'cart.html', context)
+        return TemplateResponse(request, 'cart.html', context)
 
 # displays the order creation page
 class CheckoutView(AuthenticatedUserMixin, CartMixin, CategoryDetailMixin, View):
 
     def get(self, request):
         categories = (Category.objects.get_categories_for_nav())
-        form = OrderForm(request.POST or None)
+        form = OrderForm(request.POST or None, initial={'idempotency_key': uuid.uuid4().hex})
         context = {
             'cart': self.cart,
+            'cart_products': self.cart.get_products(),
             'categories': categories,
             'form': form
         }
-        return render(request, 'checkout.html', context)
+        return TemplateResponse(request, 'checkout.html', context)
 
 # order creation
 class MakeOrderView(AuthenticatedUserMixin, CartMixin, CategoryDetailMixin, View):
 
-    @transaction.atomic
     def post(self, request):
         form = OrderForm(request.POST or None)
-        client = Client.objects.get(user=request.user)
-        if form.is_valid():
-            new_order = form.save(commit=False)
-            new_order.client = client
-            new_order.first_name = form.cleaned_data['first_name']
-            new_order.last_name = form.cleaned_data['last_name']
-            new_order.phone = form.cleaned_data['phone']
-            new_order.address = form.cleaned_data['address']
-            new_order.buying_type = form.cleaned_data['buying_type']
-            new_order.comment = form.cleaned_data['comment']
-            new_order.save()
-            self.cart.in_order = True
-            self.cart.save()
-            new_order.cart = self.cart
-            new_order.save()
-            client.orders.add(new_order)
-            messages.add_message(request, messages.INFO, 'Заказано!')
-            return HttpResponseRedirect('/')
-        return HttpResponseRedirect('/checkout/')
+        if not form.is_valid():
+            return HttpResponseRedirect('/checkout/')
+        idempotency_key = form.cleaned_data['idempotency_key']
+        if Order.objects.filter(idempotency_key=idempotency_key).exists():
+            return self.order_placed(request)
+        try:
+            with transaction.atomic():
+                cart = Cart.objects.select_for_update().filter(pk=self.cart.pk, in_order=False).first()
+                if cart is None:
+                    return self.order_placed(request)
+                cart_products, final_price = freeze_cart_prices(cart)
+                # a repeated submit from another checkout page finds the fresh empty cart
+                if not cart_products:
+                    messages.add_message(request, messages.ERROR, 'Корзина пуста')
+                    return HttpResponseRedirect('/checkout/')
+                # the conditional update claims the cart, a concurrent checkout of the same cart updates nothing
+                if not Cart.objects.filter(pk=cart.pk, in_order=False).update(
+                        in_order=True, total_products=len(cart_products), final_price=final_price):
+                    return self.order_placed(request)
+                # lines of deleted products are not part of the order or its total
+                CartProduct.objects.filter(cart=cart).exclude(
+                    pk__in=[cart_product.pk for cart_product in cart_products]
+                ).delete()
+                new_order = form.save(commit=False)
+                new_order.client_id = cart.owner_id
+                new_order.cart = cart
+                new_order.idempotency_key = idempotency_key
+                new_order.final_price = final_price
+                new_order.save()
+                new_order.related_client.add(cart.owner_id)
+                OrderLine.objects.create_for_order(new_order, cart_products)
+                # the email is sent by a task once the order is committed
+                send_order_notification.delay(new_order.id)
+        except IntegrityError:
+            # the same idempotency key was committed by a concurrent request
+            return self.order_placed(request)
+        return self.order_placed(request)
+
+    @staticmethod
+    def order_placed(request):
+        invalidate_cart_summary(request.session)
+        messages.add_message(request, messages.INFO, 'Заказано!')
+        return HttpResponseRedirect('/')
 
 # displays the login page
 class LoginView(CartMixin, CategoryDetailMixin, View):
@@ -169,7 +287,7 @@ class LoginView(CartMixin, CategoryDetailMixin, View):
         form = LoginForm(request.POST or None)
         categories = Category.objects.get_categories_for_nav()
         context = {'form': form, 'categories': categories, 'cart': self.cart}
-        return render(request, 'profile/login.html', context)
+        return TemplateResponse(request, 'profile/login.html', context)
 
     def post(self, request):
         form = LoginForm(request.POST or None)
@@ -181,7 +299,7 @@ class LoginView(CartMixin, CategoryDetailMixin, View):
                 login(request, user)
                 return HttpResponseRedirect('/')
         context = {'form': form, 'cart': self.cart}
-        return render(request, 'profile/login.html', context)
+        return TemplateResponse(request, 'profile/login.html', context)
 
 # displays the registration page
 class RegistrationView(CartMixin, CategoryDetailMixin, View):
@@ -189,7 +307,7 @@ class RegistrationView(CartMixin, CategoryDetailMixin, View):
         form = RegistrationForm(request.POST or None)
         categories = Category.objects.get_categories_for_nav()
         context = {'form': form, 'categories': categories, 'cart': self.cart}
-        return render(request, 'profile/registration.html', context)
+        return TemplateResponse(request, 'profile/registration.html', context)
 
     def post(self, request):
         form = RegistrationForm(request.POST or None)
@@ -211,16 +329,33 @@ class RegistrationView(CartMixin, CategoryDetailMixin, View):
             login(request, user)
             return HttpResponseRedirect('/')
         context = {'form': form, 'cart': self.cart}
-        return render(request, 'profile/registration.html', context)
+        return TemplateResponse(request, 'profile/registration.html', context)
 
 # displays the user profile page
 class ProfileView(AuthenticatedUserMixin, CartMixin, CategoryDetailMixin, View):
 
+    ORDERS_ORDERING = ('-created_at', '-id')
+    orders_per_page = 10
+
     def get(self, request):
         client = Client.objects.get(user=request.user)
-        orders = Order.objects.filter(client=client).order_by('-created_at')
+        orders, next_cursor = paginate_by_keyset(
+            Order.objects.filter(client=client).prefetch_related('lines'),
+            self.ORDERS_ORDERING, request.GET.get('after'), self.orders_per_page
+        )
         categories = Category.objects.get_categories_for_nav()
-        return render(request, 'profile/profile.html', {'orders': orders, 'cart': self.cart, 'categories': categories})
+        next_page_params = None
+        if next_cursor:
+            next_page_params = request.GET.copy()
+            next_page_params['after'] = next_cursor
+            next_page_params = next_page_params.urlencode()
+        context = {
+            'orders': orders,
+            'next_page_params': next_page_params,
+            'cart': self.cart,
+            'categories': categories
+        }
+        return TemplateResponse(request, 'profile/profile.html', context)
 
 # deleting an item from the database
 class ClothesDelete(AuthenticatedSuperuserMixin, View):
@@ -228,7 +363,7 @@ class ClothesDelete(AuthenticatedSuperuserMixin, View):
     def get(self, request, **kwargs):
         ct_model, clothes_slug = kwargs.get('ct_model'), kwargs.get('slug')
         content_type = ContentType.objects.get(model=ct_model)
-        product = content_type.model_class().objects.get(slug=clothes_slug)
+        product = content_type.model_class().objects.for_listing().get(slug=clothes_slug)
         product.delete()
         messages.add_message(request, messages.INFO, "Товар удален из базы")
         return HttpResponseRedirect('/category/{}s/'.format(ct_model))
@@ -277,7 +412,7 @@ class ClothesUpdateView(AuthenticatedSuperuserMixin, UpdateView):
 
     def dispatch(self, request, *args, **kwargs):
         self.model = self.CT_MODEL_MODEL_CLASS[kwargs['ct_model']]
-        self.queryset = self.model._base_manager.all()
+        self.queryset = self.model.objects.for_detail()
         self.form_class = self.CT_MODEL_FORM_CLASS[kwargs['ct_model']]
         return super().dispatch(request, *args, **kwargs)
 
@@ -310,12 +445,96 @@ class BrandCreateView(AuthenticatedSuperuserMixin, CreateView):
 
 # displays a page with registered users
 class UsersView(AuthenticatedSuperuserMixin, CartMixin, CategoryDetailMixin, View):
-    def get(self, request):
+
+    USERS_ORDERING = ('id',)
+    users_per_page = 50
+
+    @staticmethod
+    def search_users(query):
+        """
+        users whose username or email starts with the query
+        """
         users = User.objects.all()
+        if query:
+            users = users.filter(Q(username__istartswith=query) | Q(email__istartswith=query))
+        return users
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        users, next_cursor = paginate_by_keyset(
+            self.search_users(query).only('id', 'username', 'first_name', 'last_name', 'email'),
+            self.USERS_ORDERING, request.GET.get('after'), self.users_per_page
+        )
+        next_page_params = None
+        if next_cursor:
+            next_page_params = request.GET.copy()
+            next_page_params['after'] = next_cursor
+            next_page_params = next_page_params.urlencode()
         categories = Category.objects.get_categories_for_nav()
         context = {
             'users': users,
+            'users_query': query,
+            'next_page_params': next_page_params,
             'cart': self.cart,
             'categories': categories
         }
-        return render(request, 'profile/users.html', context)
+        return TemplateResponse(request, 'profile/users.html', context)
+
+# streams the list of users as CSV or JSON
+class UsersExportView(AuthenticatedSuperuserMixin, View):
+
+    EXPORT_FIELDS = ('id', 'username', 'first_name', 'last_name', 'email', 'date_joined')
+    # spreadsheets run cells starting with these characters as formulas
+    FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+    chunk_size = 2000
+
+    def get(self, request):
+        users = UsersView.search_users(request.GET.get('q', '').strip()).order_by('id').values_list(
+            *self.EXPORT_FIELDS
+        ).iterator(chunk_size=self.chunk_size)
+        if request.GET.get('format') == 'json':
+            response = StreamingHttpResponse(self.iter_json(users), content_type='application/json')
+            response['Content-Disposition'] = 'attachment; filename="users.json"'
+        else:
+            response = StreamingHttpResponse(self.iter_csv(users), content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = 'attachment; filename="users.csv"'
+        return response
+
+    def iter_csv(self, users):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(self.EXPORT_FIELDS)
+        for i, row in enumerate(users, 1):
+            writer.writerow([self.escape_formula(value) for value in row])
+            if i % self.chunk_size == 0:
+                yield self.flush(buffer)
+        yield self.flush(buffer)
+
+    def iter_json(self, users):
+        yield '['
+        separator = ''
+        for row in users:
+            yield separator + json.dumps(dict(zip(self.EXPORT_FIELDS, row)), cls=DjangoJSONEncoder, ensure_ascii=False)
+            separator = ',\n'
+        yield ']\n'
+
+    @classmethod
+    def escape_formula(cls, value):
+        if isinstance(value, str) and value.startswith(cls.FORMULA_PREFIXES):
+            return "'" + value
+        return value
+
+    @staticmethod
+    def flush(buffer):
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+# exports the request statistics in the Prometheus text format
+class MetricsView(View):
+
+    def get(self, request):
+        if not request.user.is_staff and not has_metrics_token(request):
+            return HttpResponseForbidden()
+        return HttpResponse(registry.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
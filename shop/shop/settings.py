@@ -43,6 +43,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'mainapp.middleware.InstrumentationMiddleware',
+    'mainapp.middleware.ASGIURLConfMiddleware',
+    'mainapp.middleware.PageCacheMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -53,6 +56,16 @@ MIDDLEWARE = [
 ]
 
 ROOT_URLCONF = 'shop.urls'
+# used instead of ROOT_URLCONF for requests served by shop/asgi.py, empty to serve the same views as WSGI
+ASGI_ROOT_URLCONF = os.environ.get('ASGI_ROOT_URLCONF', 'shop.urls_asgi')
+
+# per-view query, SQL time and template time statistics (see mainapp.middleware.InstrumentationMiddleware)
+INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED', '1') == '1'
+# a statement repeated this many times in one request is reported as a possible N+1
+INSTRUMENTATION_DUPLICATE_THRESHOLD = int(os.environ.get('INSTRUMENTATION_DUPLICATE_THRESHOLD', 3))
+INSTRUMENTATION_SERVER_TIMING = os.environ.get('INSTRUMENTATION_SERVER_TIMING', '1' if DEBUG else '0') == '1'
+# bearer token for reading /metrics/ without logging in as a staff user, empty to allow staff users only
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 TEMPLATES = [
     {
@@ -65,6 +78,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'mainapp.context_processors.cart_summary',
             ],
         },
     },
@@ -78,12 +92,39 @@ WSGI_APPLICATION = 'shop.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        # the SQLite backend with the "pragmas" and "transaction_mode" options, see mainapp.sqlite_backend
+        'ENGINE': 'mainapp.sqlite_backend',
+        'NAME': os.environ.get('DJANGO_DB_NAME', BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': int(os.environ.get('DJANGO_CONN_MAX_AGE', 60)),
+        'OPTIONS': {
+            # applied to every new connection
+            'pragmas': {
+                'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'wal'),
+                'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'normal'),
+                'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 20000)),
+                'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 128 * 1024 * 1024)),
+                'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -32000)),
+                'temp_store': os.environ.get('SQLITE_TEMP_STORE', 'memory'),
+            },
+            'transaction_mode': 'IMMEDIATE' if os.environ.get('SQLITE_IMMEDIATE_TRANSACTIONS', '1') == '1' else None,
+        },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', 'shop-default'),
+    }
+}
+
+SESSION_ENGINE = os.environ.get('DJANGO_SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -126,6 +167,26 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# background tasks (image derivatives and deletion, order emails):
+# "thread" runs them in a thread pool of the web process, "db" stores them for the "run_tasks" worker
+# and needs a cache shared between processes, "sync" runs them in the request right after the commit
+TASKS_BACKEND = os.environ.get('TASKS_BACKEND', 'thread')
+TASKS_WORKERS = int(os.environ.get('TASKS_WORKERS', 2))
+
+EMAIL_BACKEND = os.environ.get('DJANGO_EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.environ.get('DJANGO_DEFAULT_FROM_EMAIL', 'shop@localhost')
+
+# products of each category in the home page feed
+LATEST_PRODUCTS_PER_CATEGORY = int(os.environ.get('LATEST_PRODUCTS_PER_CATEGORY', 4))
+
+# seconds a reverse proxy may serve anonymous product and category pages without revalidating them
+CATALOG_PAGE_SHARED_MAX_AGE = int(os.environ.get('CATALOG_PAGE_SHARED_MAX_AGE', 60))
+
+# whole-page cache of the home, category and product pages for visitors without a session,
+# pages are purged by tags when products, brands or categories change, the timeout is a safety net
+PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', 3600))
+
 STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static_dev'),
 )
@@ -0,0 +1,9 @@
+from django.urls import path, include
+
+from mainapp.urls import async_urlpatterns
+from .urls import urlpatterns as wsgi_urlpatterns
+
+# root URLconf for ASGI requests: the async catalog views shadow their sync versions
+urlpatterns = [
+    path('', include(async_urlpatterns)),
+] + wsgi_urlpatterns